@@ -6,6 +6,9 @@ import serial
 import time
 import threading
 import logging
+import collections
+import contextlib
+import Queue
 
 # functions for talking to animatics smart motors over rs232 in
 # python, because we can use it in windows without having to try too
@@ -15,6 +18,18 @@ import logging
 # too much.
 
 import winch_settings
+import telemetry
+import commstats
+import clock
+import transport
+import scheduler
+import profiles
+import slack
+import conditions
+import trajectory
+import spool
+import calibration
+import positionmove
 
 
 class FakeAnimatics(object):
@@ -23,12 +38,29 @@ class FakeAnimatics(object):
     """ 
     version = '5.0.3.61'
     srate = 8000
+    bauds = [2400,4800,9600,19200,38400,57600,115200]
     
-    def __init__(self):
-        self.buff = ""
+    def __init__(self,clk=None):
+        self.clock = clk or clock.get_clock()
+        # bytes on their way back to the PC are buff[buff_start:], and
+        # the PC can read those up to rx_avail
+        self.buff = bytearray()
+        self.buff_start = 0
+        self.rx_avail = 0
+        # read timeout, seconds, as for serial.Serial.  None waits forever
+        self.timeout = 1
+        # serial line model: the PC side rate, the motor side rate,
+        # when the last byte written reaches the motor, and when the last
+        # byte in buff finishes arriving at the PC.
+        self.baudrate = winch_settings.winch_baud
+        self.motor_baud = 9600
+        self.tx_end = 0.0
+        self.rx_end = 0.0
+        # while handling a write, the time the command reached the motor
+        self.t_arrive = None
         self.traj = None
         self.traj_fn = None
-        self.time_zero = time.time()
+        self.time_zero = self.clock.time()
         
         self.state = dict(VT=0,
                           ADT=100,
@@ -36,28 +68,196 @@ class FakeAnimatics(object):
                           RVA=0,
                           REL=100, # should find the actual default
                           RTRQ=0,  # does nothing...
+                          UIA=100,
                           T=10,
                           TS=200000,
-                          RMODE=0)
+                          RMODE=0,
+                          a=50, # telemetry stream period
+                          m=0)  # resident program mode
         self.log = logging.getLogger('fakewinch')
-        
-    def read(self):
-        if len(self.buff) == 0:
-            # print "[fake] read past end of buffer"
-            time.sleep(1)
-            return ""
+        # time the next telemetry record is due, when the stream program
+        # is running
+        self.stream_due = None
+        # the cast sequencer's current segment, when it is running
+        self.cast_segment = None
+
+    # the PC's receive FIFO hands bytes over rx_fifo at a time, or
+    # whatever it holds once the line has been idle for rx_idle byte
+    # times, as a 16550 UART does.  rx_fifo=1 passes each byte on as it
+    # arrives.
+    rx_fifo = 14
+    rx_idle = 4
+
+    def arrived(self,now):
+        """ number of buffered bytes which the PC can read by time now
+        """
+        if now >= self.rx_end + self.rx_idle*self.byte_time() - 1e-9:
+            self.rx_avail = len(self.buff)
         else:
-            char = self.buff[0]
-            self.buff = self.buff[1:]
-            return char
+            in_transit = int(math.ceil((self.rx_end - now)/self.byte_time() - 1e-9))
+            crossed = len(self.buff) - max(0,in_transit) - self.rx_avail
+            if crossed > 0:
+                self.rx_avail += crossed - crossed % self.rx_fifo
+        return self.rx_avail - self.buff_start
+
+    def ready_at(self,size):
+        """ time at which size of the buffered bytes can be read, if
+        nothing more is sent
+        """
+        short = self.buff_start + size - self.rx_avail
+        if short <= 0:
+            return self.clock.time()
+        count = self.rx_avail + short + (-short) % self.rx_fifo
+        if count <= len(self.buff):
+            return self.rx_end - (len(self.buff)-count)*self.byte_time()
+        return self.rx_end + self.rx_idle*self.byte_time()
+
+    @property
+    def in_waiting(self):
+        self.update_program()
+        return self.arrived(self.clock.time())
+
+    def read(self,size=1):
+        """ as for serial.Serial - wait until size bytes have arrived or
+        the timeout expires, and return what's there.
+        """
+        now = self.clock.time()
+        deadline = None if self.timeout is None else now + self.timeout
+        while 1:
+            self.update_program()
+            if self.arrived(now) >= size:
+                break
+            if deadline is not None and now >= deadline:
+                break
+            if self.read_cancelled:
+                self.read_cancelled = False
+                break
+            pending = len(self.buff) - self.buff_start
+            if pending >= size:
+                t_next = self.ready_at(size)
+            elif self.stream_due is not None:
+                t_next = self.stream_due
+            elif deadline is None:
+                # nothing more is coming, and writes come from the
+                # thread that's reading, so don't wait forever
+                break
+            else:
+                t_next = deadline
+            if deadline is not None:
+                t_next = min(t_next,deadline)
+            self.clock.sleep(max(0,t_next-now))
+            now = self.clock.time()
+        count = min(size,self.arrived(now))
+        data = str(self.buff[self.buff_start:self.buff_start+count])
+        self.buff_start += count
+        if self.buff_start > 4096 and 2*self.buff_start > len(self.buff):
+            # drop what's been read, without copying on every read
+            del self.buff[:self.buff_start]
+            self.rx_avail -= self.buff_start
+            self.buff_start = 0
+        return data
+
+    # set by cancel_read() from another thread, and seen by read() the
+    # next time it looks at the clock
+    read_cancelled = False
+    def cancel_read(self):
+        """ as for serial.Serial - end a blocking read() early
+        """
+        self.read_cancelled = True
+
+    def byte_time(self):
+        # 8N1 - 10 bits per byte
+        return 10.0/self.motor_baud
+
+    def respond(self,txt):
+        """ queue txt to be sent back to the PC, at the motor's baud rate
+        """
+        start = self.t_arrive or self.clock.time()
+        self.rx_end = max(start,self.rx_end) + len(txt)*self.byte_time()
+        self.buff.extend(txt)
+
+    def flush(self):
+        # wait for output to be transmitted
+        self.clock.sleep(max(0,self.tx_end - self.clock.time()))
+    def reset_input_buffer(self):
+        del self.buff[:]
+        self.buff_start = 0
+        self.rx_avail = 0
+    flushInput = reset_input_buffer
+
+    def update_program(self):
+        """ emulate the resident program - the cast sequencer if it is
+        running, and any telemetry records which are due
+        """
+        if self.cast_segment is not None:
+            self.update_cast()
+        if self.stream_due is not None:
+            self.update_stream()
+
+    def update_stream(self):
+        """ append any telemetry records which are due
+        """
+        t = self.clock.time()
+        period = self.state['a']/1000.0
+        if t - self.stream_due > 1.0:
+            # don't try to catch up on a long backlog
+            self.stream_due = t
+        while self.stream_due <= t:
+            self.stream_record(self.stream_due)
+            self.stream_due += period
+
+    def stream_record(self,t):
+        self.respond("%s%i,%i,%i,%i,%i,%d\r"%(telemetry.STREAM_PREFIX,
+                                              self.status_word(),
+                                              self.state['RVA'],self.state['RPA'],
+                                              self.state['UIA'],self.state['RTRQ'],
+                                              1000*(t - self.time_zero)))
+
+    def update_cast(self):
+        """ the cast sequencer - switch VT as the position passes the
+        breakpoints, and go on to the stream or end with the move.  Only runs when
+        the PC talks to the motor or a telemetry record is due, rather
+        than every sample.
+        """
+        st = self.state
+        self.update_position()
+        breaks = [st[var] for var in 'jkl'[:int(st['s'])-1]]
+        segment = len([rpa for rpa in breaks if st['RPA'] >= rpa])
+        if segment != self.cast_segment:
+            self.cast_segment = segment
+            st['VT'] = st['fghi'[segment]]
+            st['PT'] = st['t']
+            self.traj = 'MP'
+            self.G()
+        elif not self.status_word() & 4:
+            if st['a'] > 0:
+                # falls through to the stream loop
+                self.cast_segment = None
+                self.stream_due = self.clock.time()
+            else:
+                self.END()
         
     def write(self,txt):
+        self.tx_end = max(self.clock.time(),self.tx_end) + len(txt)*10.0/self.baudrate
+        if self.baudrate != self.motor_baud:
+            self.log.debug("baud mismatch - motor ignores %s"%repr(txt))
+            return
+        self.t_arrive = self.tx_end
+        try:
+            self.update_program()
+            self.handle_commands(txt)
+        finally:
+            self.t_arrive = None
+
+    def handle_commands(self,txt):
         for cmd in txt.split():
-            if '=' in cmd:
+            if cmd.startswith('BAUD'):
+                baud = int(cmd[4:])
+                if baud in self.bauds:
+                    self.motor_baud = baud
+            elif '=' in cmd:
                 key,val = cmd.split('=')
-                self.state[key] = float(val)
-            elif cmd.startswith('PRINT(UIA,#13)'):
-                self.buff += "100\r"
+                self.assign(key,float(val))
             else:
                 left_paren=cmd.find('(')
                 if left_paren>=0:
@@ -67,23 +267,26 @@ class FakeAnimatics(object):
                     args=[]
 
                 getattr(self,cmd)(*args)
+    def assign(self,key,val):
+        self.state[key] = val
     def close(self):
         pass
     def update_position(self):
         if self.traj_fn is not None:
-            self.traj_fn(time.time())        
+            self.traj_fn(self.clock.time())        
         
     def RSP(self):
-        self.buff += "%i/%s\r"%(self.srate,self.version)
+        self.respond("%i/%s\r"%(self.srate,self.version))
     def ECHO_OFF(self):
         pass
     def RPA(self):
         self.update_position()
-        self.buff+="%i\r"%self.state['RPA']
+        self.respond("%i\r"%self.state['RPA'])
     def REL(self):
-        self.buff+="%i\r"%self.state['REL']
+        self.respond("%i\r"%self.state['REL'])
     def RTRQ(self):
-        self.buff+="%i\r"%self.state['RTRQ']
+        self.update_position()
+        self.respond("%i\r"%self.state['RTRQ'])
     def X(self):
         self.traj = None
         self.traj_start = None
@@ -94,7 +297,7 @@ class FakeAnimatics(object):
         
     def G(self):
         start_pos = self.state['RPA']
-        start_time = time.time()
+        start_time = self.clock.time()
         VT = self.state['VT']
         
         if self.traj == 'MV':
@@ -112,6 +315,7 @@ class FakeAnimatics(object):
                 VT = -abs(VT)
             elif PT == start_pos:
                 self.log.debug("empty MP")
+                self.traj_fn = None
                 return
                 
             def MP_fn(t):
@@ -123,6 +327,9 @@ class FakeAnimatics(object):
                     self.state['RPA'] = PT
                     self.traj_fn = None
             self.traj_fn = MP_fn
+        elif self.traj == 'MT':
+            # torque mode - no trajectory
+            self.traj_fn = None
         else:
             print "NOT READY FOR ",self.traj
 
@@ -134,38 +341,114 @@ class FakeAnimatics(object):
         self.traj = 'MP'
     def ZS(self):
         pass
+    def RUN(self):
+        # see telemetry.RESIDENT_PROGRAM
+        if self.state['m'] == 1:
+            self.cast_segment = -1
+            self.stream_due = self.clock.time() if self.state['a'] > 0 else None
+            self.update_cast()
+        else:
+            self.stream_due = self.clock.time()
+    def END(self):
+        self.stream_due = None
+        self.cast_segment = None
     def RCLK(self):
-        self.buff+= "%d\r"%(1000*(time.time() - self.time_zero))
+        self.respond("%d\r"%(1000*(self.clock.time() - self.time_zero)))
     def RW(self,arg):
         arg=int(arg)
         if arg==0:
-            # Not real...
-            # bitmask - 16bits
-            self.buff+="127\r"
+            self.respond("%i\r"%self.status_word())
+    def status_word(self):
+        """ Not real... bitmask - 16bits.  Ready, with the trajectory
+        bit set while a move is in progress.
+        """
+        self.update_position()
+        if self.traj_fn is not None:
+            return 7
+        return 3
     def REA(self):
         """ report actual position error """
-        self.buff+="0\r"
+        self.respond("0\r")
     def PRINT(self,*args):
+        self.update_position()
         resp=[]
         for arg in args:
             if arg=='VA':
-                val="0" # velocity actual
+                val="%i"%self.state['RVA'] # velocity actual
             elif arg=='#13':
                 val="\r"
             elif arg=="PA":
-                val="0" # position actual
+                val="%i"%self.state['RPA'] # position actual
+            elif arg=="UIA":
+                val="%i"%self.state['UIA'] # current
+            elif arg=="TRQ":
+                val="%i"%self.state['RTRQ']
             else:
                 val="n/a"
                 self.log.warn("Don't know how to take %s"%arg)
             resp.append(val)
         resp="".join(resp)
-        self.buff+=resp
+        self.respond(resp)
+
+from async import async,OperationAborted,Executor
+
+class MotorRequest(object):
+    """ A command submitted to the winch I/O thread, which will be
+    completed once nresp responses have been read back.  Acts as a
+    future: result() blocks until the responses are in.
+    """
+    def __init__(self,out,nresp,fn=None):
+        self.out = out
+        self.nresp = nresp
+        # for requests which run fn() on the I/O thread instead of writing
+        self.fn = fn
+        self.responses = []
+        self.exc = None
+        self.callbacks = []
+        # guards callbacks against completion on the I/O thread
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.t_submit = time.time()
+        self.t_written = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self,timeout=None):
+        """ wait for the responses, returned as a list of strings
+        with the CR stripped.
+        """
+        if not self.event.wait(timeout):
+            raise Exception("Timed out waiting for response to %s"%repr(self.out))
+        if self.exc is not None:
+            raise self.exc
+        return self.responses
+
+    def add_done_callback(self,fn):
+        """ fn(request) is called from the I/O thread on completion,
+        or immediately if the request is already complete.
+        """
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self,exc=None):
+        with self.lock:
+            if self.event.is_set():
+                # timed out already - see AnimaticsWinch.io_watchdog()
+                return
+            self.exc = exc
+            self.event.set()
+            callbacks,self.callbacks = self.callbacks,[]
+        for fn in callbacks:
+            fn(self)
 
-from async import async,OperationAborted
-            
 class AnimaticsWinch(object):
     cmd_ver = '523' # or 'old'
     enc_count = 4000 # std. for 17 and 23 sized motors - counts per rev.
+    srate = 8000 # until it's read from the motor
     target_velocity = 0.4
 
     # measured with ruler and by circumference
@@ -205,6 +488,34 @@ class AnimaticsWinch(object):
     # bench testing:
     deploy_slack_current = 220
     deploy_slack_torque = 15000
+    # slack line while servoing out: torque above
+    # coeffs[0]*VA + coeffs[1], but at least torque_thresh_min
+    torque_thresh_coeffs = [2.84593843e-02, 1.06744338e+03]
+    torque_thresh_min = 500
+    # judge slack on the last slack_window status samples, requiring the
+    # mean torque over the threshold by slack_z standard errors.  A
+    # window of 1 tests each sample on its own.  See slack.py
+    slack_window = 1
+    slack_z = 2.0
+    # when free-wheeling out, switch to servo at this fraction of the
+    # target speed, or give up after max_pause seconds.  As tuned on the
+    # bench, the speed is VA over the VT for 1 m/s on a full spool,
+    # clipped to vt_max - see profiles.switch_va()
+    free_wheel_ratio = 0.25
+    max_pause = 2.0
+    # iterations per second of the complete_position_move loop.  A
+    # status query takes ~70ms at 9600 baud, so slower links will miss
+    # deadlines at this rate - see loop_stats.
+    control_rate = 20.0
+    # for the dead-reckoned estimates (see trajectory.py), in m/s**2:
+    # how far the drum may stray from the commanded trajectory, and
+    # how quickly it may change speed when free-wheeling.  The wire
+    # can't speed up faster than the package falls, so g bounds it.
+    # winch_sim free-wheeling from rest peaks at 4.1 m/s**2 over 10ms
+    # (5 kg wet pulling 8 kg of package and drum, 6.1 m/s**2 before
+    # friction and drag).
+    estimate_tracking_acc = 0.05
+    estimate_free_acc = 10.0
     
     # torque mode parameters:
     block_a_block_kg = 7.0
@@ -215,50 +526,84 @@ class AnimaticsWinch(object):
     ease_from_block_a_block = 0.83 # how far 'up' is from when the winch torques out
 
     max_wire_out=105.0 # [m]
+    # position moves hold the wire speed within half this fraction of
+    # the target as the drum radius changes.  See profiles.py
+    speed_tolerance=0.02
 
     motor=None
     
-    def __init__(self,port=None):
+    def __init__(self,port=None,clk=None):
         port=port or winch_settings.winch_com_port
         self.async_action = None
+        # time source for pacing and timeouts - see clock.py
+        self.clock = clk or clock.get_clock()
         
-        # The lock is acquired inside self.msg, to prevent simultaneous
-        # access to the winch.  It is also grabbed when updating the
-        # asynchronous job status.
-        self.lock = threading.Lock()
-        # the thread running an asynchronous action.  status-reading
-        # threads don't have to register here
-        self.thread = None
+        # Access to the serial port goes through the I/O thread, see
+        # io_loop().
+        # per-thread state for transaction()
+        self.tx_local = threading.local()
+        self.coalesce_writes = winch_settings.winch_coalesce_writes
+        # latency and throughput counters for the serial link
+        self.comm_stats = commstats.CommStats()
+        # timing of the complete_position_move loop
+        self.loop_stats = scheduler.LoopStats('position move loop')
+        # what the GUI reads - see get_current() etc.
+        self.cache = telemetry.TelemetryCache(self.cache_fields,self.refresh_cache,self.clock)
+        # runs actions called with block=False - see async.py
+        self.executor = Executor('winch')
 
         self.log = logging.getLogger('wnch')
 
-        self.init_motor(port)
+        # spool geometry fitted to past casts - see calibration.py
+        self.calibration = calibration.Calibration.load(winch_settings.calibration_file)
+        if self.calibration.fit is not None:
+            self.calibration.fit.apply(self)
+            self.log.info("Spool calibration: %s"%self.calibration.fit.describe())
 
-        # parameters to update during polling:
-        self.abort_async = False
+        self.init_motor(port)
 
     def init_motor(self,port):
-        if winch_settings.winch_is_real:
-            try:
-                self.motor = serial.Serial(port,
-                                           winch_settings.winch_baud,
-                                           timeout=1)
-            except OSError as exc:
-                self.log.critical("Failed to open serial port to winch")
-                sys.exit(1)
-        else:
-            self.motor = FakeAnimatics()
-            
+        def opener():
+            if winch_settings.winch_is_real:
+                try:
+                    return serial.Serial(port,
+                                         winch_settings.winch_baud,
+                                         timeout=1)
+                except OSError as exc:
+                    self.log.critical("Failed to open serial port to winch")
+                    sys.exit(1)
+            elif winch_settings.winch_sim:
+                import winch_sim
+                return winch_sim.SimulatedAnimatics(self.clock)
+            else:
+                return FakeAnimatics(self.clock)
+        # possibly recorded, or replayed - see transport.py
+        self.motor = transport.open_port('winch',opener,clk=self.clock)
+        self.start_io()
+
         # if SMI has run recently, motor might be in echo mode
         self.msg("ECHO_OFF ")
         # Query sample rate and version
         rsp=self.msg("RSP\r")
-        if len(rsp)==0 or rsp[0]=="":
+        fast=winch_settings.winch_baud_fast
+        if '/' not in rsp[0] and fast and fast != self.motor.baudrate:
+            # a run which died before close() leaves the motor at the
+            # fast rate
+            self.log.warning("No response at %d baud - trying %d"%(self.motor.baudrate,fast))
+            self.io_call(lambda: self.switch_port_baud(fast))
+            self.msg("ECHO_OFF ")
+            rsp=self.msg("RSP\r")
+        if '/' not in rsp[0]:
             self.log.critical("Failed to read sample rate and version - motor disconnected?")
             sys.exit(1)
+        self.rsp = rsp[0]
         srate,self.version = rsp[0].split('/')
 
         self.srate = int(srate)
+        counts_per_m=self.position_m_to_winch(1.0)
+        self.estimator = trajectory.TrajectoryEstimator(self.srate,
+                                                        self.estimate_tracking_acc*counts_per_m,
+                                                        self.estimate_free_acc*counts_per_m)
         # very simple - expand as needed
         if self.version == '5.0.3.61':
             self.cmd_ver = self.version
@@ -266,6 +611,11 @@ class AnimaticsWinch(object):
             self.cmd_ver = 'old'
         self.log.info("Sample rate: %s"%self.srate)
         self.log.info("Firmware version: %s"%self.version)
+        if winch_settings.winch_baud_fast:
+            self.set_baud(winch_settings.winch_baud_fast)
+        # run cast profiles with the resident program - see
+        # telemetry.RESIDENT_PROGRAM
+        self.resident_cast = winch_settings.winch_resident_cast and self.cmd_ver != 'old'
         if self.cmd_ver != 'old':
             # N.B. BRKTRJ doesn't release the
             # break during torque mode - this must be done
@@ -278,6 +628,8 @@ class AnimaticsWinch(object):
         self.log.info("Set error limit to %s"%REL)
         self.set_max_power_fraction(1.0)
         self.reset_encoder_position()
+        if winch_settings.winch_stream_period_ms:
+            self.start_stream(winch_settings.winch_stream_period_ms)
 
     def msg(self,out,verb=2,nresp=-1):
         """ send the commands in out to the motor.
@@ -290,6 +642,21 @@ class AnimaticsWinch(object):
         a space after them to indicate that no response will come
         back.  the responses will be returned as a list of strings
         with the CR stripped
+
+        this blocks until the responses are in, or response_timeout has
+        passed - see io_watchdog().  See submit() for the non-blocking
+        version.
+        """
+        return self.submit(out,verb=verb,nresp=nresp).result()
+
+    # a request still waiting on responses after this many seconds fails
+    response_timeout = 10.0
+
+    def submit(self,out,verb=2,nresp=-1):
+        """ queue the commands in out for the I/O thread, formatted
+        as for msg(), and return a MotorRequest without waiting.
+        Several callers can have requests in flight at once - responses
+        are matched up with requests in the order they were written.
         """
         out = out.replace("\n","\r")
         
@@ -300,35 +667,401 @@ class AnimaticsWinch(object):
             nresp = out.count("\r")
         if verb<3:
             self.log.debug("=>%s"%(repr(out)))
-        with self.lock:
-            self.motor.write(out)
-            responses = [self.my_readline() for n in range(nresp)]
-        return responses
-            
+        if self.io_thread is None:
+            raise Exception("Winch serial port is not open")
+
+        pending = getattr(self.tx_local,'pending',None)
+        if pending is not None:
+            if nresp == 0:
+                # hold it for the end of the transaction
+                pending.append(out)
+                req = MotorRequest(out,0)
+                req.set_result()
+                return req
+            # commands waiting on a response go out with everything
+            # queued ahead of them
+            out = "".join(pending) + out
+            del pending[:]
+        req = MotorRequest(out,nresp)
+        self.track(req)
+        if self.estimator is not None:
+            self.estimator.command(out,self.clock.time())
+        self.requests.put(req)
+        if self.io_thread is None and not req.done():
+            # the I/O thread went away while this was being queued
+            req.set_result(Exception("Winch serial port is not open"))
+        elif self.streaming:
+            # the I/O thread is likely blocked reading the stream
+            self.wake_io()
+        return req
+
+    # set to False to send every msg() on its own, even in a transaction.
+    # See winch_settings.winch_coalesce_writes
+    coalesce_writes = False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ within the block, commands from this thread which produce no
+        response are collected and sent as a single write when the block
+        exits.  A command which does expect a response flushes the
+        collected commands ahead of it, so order is kept.  Nested
+        transactions join the outer one.
+        """
+        if not self.coalesce_writes or getattr(self.tx_local,'pending',None) is not None:
+            yield
+            return
+        pending = self.tx_local.pending = []
+        try:
+            yield
+        finally:
+            self.tx_local.pending = None
+            if pending:
+                self.msg("".join(pending))
+
+    @contextlib.contextmanager
+    def outside_transaction(self):
+        """ within the block, commands go out on their own even inside a
+        transaction.  Anything the transaction has collected is sent
+        first, to keep the order.
+        """
+        pending = getattr(self.tx_local,'pending',None)
+        if pending is None:
+            yield
+            return
+        self.tx_local.pending = None
+        try:
+            if pending:
+                self.msg("".join(pending))
+                del pending[:]
+            yield
+        finally:
+            self.tx_local.pending = pending
+
+    ### I/O thread ###
+    io_thread = None
+    # follows commands and samples to dead-reckon the motor, once the
+    # sample rate is known
+    estimator = None
+    # True when the motor is pushing telemetry records
+    streaming = False
+    stream = None
+
+    def start_io(self):
+        self.requests = Queue.Queue()
+        # requests which haven't completed, for io_watchdog()
+        self.outstanding = set()
+        self.io_thread = threading.Thread(target=self.io_loop)
+        self.io_thread.setDaemon(1)
+        self.io_thread.start()
+        watchdog = threading.Thread(target=self.io_watchdog,args=(self.io_thread,))
+        watchdog.setDaemon(1)
+        watchdog.start()
+
+    def track(self,req):
+        self.outstanding.add(req)
+        req.add_done_callback(self.outstanding.discard)
+
+    def io_watchdog(self,io_thread):
+        """ fail requests which have waited more than response_timeout,
+        so that a stalled I/O thread can't hang msg().  This checks once a
+        second in its own thread - under python 2 a timed wait in msg()
+        polls, and would add latency to every response.
+        """
+        while self.io_thread is io_thread:
+            time.sleep(1.0)
+            now = time.time()
+            for req in list(self.outstanding):
+                if now - req.t_submit > self.response_timeout:
+                    self.log.error("No response to %s in %.0fs"%(repr(req.out),self.response_timeout))
+                    req.set_result(Exception("Timed out waiting for response to %s"%repr(req.out)))
+
+    def stop_io(self):
+        if self.io_thread is not None:
+            thread = self.io_thread
+            self.io_thread = None
+            self.requests.put(None)
+            thread.join(5.0)
+
+    def io_loop(self):
+        """ owns the serial port - writes queued requests as soon as
+        they are submitted, and hands each response line to the oldest
+        request still waiting on responses.
+        """
+        in_flight = collections.deque()
+        req = None
+        try:
+            while 1:
+                if not in_flight and not self.streaming:
+                    # idle - block until there is something to send
+                    req = self.requests.get()
+                    if req is None:
+                        break
+                    self.io_write(req,in_flight)
+                # pipeline anything else which has been submitted
+                while 1:
+                    try:
+                        req = self.requests.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if req is None:
+                        return
+                    self.io_write(req,in_flight)
+                if in_flight or self.streaming:
+                    line = self.my_readline()
+                    if line is None:
+                        # woken by submit() - write the new request
+                        continue
+                    if line.startswith(telemetry.STREAM_PREFIX):
+                        self.stream_record(line)
+                        continue
+                    if not in_flight:
+                        # read timeout while waiting on the stream
+                        continue
+                    req = in_flight[0]
+                    self.comm_stats.record_response(req,len(req.responses),time.time())
+                    req.responses.append(line)
+                    if len(req.responses) >= req.nresp:
+                        in_flight.popleft()
+                        req.set_result()
+        except Exception as exc:
+            self.log.error("winch I/O thread died: %s"%exc)
+            self.io_thread = None
+            if req is not None and not req.done() and req not in in_flight:
+                # died while writing it
+                in_flight.append(req)
+            self.fail_requests(in_flight,exc)
+
+    # set by wake_io(), so that my_readline() can tell a cancelled read
+    # from a timeout
+    io_woken = False
+    def wake_io(self):
+        """ end a blocking read on the I/O thread, so that a new request
+        is written now rather than after the next line or the read timeout.
+        Ports without cancel_read() (pyserial before 3.1) just wait.
+        """
+        cancel_read = getattr(self.motor,'cancel_read',None)
+        if cancel_read is not None:
+            self.io_woken = True
+            cancel_read()
+
+    def fail_requests(self,in_flight,exc):
+        """ once the I/O thread is gone, complete everything in flight or
+        still queued with exc, so that no caller waits forever
+        """
+        for req in in_flight:
+            req.set_result(exc)
+        while 1:
+            try:
+                req = self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            if req is not None:
+                req.set_result(exc)
+
+    ### Baud rate ###
+    def set_baud(self,baud):
+        """ switch the motor and the serial port to a new baud rate, and
+        verify with RSP.  On failure, go back to the previous rate.
+        Returns True if the new rate is in effect.
+        """
+        old_baud = self.motor.baudrate
+        if baud == old_baud:
+            return True
+        self.log.info("Switching winch serial from %d to %d baud"%(old_baud,baud))
+        self.msg("BAUD%d "%baud)
+        self.io_call(lambda: self.switch_port_baud(baud))
+        if self.msg("RSP\r")[0] == self.rsp:
+            return True
+        self.log.warning("No response at %d baud - reverting to %d"%(baud,old_baud))
+        self.io_call(lambda: self.switch_port_baud(old_baud))
+        if self.msg("RSP\r")[0] != self.rsp:
+            # the motor may have switched after all - tell it to come back
+            self.io_call(lambda: self.switch_port_baud(baud))
+            self.msg("BAUD%d "%old_baud)
+            self.io_call(lambda: self.switch_port_baud(old_baud))
+            if self.msg("RSP\r")[0] != self.rsp:
+                self.log.error("Lost contact with motor while changing baud rate")
+        return False
+
+    def switch_port_baud(self,baud):
+        """ on the I/O thread: let pending output drain, then reopen the
+        port at the new rate with empty input buffers.
+        """
+        self.motor.flush()
+        # give the motor time to act on a BAUD command
+        self.clock.sleep(0.05)
+        self.motor.baudrate = baud
+        self.motor.flushInput()
+        self.rx_buff = ""
+
+    ### Telemetry stream ###
+    def start_stream(self,period_ms):
+        """ start the resident program (see telemetry.RESIDENT_PROGRAM)
+        as the telemetry stream, printing a status record every period_ms.
+        Falls back to polling if no records show up.
+        """
+        if self.cmd_ver == 'old':
+            self.log.info("Telemetry stream not supported by firmware - polling")
+            return False
+        if self.stream is None:
+            self.stream = telemetry.TelemetryRing()
+        seq = self.stream.seq
+        self.streaming = True
+        self.msg("m=0 a=%d RUN "%period_ms)
+        seq,rec = self.stream.wait_newer(seq,timeout=1.0+2*period_ms/1000.0)
+        if rec is None:
+            self.log.warning("No telemetry stream from motor - polling")
+            self.stop_stream()
+            return False
+        self.log.info("Telemetry stream running every %dms"%period_ms)
+        return True
+
+    def end_program(self):
+        """ stop the cast sequencer, or whatever the resident program is
+        doing, and restart the telemetry stream if it is in use
+        """
+        if self.streaming:
+            self.msg("END m=0 RUN ")
+        else:
+            self.msg("END ")
+
+    def stop_stream(self):
+        self.streaming = False
+        self.msg("END ")
+
+    def stream_record(self,line):
+        """ called on the I/O thread for each telemetry record
+        """
+        try:
+            vals = telemetry.parse_stream_record(line)
+        except ValueError as exc:
+            self.log.warning(str(exc))
+            return
+        if self.stream is not None:
+            self.stream.append(self.clock.time(),vals)
+        if self.estimator is not None:
+            rec = dict(zip(telemetry.STREAM_FIELDS,vals))
+            self.estimator.observe(self.clock.time(),rec['rpa'],
+                                   self.estimator.from_va(rec['va']))
+
+    def stream_sample(self,age=0.0):
+        """ the latest telemetry record if the stream is running and the
+        record is no older than age seconds, otherwise None.
+        """
+        if not self.streaming:
+            return None
+        rec = self.stream.latest()
+        if rec is None or self.clock.time() - rec['t'] > age:
+            return None
+        return rec
+
+    def read_sample(self,names,seq=0):
+        """ read the motor variables in names (see telemetry.VARIABLES)
+        for a blocking operation.  If the telemetry stream is running and
+        has them all, this waits for a record newer than sequence number
+        seq, otherwise queries the motor.
+        returns (seq,dict of name: value)
+        """
+        if not names:
+            return seq,{}
+        if self.streaming and set(names) <= set(telemetry.STREAM_FIELDS):
+            seq,rec = self.stream.wait_newer(seq,timeout=1.0)
+            if rec is not None:
+                return seq,dict( (name,int(rec[name])) for name in names )
+            self.log.warning("Telemetry stream stalled - querying")
+        return seq,self.query(*names)._asdict()
+
+    def io_call(self,fn):
+        """ run fn() on the I/O thread, in order with submitted commands,
+        and wait for it to complete.
+        """
+        req = MotorRequest(None,0,fn=fn)
+        self.track(req)
+        self.requests.put(req)
+        return req.result()
+
+    def io_write(self,req,in_flight):
+        if req.fn is not None:
+            try:
+                req.fn()
+            except Exception as exc:
+                req.set_result(exc)
+            else:
+                req.set_result()
+            return
+        t_write = time.time()
+        self.motor.write(req.out)
+        req.t_written = time.time()
+        self.comm_stats.record_write(req,t_write,req.t_written)
+        if req.nresp > 0:
+            in_flight.append(req)
+        else:
+            req.set_result()
+
+    # bytes which have been read from the motor but not yet returned
+    # as part of a response
+    rx_buff = ""
+
     def my_readline(self):
         """ some versions of pyserial don't allow specifying
         a non-NL end of line, but going with the full io.IOBase
-        stuff introduces an extra layer, and also forces us to 
+        stuff introduces an extra layer, and also forces us to
         use buffering everywhere.
-        
-        this reads one character at a time until CR is seen,
-        then returns the stripped string
+
+        this pulls whatever the port has waiting in one read,
+        splits off the first CR (or NL) terminated line, and keeps
+        any leftover bytes for the next response.  A read timeout
+        returns whatever partial line has accumulated.  A read cancelled
+        by wake_io() returns None, and keeps the partial line.
         """
-        eol = ["","\r","\n"]
-        chars = []
         while 1:
-            char = self.motor.read()
-            if char in eol:
-                return "".join(chars)
-            chars.append(char)
-            
+            eol = self.rx_buff.find("\r")
+            nl = self.rx_buff.find("\n")
+            if nl>=0 and (eol<0 or nl<eol):
+                eol = nl
+            if eol>=0:
+                line = self.rx_buff[:eol]
+                self.rx_buff = self.rx_buff[eol+1:]
+                return line
+            chunk = self.read_chunk()
+            if chunk == "" and self.io_woken:
+                self.io_woken = False
+                return None
+            if chunk == "":
+                # timeout
+                line = self.rx_buff
+                self.rx_buff = ""
+                return line
+            self.rx_buff += chunk
+
+    def read_chunk(self):
+        """ read everything the port has waiting, or block for a single
+        byte (up to the port timeout) if nothing is waiting.
+        ports without in_waiting (pyserial before 3.0) are read one byte
+        at a time.
+        """
+        try:
+            n = self.motor.in_waiting
+        except AttributeError:
+            chunk = self.motor.read()
+        else:
+            chunk = self.motor.read(max(1,n))
+        self.comm_stats.record_read(len(chunk))
+        return chunk
+
     def __del__(self):
         """ attempt to automatically close port
         """
-        if self.motor:
-            self.motor.close()
-            self.motor = None
+        self.close()
     def close(self):
+        self.executor.shutdown()
+        if self.streaming and self.io_thread is not None:
+            self.stop_stream()
+        if self.motor and self.io_thread is not None and \
+           self.motor.baudrate != winch_settings.winch_baud:
+            # leave the motor at the default rate for SMI, next startup
+            self.set_baud(winch_settings.winch_baud)
+        self.stop_io()
         if self.motor:
             self.motor.close()
             self.motor=None
@@ -348,103 +1081,79 @@ class AnimaticsWinch(object):
         # not be a running operation
         self.stop_motor()
         # and in handle_abort, to clean up after the running operation
-        # exits
-        with self.lock:
-            # if self.thread is not None:
-            # problem here: if the winch is called synchronously, but
-            # from a thread in ctd, then self.thread is None but we still
-            # need to abort asynchronously.
-            # maybe async_action is better, since it records whether we're in
-            # any sort of action.
-            # problem will be that abort async may get set when nobody is
-            # around to listen for it, and it will cancel some future action.
-            if self.async_action is not None:
-                # in some cases, even though this exception is meant for
-                # the winch, it may propagate out to a ctd method, where
-                # we need to make sure it has cleanup=False to avoid ctd
-                # scheduling cleanup actions.
-                self.abort_async = OperationAborted(cleanup=False)
-
+        # exits.  This reaches winch actions called synchronously from
+        # a ctd thread, too.  Even though this exception is meant for
+        # the winch, it may propagate out to a ctd method, where we
+        # need to make sure it has cleanup=False to avoid ctd
+        # scheduling cleanup actions.
+        dropped=self.executor.cancel_all(OperationAborted(cleanup=False))
+        if dropped:
+            self.log.info("abort(): dropped %d queued actions"%dropped)
+
+    # whether the encoder was last zeroed by ctd_in_reset(), so that
+    # block-a-block is a known distance inside of the zero
+    zero_from_reset=False
     def reset_encoder_position(self):
         self.msg("O=0 ")
+        self.zero_from_reset=False
+
+    def record_calibration(self,kind,m,counts=None):
+        """ add an observation of the true wire out m at counts, or the
+        current position, to the calibration dataset and refit.  kind is
+        'mark', or 'reset' for the expected wire out at a block-a-block,
+        which is only checked against the fit - see calibration.py
+        """
+        if counts is None:
+            counts=self.read_encoder_position()
+        self.calibration.add(kind,self.position_winch_to_revs(counts),m)
+        fit=self.calibration.refit(self)
+        if fit is not None:
+            fit.apply(self)
+        for line in self.calibration.report():
+            self.log.info("Calibration: %s"%line)
         
     ### Unit Conversions ###
+    # the conversions go through a spool.SpoolModel, rebuilt whenever
+    # one of its attributes here changes, e.g. from the GUI
+    _spool=None
+    @property
+    def spool(self):
+        key=tuple(getattr(self,attr) for attr in spool.SpoolModel.winch_attrs)
+        if self._spool is None or self._spool.key()!=key:
+            self._spool=spool.SpoolModel(*key)
+        return self._spool
+
     def force_kg_to_winch(self,kg):
         # okay - kg not a force, but who knows the weight of
         # their rig in Newtons??
-    
-        # torque of 35 balances a 5lb weight
-        if self.cmd_ver=='old':
-            return kg*2.2 * 35./5.
-        else:
-            # new winch has different range for torque
-            return kg*2.2 * 2000./5.
+        return self.spool.kg_to_trq(kg)
     def force_winch_to_kg(self,nondim):
-        return nondim / self.force_kg_to_winch(1.0)
+        return self.spool.trq_to_kg(nondim)
     
     def velocity_mps_to_winch(self,vel_meters_per_second,clip=True,posn_m=0.0):
         """ take a wire speed in m/s to a winch non-dimensional
-        velocity setting.  Assumes full spool.
+        velocity setting.
 
-        posn_m: evaluate velocity at the given amount of wire out.  This is NOT 
-         implemented!
+        posn_m: evaluate velocity at the given amount of wire out, i.e.
+         at the drum radius there.  Defaults to a full spool.
         """
         # the numbers below are from the animatics users guide (5.23, page 22)
         # VT = velocity * ((counts per rev) / (sample rate)) * 65536
         # velocity above is in revolutions per second
         # counts per rev is 4000, sample rate is 8000, so the
         # multiplier is 32768.
-        if posn_m!=0.0:
-            raise Exception("Not implemented!")
-        
-        circumference = self.spool_radius_outer * 2 * math.pi
-        rps = vel_meters_per_second / circumference
-        # The 2 is totally empirical.
-        vel= 2 * rps * float(self.enc_count) / self.srate * 65536.0 * self.gear_box_ratio
-        if clip:
-            if vel>self.vt_max:
-                vel=self.vt_max
-            elif vel<-self.vt_max:
-                vel=-self.vt_max
-        return vel
+        return self.spool.mps_to_vt(vel_meters_per_second,clip=clip,
+                                    counts=self.position_m_to_winch(posn_m))
 
     def velocity_winch_to_mps(self,vel_winch,posn_m=0.0):
-        return float(vel_winch)/self.velocity_mps_to_winch(1.0,posn_m=posn_m)
+        return self.spool.vt_to_mps(vel_winch,counts=self.position_m_to_winch(posn_m))
 
     def position_winch_to_m(self,nondim):
-        # old way:
-        # return nondim/float(self.enc_count) / self.gear_box_ratio \
-        #    * self.spool_radius * 2 *math.pi
-        # new way:
-        # get drum revolutions from nondim position:
-        revs=self.position_winch_to_revs(nondim)
-        m=2*math.pi*revs*self.spool_radius_outer - 2*math.pi*revs**2/2*self.wire_area/self.spool_width
-        return m
+        return self.spool.counts_to_m(nondim)
     def position_winch_to_revs(self,nondim):
-        return nondim/float(self.enc_count) / self.gear_box_ratio
-
+        return self.spool.counts_to_revs(nondim)
     def position_m_to_winch(self,m):
-        # old way:
-        # return m/self.position_winch_to_m(1.0)
-
-        # new way - account for how much line is on the drum
-        # quadratic
-        # + 2*math.pi*revs**2/2*self.wire_area/self.spool_width
-        # - 2*math.pi*revs*self.spool_radius_full
-        # + m
-        # = 0
-
-        a=math.pi*self.wire_area/self.spool_width
-        b=-2*math.pi*self.spool_radius_outer
-        c=m
-
-        # choose the smaller of the roots - the larger root is a greater number of
-        # revolutions, corresponding to so much wire out that the radius becomes negative
-        # and revolutions out begin to add wire.
-        revs=(-b- math.sqrt(b**2-4*a*c)) / (2*a)
-        nondim=revs*self.gear_box_ratio*float(self.enc_count)
-        return nondim
-
+        return self.spool.m_to_counts(m)
         
     accel = 200
     ### synchronous/fast helper functions ###
@@ -456,12 +1165,12 @@ class AnimaticsWinch(object):
         self.msg("ZS MV ADT=%i VT=%i G "%(self.accel,vel) )
 
     def release_brake(self):
-        if self.cmd_ver != 'old':
-            self.msg("BRKRLS ")
+        for cmd in positionmove.release_brake_cmds(self.cmd_ver):
+            self.msg(cmd)
 
     def enable_brake(self):
-        if self.cmd_ver != 'old':
-            self.msg("BRKTRJ ")
+        for cmd in positionmove.enable_brake_cmds(self.cmd_ver):
+            self.msg(cmd)
 
     def start_force_move(self,kg):
         """ NB: must release brake first! """
@@ -470,17 +1179,12 @@ class AnimaticsWinch(object):
         # also MT acts immediately.
         # Stop, and get confirmation that it's done:
         # no idea why these commands are touchy, but 
-        self.motor_stop()
         T = int(self.force_kg_to_winch(kg))
         self.log.info("Will run force mode with torque of %s"%T)
-        if self.cmd_ver =='old':
-            self.msg('MT ')
-            self.msg("TS=65536 ")
-            self.msg("T=%i "%T)
-        else:
-            self.msg('ZS MT ')
-            self.msg("T=%i "%T)
-            self.msg("TS=250000 G ")
+        with self.transaction():
+            self.motor_stop()
+            for cmd in positionmove.force_cmds(self.cmd_ver,T):
+                self.msg(cmd)
         self.log.debug("Done initiating force move")
         
     def start_position_move(self, absol_m=None,rel_m=None,velocity=None,direc=0,accel=None,
@@ -520,9 +1224,10 @@ class AnimaticsWinch(object):
 
     def stop_motor(self):
         self.log.info("Stopping motor")
-        self.msg("X ")
-        # And set the mode back to something sane.
-        self.msg("ZS MV ADT=800 VT=0 G ")
+        # X on its own, even when called from a transaction
+        with self.outside_transaction():
+            for cmd in positionmove.stop_cmds():
+                self.msg(cmd)
         
     def motor_stop(self):
         self.stop_motor()
@@ -530,65 +1235,102 @@ class AnimaticsWinch(object):
         self.stop_motor()
 
     # state variables which should be cached and when it's not necessary
-    # to have precise data:
-    # current
-    # torque
-    # velocity
-    # cable_out
-    cache_current=(0,0)
-    cache_torque=(0,0)
-    cache_velocity=(0,0)
-    cache_cable_out=(0,0)
+    # to have precise data.  A stale read of any of them refreshes them
+    # all with refresh_cache() - see telemetry.TelemetryCache
+    cache_fields=('current','torque','velocity','cable_out')
 
     def set_current(self,val):
-        self.cache_current=(val,time.time())
+        self.cache.set('current',val)
     def set_velocity(self,val):
-        self.cache_velocity=(val,time.time())
+        self.cache.set('velocity',val)
     def set_torque(self,val):
-        self.cache_torque=(val,time.time())
+        self.cache.set('torque',val)
     def set_cable_out(self,val):
         if len(val)!=2:
             raise Exception("set_cable_out() should get a tuple!")
-        self.cache_cable_out=(val,time.time())
+        self.cache.set('cable_out',val)
+
+    def refresh_cache(self,age):
+        """ read all of cache_fields in one round trip.  With the
+        telemetry stream running, a record no older than age is used
+        instead of querying the motor.
+        """
+        rec=self.stream_sample(age)
+        if rec is None:
+            rec=self.query('uia','va','rtrq','rpa')._asdict()
+            rec['trq']=rec.pop('rtrq')
+        self.read_motor_current(uia=rec['uia'])
+        self.read_motor_torque(rtrq=rec['trq'])
+        self.read_motor_velocity(va=rec['va'],pa=rec['rpa'])
+        self.read_cable_out(rpa=rec['rpa'])
 
     def get_current(self,age=0.0):
-        t=time.time()
-        if t-self.cache_current[1] > age:
-            self.read_motor_current()
-        return self.cache_current[0]
-    def get_velocity(self,age=0.0):
-        t=time.time()
-        if t-self.cache_velocity[1] > age:
-            self.read_motor_velocity()
-        return self.cache_velocity[0]
+        return self.cache.get('current',age)
+    # with accuracy given, a dead-reckoned estimate is used if its error
+    # bound is within accuracy (m or m/s) - see estimate()
+    def get_velocity(self,age=0.0,accuracy=None):
+        if accuracy is not None:
+            cable_out,speed,cable_out_err,speed_err=self.estimate()
+            if speed_err<=accuracy:
+                return speed
+        return self.cache.get('velocity',age)
     def get_torque(self,age=0.0):
-        t=time.time()
-        if t-self.cache_torque[1] > age:
-            self.read_motor_torque()
-        return self.cache_torque[0]
-    def get_cable_out(self,age=0.0,extra=False):
-        t=time.time()
-        if t-self.cache_cable_out[1] > age:
-            self.read_cable_out()
+        return self.cache.get('torque',age)
+    def get_cable_out(self,age=0.0,extra=False,accuracy=None):
+        if accuracy is not None:
+            pos,vel,pos_err,vel_err=self.estimator.estimate(self.clock.time())
+            if pos_err*self.position_winch_to_m(1.0)<=accuracy:
+                if extra:
+                    return self.position_winch_to_m(pos),self.position_winch_to_revs(pos)
+                else:
+                    return self.position_winch_to_m(pos)
+        val=self.cache.get('cable_out',age)
         if extra:
-            return self.cache_cable_out[0]
+            return val
         else:
-            return self.cache_cable_out[0][0]
+            return val[0]
+
+    def estimate(self):
+        """ cable out and cable speed now, dead-reckoned from the last
+        sample along the commanded trajectory, without talking to the
+        motor.  Returns (cable_out,speed,cable_out_err,speed_err) in m and
+        m/s, with bounds on the errors.  Speed is as read_motor_velocity().
+        """
+        pos,vel,pos_err,vel_err=self.estimator.estimate(self.clock.time())
+        m_per_count=self.position_winch_to_m(1.0)
+        # counts/s to VA units
+        va_per_cps=65536.0/self.srate
+        return (self.position_winch_to_m(pos),
+                self.spool.vt_to_mps(vel*va_per_cps,counts=pos),
+                pos_err*m_per_count,
+                self.spool.vt_to_mps(vel_err*va_per_cps,counts=pos))
+
+    def query(self,*names,**kw):
+        """ read a set of motor variables in a single round trip,
+        e.g. query('sw0','va','rpa').  See telemetry.VARIABLES for the
+        names.  Returns a namedtuple with fields in the order given.
+        """
+        verb = kw.pop('verb',5)
+        q = telemetry.compile_query(names,self.cmd_ver)
+        rec = q.parse(self.msg(q.cmd,verb=verb,nresp=q.nresp))
+        if self.estimator is not None:
+            pos = getattr(rec,'rpa',getattr(rec,'pa',None))
+            if pos is not None:
+                va = getattr(rec,'va',None)
+                self.estimator.observe(self.clock.time(),pos,
+                                       None if va is None else self.estimator.from_va(va))
+        return rec
 
     def read_encoder_position(self,verb=5):
-        if self.cmd_ver =='old':
-            line, = self.msg("RP\r",verb=verb) 
-        else:
-            line, = self.msg("RPA\r",verb=verb)
         try:
-            return float(line)
-        except ValueError:
-            self.log.warn("Failed to parse encoder position '%s'"%line)
+            return float(self.query('rpa',verb=verb).rpa)
+        except ValueError as exc:
+            self.log.warn("Failed to parse encoder position: %s"%exc)
             return None
 
     def read_motor_current(self,uia=None,verb=5):
         if uia is None:
-            uia, = self.msg("PRINT(UIA,#13)\r",verb=verb)
+            uia = self.query('uia',verb=verb).uia
         curr = float(uia)
         self.log.debug("current=%f"%curr)
         self.set_current(curr)
@@ -596,43 +1338,43 @@ class AnimaticsWinch(object):
 
     def read_motor_torque(self,rtrq=None,verb=5):
         if rtrq is None:
-            rtrq, = self.msg("RTRQ\r",verb=verb)
+            rtrq = self.query('rtrq',verb=verb).rtrq
         trq = float(rtrq)
         self.log.debug("torque=%f"%trq)
         self.set_torque(trq)
         return trq
 
-    def read_motor_velocity(self,dt=1.0,full_spool=True,verb=5):
+    def read_motor_velocity(self,dt=1.0,full_spool=False,verb=5,va=None,pa=None):
+        """ cable speed in m/s, at the drum radius for the position pa.
+        With va but no pa, the position is the dead-reckoned one.
+        full_spool: pretend the spool is full, as this used to.
+        """
         if 1: # try builtin measurement:
-            VA,counts0=[float(s) for s in self.msg("PRINT(VA,#13,PA,#13)\r",nresp=2,verb=verb)]
+            if va is None:
+                VA,counts0=[float(s) for s in self.query('va','pa',verb=verb)]
+            else:
+                VA=float(va)
+                if pa is not None:
+                    counts0=float(pa)
+                elif self.estimator is not None:
+                    counts0=self.estimator.estimate(self.clock.time())[0]
+                else:
+                    counts0=0
             if full_spool:
-                # pretend this is the velocity for when the spool is full
                 counts0=0
 
-            # that will be in encoder counts per PID sample * 65536
-            # pid sample rate
-            counts1=counts0 + (VA*self.srate/65536)
-
-            posn0=self.position_winch_to_m(counts0)
-            posn1=self.position_winch_to_m(counts1)
-            # Not sure where the 0.5 is coming from - but at least this gets it to
-            # match the commanded velocity.
-            vel=0.5*(posn1 - posn0)
-            return vel
+            # VA is encoder counts per PID sample * 65536, which the
+            # spool model takes to wire speed at the radius for counts0
+            vel=self.spool.vt_to_mps(VA,counts=counts0)
         else:
             posns = []
             clks = []
-            if self.cmd_ver=='old':
-                cmd="RP\rRCLK\r"
-            else:
-                cmd="RPA\rRCLK\r"
-
             for it in range(2):            
-                pos,clk_ms = [float(s) for s in self.msg(cmd,verb=verb)]
+                pos,clk_ms = [float(s) for s in self.query('rpa','clk',verb=verb)]
                 posns.append(self.position_winch_to_m(pos))
                 clks.append(clk_ms/1000.0)
                 if it ==0:
-                    time.sleep(dt)
+                    self.clock.sleep(dt)
 
             # not sure why the factor of 4 is needed, but it is.
             vel=4*(posns[1] - posns[0])/(clks[1] - clks[0])
@@ -641,7 +1383,7 @@ class AnimaticsWinch(object):
 
     def status_report(self,sw0=None):
         if sw0 is None:
-            sw0 = int(self.msg("RW(0)\r")[0])
+            sw0 = self.query('sw0').sw0
         self.log.info("--- Status ---")
         for i,name in enumerate(['ready','motor_off','trajectory',
                                  'bus_volt_fault','peak_overcurrent',
@@ -685,40 +1427,73 @@ class AnimaticsWinch(object):
     ### Polling ###
     def poll(self,rpa=None,uia=None):
         """ long-running operations should arrange to call this frequently,
-        it updates status information from the motor, and checks self.abort_async
-        to see whether the current operation should be aborted.
+        it updates status information from the motor, and checks whether
+        the current operation has been aborted - see async.py
 
         Note that on abort, the motor will be stopped.
 
         A bit kludgey, but the caller can supply recently read strings
         for monitored values to avoid double querying.
         """
-        if self.abort_async:
-            self.abort_async = False # show that it's been received.
-            self.log.info("poll(): raising exception")
-            if isinstance(self.abort_async,Exception):
-                exc = self.abort_async
-            else:
-                exc = OperationAborted(cleanup=False)
-            raise exc
+        self.executor.check()
 
     def handle_abort(self):
         self.log.info("handle_abort: stopping motor on abort")
         self.motor_stop()
         
     ### Blocking or asynchronous, higher-level operations ###
+    # what the position move loop reads each iteration
+    status_names=('sw0','va','uia','trq','rpa')
+
+    def samples(self,names,rate=None,stats=None):
+        """ the polling loop shared by blocking operations - for each
+        iteration, at rate per second (default control_rate), checks for
+        abort and reads names with one query or stream record.  Yields
+        (scheduler.FixedRate,dict of name: value), so that the caller
+        can see if it's running late.  Break out of the loop to stop.
+        """
+        # a steady rate, so that detection latency doesn't depend on
+        # how fast the motor answers
+        sched=scheduler.FixedRate(rate or self.control_rate,self.clock,stats)
+        seq=self.stream.seq if self.streaming else 0
+        while 1:
+            sched.tick()
+            self.poll() # check for abort
+            seq,sample=self.read_sample(names,seq)
+            yield sched,sample
+
+    def wait_for(self,*conds,**kw):
+        """ block until any of conds, from conditions.py, is met, and
+        return it.  All of the conditions are checked against a single
+        read of the motor each iteration.
+        rate: iterations per second, default control_rate
+        """
+        rate=kw.pop('rate',None)
+        if kw:
+            raise TypeError("Unexpected arguments to wait_for: %s"%", ".join(kw))
+        names=set()
+        for cond in conds:
+            names.update(cond.names)
+        # in the same order as compiled queries, to reuse them
+        names=[name for name in telemetry.VARIABLES if name in names]
+        t_start=self.clock.time()
+        for sched,sample in self.samples(names,rate=rate):
+            elapsed=self.clock.time()-t_start
+            for cond in conds:
+                if cond.met(self,sample,elapsed):
+                    self.log.debug("wait_for: %r after %.2fs"%(cond,elapsed))
+                    return cond
     @async('move to position')
     def complete_position_move(self, 
                                absol_m=None,rel_m=None,
                                velocity=None,direc=0,
                                accel=None,decel=None,
-                               monitor_slack=True,max_pause=2.0):
+                               monitor_slack=True,max_pause=None):
         """ absol_m: the target, ending cable out in meter
         rel_m: or targert cable out relative to current position
-        velocity: a speed in m/s. N.B. this is calculated based on the 
-           full spool radius.
-           This can also be a function which takes the cable out in m and returns a velocity
-           in m/s.
+        velocity: a wire speed in m/s, held across the changing drum radius.
+           This can also be a profiles.SpeedProfile, or a function which takes the
+           cable out in m and returns a velocity in m/s.
 
         direc: +1 only move if target is farther out, -1 only move if target is closer in.
                 0 move regardless
@@ -728,21 +1503,15 @@ class AnimaticsWinch(object):
          is always tension in the line.  This is accomplished by 
          free-wheeling at the beginning, and whenever the drive torque and current
          suggest that the motor is overhauling the line, revert to freewheel mode.
-        max_pause: when free-wheeling, if it doesn't free-wheel up to half the speed
-         in this time, then give up.
+        max_pause: when free-wheeling, if it doesn't free-wheel up to 
+         free_wheel_ratio of the speed in this time, then give up.
+         Defaults to self.max_pause.
         """
         self.log.debug("top of complete_position_move")
         self.poll()
         velocity = velocity or self.target_velocity
-
-        if not callable(velocity):
-            vel_func=lambda x: velocity
-        else:
-            vel_func=velocity
-
-        # have to wrap it, so that stop_cond() can modify.
-        vbox=[vel_func]
-        cmd_vel=[vbox[0](self.read_cable_out())]
+        if max_pause is None:
+            max_pause = self.max_pause
 
         #####
 
@@ -769,6 +1538,10 @@ class AnimaticsWinch(object):
             else:
                 direc=-1
         self.log.info("Commanded to move to cable length %s"%absol_m)
+        # the cast sequencer only has room for so many segments - see
+        # telemetry.RESIDENT_PROGRAM
+        max_pieces=telemetry.CAST_SEGMENTS if self.resident_cast else None
+        profile=self.compile_profile(velocity,span=(pos,absol_m),max_pieces=max_pieces)
         accel=accel or 100
         decel=decel or 100
 
@@ -779,90 +1552,73 @@ class AnimaticsWinch(object):
             # only worry about slack when reeling out
             monitor_slack=False
             
-        def do_servo(target_velocity=None):
-            target_velocity=target_velocity or vbox[0](self.read_cable_out())
-            cmd_vel[0] = target_velocity
-            vel=self.velocity_mps_to_winch(cmd_vel[0])
-            cmd = "MP AT=%d DT=%d VT=%i PT=%i G "%(accel,decel,vel,target_position)
+        # with the cast sequencer, the motor switches speeds at the
+        # breakpoints itself, and the PC just watches for slack and the
+        # end of the move
+        on_motor=(self.resident_cast and isinstance(profile,profiles.CompiledProfile)
+                  and len(profile.vts)<=telemetry.CAST_SEGMENTS)
+        if self.resident_cast and not on_motor:
+            self.log.warning("Speed profile doesn't fit the cast sequencer - driving the move from the PC")
+        elif on_motor and profile.speed_error > self.speed_tolerance/2:
+            self.log.info("Cast sequencer holds wire speed within %.1f%% in %d segments"%(100*profile.speed_error,
+                                                                                        len(profile.vts)))
+        # a status record from the telemetry stream, or the sequencer,
+        # can lag the command starting the move
+        move=positionmove.PositionMove(self,profile,target_position,direc,
+                                       free=monitor_slack,max_pause=max_pause,
+                                       status_lag=on_motor or self.streaming,
+                                       update_vt=not on_motor)
+
+        def do_servo(vt):
+            move.servo_sent(vt)
+            if on_motor:
+                # when polling, a=0 keeps the program from printing
+                # telemetry records
+                cmd="END AT=%d DT=%d %s%sm=1 RUN "%(accel,decel,
+                                                    telemetry.cast_variables(profile,target_position),
+                                                    "" if self.streaming else "a=0 ")
+            else:
+                cmd = positionmove.servo_cmd(accel,decel,vt,target_position)
             self.msg(cmd)
         
         try:
             if monitor_slack:
-                mode='free'
-                self.release_brake()
-                self.start_force_move(0.0)
+                with self.transaction():
+                    self.release_brake()
+                    self.start_force_move(0.0)
                 self.log.info('Start free velocity move')
             else:
-                mode='servo'
-                do_servo()
+                do_servo(profile.vt(self.read_encoder_position()))
                 
-            # track how long it's been idle:
-            t_start=t_idle=time.time()
-
-            while 1:
-                self.poll() # check for abort
-
-                # read the current status:
-                status=self.msg("RW(0)\rPRINT(VA,#13,UIA,#13,TRQ,#13)\rRPA\r",verb=5,nresp=5)
-                sw0,va,uia,rtrq,rpa=[int(s) for s in status]
-                in_trajectory=sw0&4
-
-                # update the target velocity based on the new position
-                cable_out=self.read_cable_out(rpa=rpa)
-                target_velocity=vbox[0](cable_out)
-
-                if mode=='free':
-                    # e.g. direc=1, going out, stop if rpa is greater than target_position
-                    if direc*(rpa-target_position)>=0:
-                        self.log.info("Free-wheeled to target_position.")
-                        break
-
-                    # has it free-wheeled up to speed?
-                    if rtrq!=0.0:
-                        self.log.info('Wait for true free-wheel')
-                        continue
-                    curr_vel=self.velocity_winch_to_mps(va)
-                    if curr_vel>0.25*target_velocity:
-                        self.log.info('Free-wheeled up to %.2f, switch to servo'%curr_vel)
-                        mode='servo'
-                        do_servo(target_velocity=target_velocity)
-                        continue
-                    elif time.time() - t_idle > max_pause:
-                        self.log.info('Idle too long.')
-                        break
-                    else:
-                        self.log.info("Free-wheeling at %f [%d], compared to %.2f"%(curr_vel,va,target_velocity))
-                elif mode=='servo':
-                    if not in_trajectory:
-                        elapsed=time.time() - t_start
-                        self.log.info("position move - end on no trajectory flag after %fs"%(elapsed))
-                        # to diagnose the stops, grab status words:
-                        # clean this up
-                        if sw0 not in (3073,3075,1,3): # this is status ready, motor off, limits enabled/disabled
-                            self.log.info("SW(0) is ",repr(sw0))
-                            self.status_report(sw0=sw0)
-                        break
-
-                    thresh=self.torque_thresh(spd_winch=va)
-                    # if it's working to go this fast, then revert to free-wheel
-                    # to avoid overhauling the line.
-                    if uia>self.slack_current_threshold and rtrq>thresh:
-                        self.log.info('Line appears slack')
-                        mode='free'
-                        self.msg('MT T=0 G ')
-                        t_idle=time.time()
-                        continue
-                    elif target_velocity != cmd_vel[0]:
-                        # update the commanded velocity
-                        do_servo(target_velocity=target_velocity)
-                    else:
-                        self.log.debug("VA: %7d  UIA: %7d [%d]  TRQ: %7d [%d]"%(va,uia,
-                                                                                self.slack_current_threshold,
-                                                                                rtrq,thresh))
+            for sched,st in self.samples(self.status_names,stats=self.loop_stats):
+                sw0,va,uia,rtrq,rpa=[st[name] for name in self.status_names]
+                if not sched.late():
+                    # keep the cable out display current
+                    self.read_cable_out(rpa=rpa)
+
+                action=move.update(sw0,va,uia,rtrq,rpa,late=sched.late())
+                if action==positionmove.SERVO:
+                    do_servo(move.vt)
+                elif action==positionmove.FREE:
+                    with self.transaction():
+                        if on_motor:
+                            self.end_program()
+                        self.msg(positionmove.FREE_WHEEL_CMD)
+                elif action==positionmove.END:
+                    # to diagnose the stops, grab status words:
+                    # clean this up
+                    if move.end_reason=='trajectory' and sw0 not in (3073,3075,1,3): # this is status ready, motor off, limits enabled/disabled
+                        self.log.info("SW(0) is %r"%sw0)
+                        self.status_report(sw0=sw0)
+                    break
+            self.log.info("Position move loop: %s"%sched.describe())
 
         finally:
-            self.stop()
-            self.enable_brake()
+            with self.transaction():
+                if on_motor:
+                    self.end_program()
+                self.stop()
+                self.enable_brake()
                                        
 
         #######
@@ -964,26 +1720,34 @@ class AnimaticsWinch(object):
         #  while not stop_cond():
         #      self.poll()
 
+    def compile_profile(self,velocity,span=None,max_pieces=None):
+        """ velocity as for complete_position_move, as an object with
+        vt(rpa) and speed(rpa) - see profiles.py.  span: (from_m,to_m) of
+        the move.  max_pieces: as for SpeedProfile.compile()
+        """
+        if isinstance(velocity,profiles.SpeedProfile):
+            return velocity.compile(self,span=span,max_pieces=max_pieces)
+        if callable(velocity):
+            return profiles.FunctionProfile(velocity,self)
+        return profiles.SpeedProfile.constant(velocity).compile(self,span=span,max_pieces=max_pieces)
+
     def torque_thresh(self,spd_winch):
-        wire_out_coeffs=[  2.84593843e-02,   1.06744338e+03]
-        calc=wire_out_coeffs[0]*spd_winch + wire_out_coeffs[1]
-        return max(500,calc)
+        return slack.torque_thresh(spd_winch,self.torque_thresh_coeffs,self.torque_thresh_min)
 
     @async('ctd out')
     def ctd_out(self, max_depth):
         self.log.debug("ctd_out start")
-        def vfunc(cable_out):
-            if cable_out<self.arm_length+self.cage_length:
-                return 0.3*self.target_velocity
-            else:
-                return self.target_velocity
+        # slow until the CTD is clear of the cage
+        vprof=profiles.SpeedProfile([(0.0,0.3*self.target_velocity),
+                                     (self.arm_length+self.cage_length,self.target_velocity)])
         self.complete_position_move(absol_m=max_depth+self.arm_length+self.cage_length,
                                     block=True,
                                     direc=1,accel=80,
                                     monitor_slack=True,
-                                    velocity=vfunc)
+                                    velocity=vprof)
     # pull winch back in, until we're back at the original position.
-    @async('ctd in')
+    # a recovery goes ahead of anything else waiting
+    @async('ctd in',priority=-1)
     def ctd_in(self):
         if 0: # old way, with separate moves
             self.complete_position_move(absol_m=self.arm_length+self.cage_length,block=True,direc=-1)
@@ -995,15 +1759,13 @@ class AnimaticsWinch(object):
             self.complete_position_move(absol_m=0.0,velocity=0.4*self.target_velocity,block=True,
                                         direc=-1)
         else:
-            def vfunc(cable_out):
-                if cable_out>self.arm_length+self.cage_length:
-                    return self.target_velocity
-                elif cable_out>self.arm_length:
-                    return 0.2*self.target_velocity
-                else:
-                    return 0.4*self.target_velocity
+            # very slow as CTD meets cage, then a bit faster to bring
+            # it in to resting position
+            vprof=profiles.SpeedProfile([(0.0,0.4*self.target_velocity),
+                                         (self.arm_length,0.2*self.target_velocity),
+                                         (self.arm_length+self.cage_length,self.target_velocity)])
             self.complete_position_move(absol_m=0.0,
-                                        velocity=vfunc,
+                                        velocity=vprof,
                                         block=True,
                                         accel=80,
                                         decel=80,
@@ -1019,24 +1781,28 @@ class AnimaticsWinch(object):
             self.ctd_in_reset(block=True)
 
     reset_strategy = 'force' # 'current'
-    @async('ctd in reset')
+    @async('ctd in reset',priority=-1)
     def ctd_in_reset(self):
         if self.reset_strategy == 'current':
             self.ctd_in_by_current(block=True)
         elif self.reset_strategy=='force':
             self.ctd_in_by_force(block=True)
         self.reset_encoder_position()
+        self.zero_from_reset=True
 
     @async('ctd in by force')
     def ctd_in_by_force(self):
-        self.release_brake()
-        self.start_force_move(-self.block_a_block_kg)
-        time.sleep(1.0) # new motor is slower to ramp up
-        while self.read_motor_velocity() < -0.005:
-            self.poll()
+        with self.transaction():
+            self.release_brake()
+            self.start_force_move(-self.block_a_block_kg)
+        self.clock.sleep(1.0) # new motor is slower to ramp up
+        self.wait_for(conditions.Velocity(above=-0.005))
         self.log.info("in_by_force: found stall")
-        self.motor_stop()
-        self.enable_brake()
+        if self.zero_from_reset:
+            self.record_calibration('reset',-self.ease_from_block_a_block)
+        with self.transaction():
+            self.motor_stop()
+            self.enable_brake()
         self.log.info("stopped motor")
         # relieves tension to reduce power by servoing in place
         self.complete_position_move(rel_m=self.ease_from_block_a_block,block=True)
@@ -1055,10 +1821,9 @@ class AnimaticsWinch(object):
                        motor_current, self.stressed_current_threshold))
         self.start_velocity_move(-self.target_velocity * 0.5)
         
-        while motor_current < self.stressed_current_threshold:
-            time.sleep(0.2)
-            motor_current = self.read_motor_current()
+        if motor_current < self.stressed_current_threshold:
+            self.wait_for(conditions.Current(above=self.stressed_current_threshold),rate=5.0)
             self.log.info('cable out %5.1f, enc = %6.0f, current = %4.1f, max = %4.1f' %\
                           (self.read_cable_out(), self.read_encoder_position(),
-                           motor_current, self.stressed_current_threshold))
+                           self.get_current(age=1.0), self.stressed_current_threshold))
         self.stop_motor()
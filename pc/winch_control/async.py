@@ -1,4 +1,26 @@
+"""
+async
+
+Actions which take a while - a cast, a move, a GPIO-triggered loop -
+are methods decorated with @async(label).  Called with block=True they
+run in the caller's thread.  With block=False they go on the queue of
+the object's Executor, a single long-lived worker thread per device,
+and the call returns a Future right away.  callback=fn is called with
+the return value when a queued action finishes without error.
+
+Queued actions run one at a time, lowest priority value first, then
+in the order they were queued.  Each running action, queued or
+blocking, has a CancelToken.  Executor.cancel_all() cancels the running
+actions and drops everything queued, and the action finds out the next
+time it calls obj.poll(), which raises the OperationAborted it was
+cancelled with.  Tokens go away with their action, so a cancel can't
+leak into whatever runs next.
+"""
 import threading
+import heapq
+import itertools
+import contextlib
+import logging
 
 class OperationAborted(Exception):
     def __init__(self,cleanup=True):
@@ -10,10 +32,197 @@ class OperationAborted(Exception):
         self.cleanup = cleanup
         print "init OperationAborted with cleanup=%s"%self.cleanup
 
-# attempting python decorator to synchronize winch access
-# simplify writing asynchronous methods, and centralize
-# abort handling
-def async(label):
+
+class CancelToken(object):
+    def __init__(self):
+        self.exc = None
+
+    def cancel(self,exc):
+        # the first cancel wins
+        if self.exc is None:
+            self.exc = exc
+
+    def cancelled(self):
+        return self.exc is not None
+
+    def check(self):
+        if self.exc is not None:
+            raise self.exc
+
+
+class Future(object):
+    """ the outcome of a queued action
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = False
+        self.value = None
+        self.exc = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def set_result(self,value):
+        self.finish(value,None)
+    def set_exception(self,exc):
+        self.finish(None,exc)
+
+    def finish(self,value,exc):
+        with self.cond:
+            self.value = value
+            self.exc = exc
+            self.finished = True
+            callbacks,self.callbacks = self.callbacks,[]
+            self.cond.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.getLogger('exec').exception("callback failed")
+
+    def add_done_callback(self,fn):
+        """ fn(future) once the action finishes, in the thread which
+        finished it, or now if it already has
+        """
+        with self.cond:
+            if not self.finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def wait(self,timeout=None):
+        with self.cond:
+            if not self.finished:
+                self.cond.wait(timeout)
+            return self.finished
+
+    def exception(self,timeout=None):
+        if not self.wait(timeout):
+            raise Exception("Timed out waiting for action")
+        return self.exc
+
+    def result(self,timeout=None):
+        exc = self.exception(timeout)
+        if exc is not None:
+            raise exc
+        return self.value
+
+
+class Executor(object):
+    """ one worker thread running queued actions for a device
+    """
+    def __init__(self,name):
+        self.name = name
+        self.log = logging.getLogger('exec')
+        self.cond = threading.Condition()
+        # heap of (priority,sequence,label,fn,token,future)
+        self.queue = []
+        self.seq = itertools.count()
+        # tokens of everything running, queued or blocking
+        self.active = set()
+        # per-thread stack of tokens for check()
+        self.local = threading.local()
+        self.running = True
+        self.thread = threading.Thread(target=self.worker,name=name)
+        self.thread.setDaemon(1) # don't hold up process exit
+        self.thread.start()
+
+    def submit(self,label,fn,priority=0):
+        """ queue fn() to run on the worker.  Returns a Future.
+        """
+        future = Future()
+        with self.cond:
+            if not self.running:
+                raise Exception("%s executor is shut down"%self.name)
+            if self.active or self.queue:
+                self.log.info("%s: queueing %s behind %d"%(self.name,label,
+                                                          len(self.active)+len(self.queue)))
+            heapq.heappush(self.queue,(priority,next(self.seq),label,fn,CancelToken(),future))
+            self.cond.notify()
+        return future
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                priority,seq,label,fn,token,future = heapq.heappop(self.queue)
+                # active before the lock is released, so that a
+                # cancel_all() can't miss it between queue and action
+                self.active.add(token)
+            with self.action(token):
+                try:
+                    # cancelled after leaving the queue
+                    token.check()
+                    val = fn()
+                except Exception as exc:
+                    if not isinstance(exc,OperationAborted):
+                        self.log.exception("%s: %s failed"%(self.name,label))
+                    future.set_exception(exc)
+                else:
+                    future.set_result(val)
+
+    @contextlib.contextmanager
+    def action(self,token=None):
+        """ register token, or a new one, as an action running in this
+        thread, so that cancel_all() reaches it and check() sees it.
+        token may already be active, as when the worker pops it.
+        """
+        token = token or CancelToken()
+        if not hasattr(self.local,'tokens'):
+            self.local.tokens = []
+        self.local.tokens.append(token)
+        with self.cond:
+            self.active.add(token)
+        try:
+            yield token
+        finally:
+            self.local.tokens.pop()
+            with self.cond:
+                self.active.discard(token)
+
+    def check(self):
+        """ raise the exception an action running in this thread was
+        cancelled with, if any
+        """
+        for token in getattr(self.local,'tokens',[]):
+            token.check()
+
+    def busy(self):
+        with self.cond:
+            return bool(self.active or self.queue)
+
+    def cancel_all(self,exc):
+        """ cancel the running actions with exc, and drop the queue.
+        Returns the number of queued actions dropped.
+        """
+        with self.cond:
+            dropped,self.queue = self.queue,[]
+            for token in self.active:
+                token.cancel(exc)
+        for priority,seq,label,fn,token,future in dropped:
+            future.set_exception(exc)
+        return len(dropped)
+
+    def shutdown(self):
+        """ stop the worker once the running action, if any, is done.
+        Anything queued is dropped.
+        """
+        with self.cond:
+            self.running = False
+            dropped,self.queue = self.queue,[]
+            self.cond.notify_all()
+        for priority,seq,label,fn,token,future in dropped:
+            future.set_exception(Exception("%s executor shut down"%self.name))
+
+
+# simplify writing asynchronous methods, and centralize abort handling.
+# obj needs executor, an Executor, and async_action, the label of what
+# it's doing.
+def async(label,priority=0):
     def async_with_label(f):
         def wrapper(*args,**kw):
             obj = args[0]
@@ -21,47 +230,39 @@ def async(label):
             block = kw.pop('block')
 
             if block:
-                try:
-                    # calling this async_action is now a misnomer,
-                    # but by recording the top level synchronous action,
-                    # too, there's more information to convey.
-                    if obj.async_action is None:
-                        obj.async_action = label
-                        clear_action = True
-                    else:
-                        clear_action = False
-                    return f(*args,**kw)
-                finally:
-                    #print "on the way out of ",label
-                    if clear_action:
-                        obj.async_action = None
+                with obj.executor.action():
+                    try:
+                        # calling this async_action is now a misnomer,
+                        # but by recording the top level synchronous action,
+                        # too, there's more information to convey.
+                        if obj.async_action is None:
+                            obj.async_action = label
+                            clear_action = True
+                        else:
+                            clear_action = False
+                        return f(*args,**kw)
+                    finally:
+                        if clear_action:
+                            obj.async_action = None
 
             callback = kw.pop('callback',None)
 
             def target():
+                obj.async_action = label
                 try:
-                    obj.async_action = label
-                    try:
-                        val = f(*args,**kw)
-                        if callback is not None:
-                            callback(val)
-                        return val
-                    except OperationAborted:
-                        obj.handle_abort()
+                    return f(*args,**kw)
+                except OperationAborted:
+                    obj.handle_abort()
+                    raise
                 finally:
-                    # print "async thread exiting"
-                    with obj.lock:
-                        obj.thread = None
-                        # clear any abort signal
-                        obj.abort_async=False
-                        obj.async_action = None
-
-            with obj.lock:
-                if obj.thread is not None:
-                    print "Process already running!"
-                    return False
-                obj.thread = threading.Thread(target=target)
-                obj.thread.setDaemon(1) # don't hold up process exit??
-                obj.thread.start()
+                    obj.async_action = None
+
+            future = obj.executor.submit(label,target,priority)
+            if callback is not None:
+                def done(fut):
+                    if fut.exception() is None:
+                        callback(fut.result())
+                future.add_done_callback(done)
+            return future
         return wrapper
     return async_with_label
@@ -0,0 +1,112 @@
+"""
+Measure responses per second through AnimaticsWinch.msg(), comparing
+the old byte-at-a-time readline against the buffered reader, and
+blocking msg() calls against requests pipelined through submit(), and
+the time to engage free-wheel with and without coalesced writes.
+
+usage: python bench_serial.py [location]
+  location is passed on to winch_settings, e.g. 'lab' for a real
+  winch, 'thistle' for FakeAnimatics.
+"""
+import time
+import winch_settings
+import aniwinch
+
+class CountingPort(object):
+    """ wrap a serial port to count how many read() calls are made
+    """
+    def __init__(self,port):
+        self.port = port
+        self.reads = 0
+    def __getattr__(self,attr):
+        return getattr(self.port,attr)
+    def read(self,*args):
+        self.reads += 1
+        return self.port.read(*args)
+
+def legacy_readline(winch):
+    # the original reader - one read() per character
+    eol = ["","\r","\n"]
+    chars = []
+    while 1:
+        char = winch.motor.read()
+        if char in eol:
+            return "".join(chars)
+        chars.append(char)
+
+# the five response status query from complete_position_move
+status_cmd = "RW(0)\rPRINT(VA,#13,UIA,#13,TRQ,#13)\rRPA\r"
+
+def run(winch,label,count=200):
+    port = CountingPort(winch.motor)
+    winch.motor = port
+    try:
+        t = time.time()
+        for i in range(count):
+            winch.msg(status_cmd,verb=5,nresp=5)
+        elapsed = time.time() - t
+    finally:
+        winch.motor = port.port
+    nresp = 5*count
+    print "%-10s %8.1f responses/s  %6.2f reads/response"%(label,
+                                                           nresp/elapsed,
+                                                           port.reads/float(nresp))
+
+def run_pipelined(winch,label,count=200,depth=4):
+    """ keep up to depth status queries in flight at once
+    """
+    t = time.time()
+    pending = []
+    for i in range(count):
+        pending.append(winch.submit(status_cmd,verb=5,nresp=5))
+        if len(pending) >= depth:
+            pending.pop(0).result()
+    for req in pending:
+        req.result()
+    elapsed = time.time() - t
+    print "%-10s %8.1f responses/s"%(label,5*count/elapsed)
+
+class WriteCountingPort(CountingPort):
+    def __init__(self,port):
+        CountingPort.__init__(self,port)
+        self.writes = 0
+    def write(self,txt):
+        self.writes += 1
+        return self.port.write(txt)
+
+def run_freewheel(winch,label,count=50):
+    """ time the release-brake/free-wheel sequence which starts a
+    slack-monitored move, followed by a status query so that the time
+    includes the motor receiving every command.
+    """
+    port = WriteCountingPort(winch.motor)
+    winch.motor = port
+    try:
+        t = time.time()
+        for i in range(count):
+            with winch.transaction():
+                winch.release_brake()
+                winch.start_force_move(0.0)
+            winch.query('sw0')
+        elapsed = time.time() - t
+    finally:
+        winch.motor = port.port
+    print "%-10s %8.2f ms/engage  %6.2f writes/engage"%(label,
+                                                       1000*elapsed/count,
+                                                       port.writes/float(count))
+
+if __name__ == '__main__':
+    winch = aniwinch.AnimaticsWinch()
+    try:
+        buffered = winch.my_readline
+        winch.my_readline = lambda: legacy_readline(winch)
+        run(winch,'before')
+        winch.my_readline = buffered
+        run(winch,'after')
+        run_pipelined(winch,'pipelined')
+        winch.coalesce_writes = False
+        run_freewheel(winch,'separate')
+        winch.coalesce_writes = True
+        run_freewheel(winch,'coalesced')
+    finally:
+        winch.close()
@@ -0,0 +1,234 @@
+"""
+calibration
+
+Fits the spool geometry to observations of how much wire was truly
+out at a given drum position, so that cable out stays right as the
+wind changes - see NOTES, 410.6 revolutions to pay out the line on a
+loose wind and 423 to bring it back on a tight one.
+
+An observation is drum revolutions from the zero, the true wire out in
+m, and the kind:
+  mark: a measured mark on the line was at the block
+  reset: ctd_in_by_force found block-a-block, which should be
+    ease_from_block_a_block inside of a zero set by the last reset
+Observations are appended to a text file as they come in, so the
+dataset builds up over casts rather than bench sessions.
+
+Only marks are fit.  A reset isn't a measurement - the zero it comes
+back to was set by easing out a distance the model converted to
+counts, so fitting it would only pull the fit back to the old
+geometry.  Resets are kept as a consistency check: their residuals
+show the zero drifting, or the model going wrong near the block.
+
+Wire out is 2 pi R revs - pi dr_drev revs**2 (see spool.py), which is
+linear in the outer radius R and the radius lost per revolution
+dr_drev, so the fit is one weighted least squares solve over the whole
+dataset.  The fit is saved next to the dataset, and AnimaticsWinch
+loads it at startup.
+
+usage: python calibration.py dataset.txt
+  refit and print the fit and residuals
+usage: python calibration.py dataset.txt mark <revs> <m>
+  add an observation, then refit
+"""
+import os
+import sys
+import time
+import numpy as np
+
+import spool
+
+def fit_geometry(revs,m,weights=None,dr_drev=None):
+    """ least squares outer radius and radius lost per revolution for
+    wire out m at revs.  With dr_drev given, only the radius is fit.
+    Returns (radius,dr_drev), or None if the data can't pin them down.
+    """
+    revs = np.asarray(revs,np.float64)
+    m = np.asarray(m,np.float64)
+    if weights is None:
+        weights = np.ones(len(revs))
+    sw = np.sqrt(np.asarray(weights,np.float64))
+    if dr_drev is None:
+        cols = np.array([2*np.pi*revs,-np.pi*revs**2]).T
+        y = m
+    else:
+        cols = (2*np.pi*revs)[:,None]
+        y = m + np.pi*dr_drev*revs**2
+    coeffs,_,rank,_ = np.linalg.lstsq(cols*sw[:,None],y*sw,rcond=None)
+    if rank < cols.shape[1]:
+        return None
+    if dr_drev is None:
+        return coeffs[0],coeffs[1]
+    return coeffs[0],dr_drev
+
+
+class Fit(object):
+    """ outer radius and radius lost per revolution from a fit, with the
+    number of observations and rms residual in m
+    """
+    def __init__(self,spool_radius_outer,dr_drev,n=0,rms=0.0):
+        self.spool_radius_outer = spool_radius_outer
+        self.dr_drev = dr_drev
+        self.n = n
+        self.rms = rms
+
+    def winch_values(self,winch):
+        """ AnimaticsWinch attributes for the fit, keeping its spool
+        width and revolutions for the whole line
+        """
+        return dict(spool_radius_outer=self.spool_radius_outer,
+                    wire_area=self.dr_drev*winch.spool_width,
+                    spool_radius_inner=(self.spool_radius_outer
+                                        - self.dr_drev*winch.spool_revolutions_full))
+
+    def apply(self,winch):
+        for attr,val in self.winch_values(winch).items():
+            setattr(winch,attr,val)
+
+    def describe(self):
+        return "outer radius %.5f m, %.3e m/rev, %d observations, rms %.3f m"%(
+            self.spool_radius_outer,self.dr_drev,self.n,self.rms)
+
+    def save(self,path):
+        with open(path,'wt') as fp:
+            fp.write("# %s\n"%self.describe())
+            for attr in ('spool_radius_outer','dr_drev','n','rms'):
+                fp.write("%s %r\n"%(attr,getattr(self,attr)))
+
+    @classmethod
+    def load(cls,path):
+        vals = {}
+        with open(path,'rt') as fp:
+            for line in fp:
+                if line.startswith('#') or not line.strip():
+                    continue
+                attr,val = line.split()
+                vals[attr] = float(val)
+        vals['n'] = int(vals.get('n',0))
+        return cls(**vals)
+
+
+class Calibration(object):
+    # weight of each kind of observation in the fit.  Kinds with no
+    # weight are recorded and reported, but not fit.
+    weights = dict(mark=1.0,reset=0.0)
+    # fewer fitted observations than this only fit the radius
+    min_observations = 3
+
+    def __init__(self,path=None):
+        """ path: the dataset, or None to keep observations in memory
+        only.  The fit goes to the same name with .fit
+        """
+        self.path = path
+        self.times = []
+        self.kinds = []
+        self.revs = []
+        self.m = []
+        self.fit = None
+
+    @classmethod
+    def load(cls,path):
+        """ the dataset and fit at path, either of which may not exist yet
+        """
+        cal = cls(path)
+        if path is not None and os.path.exists(path):
+            with open(path,'rt') as fp:
+                for line in fp:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    t,kind,revs,m = line.split()
+                    cal.times.append(float(t))
+                    cal.kinds.append(kind)
+                    cal.revs.append(float(revs))
+                    cal.m.append(float(m))
+        if path is not None and os.path.exists(cal.fit_path()):
+            cal.fit = Fit.load(cal.fit_path())
+        return cal
+
+    def fit_path(self):
+        return os.path.splitext(self.path)[0] + '.fit'
+
+    def add(self,kind,revs,m,t=None):
+        if kind not in self.weights:
+            raise Exception("Unknown calibration observation %s"%kind)
+        t = time.time() if t is None else t
+        self.times.append(t)
+        self.kinds.append(kind)
+        self.revs.append(float(revs))
+        self.m.append(float(m))
+        if self.path is not None:
+            new = not os.path.exists(self.path)
+            with open(self.path,'at') as fp:
+                if new:
+                    fp.write("# unix time, kind, revolutions, true wire out [m]\n")
+                fp.write("%.1f %s %.4f %.3f\n"%(t,kind,revs,m))
+
+    def arrays(self):
+        """ (revs,m,weights) for all observations
+        """
+        w = np.array([self.weights[kind] for kind in self.kinds])
+        return np.array(self.revs),np.array(self.m),w
+
+    def refit(self,winch):
+        """ fit the whole dataset, starting from the geometry of winch.
+        Saves and returns the fit, or None if there aren't observations
+        enough, or it comes out unphysical.
+        """
+        revs,m,w = self.arrays()
+        fitted = w>0
+        if not fitted.any():
+            return None
+        revs,m,w = revs[fitted],m[fitted],w[fitted]
+        current = spool.SpoolModel.for_winch(winch)
+        coeffs = None
+        if len(revs) >= self.min_observations:
+            coeffs = fit_geometry(revs,m,w)
+            # the radius has to be positive with all of the line out
+            if coeffs is not None and not (coeffs[1] > 0 and
+                                           coeffs[0] - coeffs[1]*winch.spool_revolutions_full > 0):
+                coeffs = None
+        if coeffs is None:
+            coeffs = fit_geometry(revs,m,w,dr_drev=current.dr_drev)
+        if coeffs is None or coeffs[0] <= 0:
+            return None
+        fit = Fit(coeffs[0],coeffs[1],n=len(revs))
+        fit.rms = np.sqrt(np.mean(self.residuals(fit)[fitted]**2))
+        self.fit = fit
+        if self.path is not None:
+            fit.save(self.fit_path())
+        return fit
+
+    def residuals(self,fit=None):
+        """ true minus modeled wire out of each observation, m
+        """
+        fit = fit or self.fit
+        revs,m,w = self.arrays()
+        model = 2*np.pi*fit.spool_radius_outer*revs - np.pi*fit.dr_drev*revs**2
+        return m - model
+
+    def report(self):
+        """ lines describing the fit and the residuals by kind
+        """
+        if self.fit is None:
+            return ["no fit, %d observations"%len(self.revs)]
+        lines = [self.fit.describe()]
+        resid = self.residuals()
+        kinds = np.array(self.kinds)
+        for kind in sorted(set(self.kinds)):
+            sel = resid[kinds==kind]
+            lines.append("  %-6s %3d  mean %+.3f m  max %.3f m"%(kind,len(sel),sel.mean(),
+                                                              np.abs(sel).max()))
+        return lines
+
+
+if __name__ == '__main__':
+    import aniwinch
+    cal = Calibration.load(sys.argv[1])
+    if len(sys.argv) > 2:
+        cal.add(sys.argv[2],float(sys.argv[3]),float(sys.argv[4]))
+    winch = aniwinch.AnimaticsWinch
+    if cal.refit(winch) is not None:
+        revs,m,w = cal.arrays()
+        for kind,r,true,res in zip(cal.kinds,revs,m,cal.residuals()):
+            print "%-6s %8.2f rev  %7.2f m  %+.3f"%(kind,r,true,res)
+    print "\n".join(cal.report())
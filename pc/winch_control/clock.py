@@ -0,0 +1,80 @@
+"""
+clock
+
+Time source for the winch control stack.  Everything which paces
+itself or measures elapsed time for control purposes goes through a
+clock object, so that simulations can run on a simulated clock which
+skips ahead instead of sleeping.
+
+Timeouts which guard against hardware or threads that have stalled
+(e.g. waiting on a serial response), and timing measurements of the
+code itself, stay on real time.
+
+A clock has:
+  time(): seconds
+  sleep(dt): pass dt seconds
+  wait(dt): pass dt seconds while waiting on other threads.  In real
+    time this is the same as sleep, but a simulated clock lets the
+    threads doing the work move the clock forward.
+"""
+import time
+import threading
+
+class RealClock(object):
+    def time(self):
+        return time.time()
+    def sleep(self,dt):
+        time.sleep(dt)
+    def wait(self,dt):
+        time.sleep(dt)
+
+
+class SimClock(object):
+    """ simulated time - sleep() advances the clock immediately.
+    wait() blocks until other threads have advanced the clock far enough,
+    unless nothing has advanced it for stall (real) seconds, in which
+    case it advances the clock itself.
+    """
+    stall = 0.01
+
+    def __init__(self,t0=0.0):
+        self.t = t0
+        self.cond = threading.Condition()
+
+    def time(self):
+        return self.t
+
+    def sleep(self,dt):
+        if dt <= 0:
+            return
+        with self.cond:
+            self.t += dt
+            self.cond.notify_all()
+
+    def wait(self,dt):
+        with self.cond:
+            target = self.t + dt
+            last_t = self.t
+            deadline = time.time() + self.stall
+            while self.t < target:
+                if self.t != last_t:
+                    # someone else is moving the clock along
+                    last_t = self.t
+                    deadline = time.time() + self.stall
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.t = target
+                    self.cond.notify_all()
+                    break
+                self.cond.wait(remaining)
+
+
+# the clock used by objects which aren't given one explicitly
+default_clock = RealClock()
+
+def get_clock():
+    return default_clock
+
+def set_clock(clock):
+    global default_clock
+    default_clock = clock
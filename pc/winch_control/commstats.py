@@ -0,0 +1,166 @@
+"""
+commstats
+
+Low-overhead instrumentation for the winch serial link: per-command
+latency histograms and byte counters, updated by the winch I/O thread.
+
+Commands are grouped by template - the command string with numeric
+arguments replaced by '#', so 'MP AT=80 DT=80 VT=9837 PT=1200 G '
+and 'MP AT=100 DT=100 VT=1 PT=0 G ' are counted together.
+"""
+import bisect
+import re
+import time
+import logging
+
+# numbers which are arguments, but not the #13 in PRINT(...)
+number_re = re.compile(r'(?<![#\w])-?\d+')
+
+def command_template(out):
+    return number_re.sub('#',out)
+
+
+class Histogram(object):
+    """ fixed-bucket histogram of durations, in seconds
+    """
+    # upper edges of the buckets, in ms.  the last bucket is everything
+    # above the last edge
+    edges_ms = [0.1,0.2,0.5,1,2,5,10,20,50,100,200,500,1000,2000,5000]
+    edges = [e/1000.0 for e in edges_ms]
+
+    def __init__(self):
+        self.counts = [0]*(len(self.edges)+1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self,dt):
+        self.counts[bisect.bisect_left(self.edges,dt)] += 1
+        self.n += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def mean(self):
+        if self.n == 0:
+            return 0.0
+        return self.total / self.n
+
+    def quantile(self,q):
+        """ upper edge of the bucket holding the q quantile, in seconds
+        """
+        target = q*self.n
+        accum = 0
+        for i,count in enumerate(self.counts):
+            accum += count
+            if count and accum >= target:
+                if i < len(self.edges):
+                    return self.edges[i]
+                return self.max
+        return 0.0
+
+    def describe(self):
+        return "n=%d mean=%.1fms p50<=%.1fms p90<=%.1fms max=%.1fms"%(self.n,
+                                                                     1000*self.mean(),
+                                                                     1000*self.quantile(0.5),
+                                                                     1000*self.quantile(0.9),
+                                                                     1000*self.max)
+
+
+class CommandStats(object):
+    """ histograms for one command template:
+      wait: from submit() until the I/O thread starts writing
+      write: duration of the write
+      resp: list, time from end of write to each response
+    """
+    def __init__(self):
+        self.wait = Histogram()
+        self.write = Histogram()
+        self.resp = []
+
+    def response_hist(self,idx):
+        while len(self.resp) <= idx:
+            self.resp.append(Histogram())
+        return self.resp[idx]
+
+
+class CommStats(object):
+    # minimum interval over which throughput() is computed
+    window = 2.0
+
+    def __init__(self):
+        self.log = logging.getLogger('comm')
+        self.reset()
+
+    def reset(self):
+        self.commands = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.n_requests = 0
+        self.t_start = time.time()
+        self.mark = (self.t_start,0,0)
+        self.rates = (0.0,0.0)
+
+    def command(self,req):
+        """ the CommandStats for a request, cached on the request
+        """
+        try:
+            return req.stats
+        except AttributeError:
+            tmpl = command_template(req.out)
+            try:
+                stats = self.commands[tmpl]
+            except KeyError:
+                stats = self.commands[tmpl] = CommandStats()
+            req.stats = stats
+            return stats
+
+    def record_write(self,req,t_write,t_written):
+        stats = self.command(req)
+        stats.wait.add(t_write - req.t_submit)
+        stats.write.add(t_written - t_write)
+        self.bytes_out += len(req.out)
+        self.n_requests += 1
+
+    def record_response(self,req,idx,t):
+        self.command(req).response_hist(idx).add(t - req.t_written)
+
+    def record_read(self,nbytes):
+        self.bytes_in += nbytes
+
+    def throughput(self):
+        """ (bytes/s in, bytes/s out), averaged over at least window seconds
+        """
+        t = time.time()
+        t0,in0,out0 = self.mark
+        if t - t0 >= self.window:
+            self.rates = ((self.bytes_in-in0)/(t-t0),
+                          (self.bytes_out-out0)/(t-t0))
+            self.mark = (t,self.bytes_in,self.bytes_out)
+        return self.rates
+
+    def summary(self):
+        """ one-line summary for the GUI
+        """
+        rate_in,rate_out = self.throughput()
+        return "%.0f B/s in, %.0f B/s out, %d msgs"%(rate_in,rate_out,self.n_requests)
+
+    def report(self):
+        """ list of lines describing everything recorded so far
+        """
+        elapsed = max(time.time() - self.t_start,1e-6)
+        lines = ["%d requests, %d bytes out, %d bytes in over %.1fs (%.0f/%.0f B/s)"%(
+                 self.n_requests,self.bytes_out,self.bytes_in,elapsed,
+                 self.bytes_out/elapsed,self.bytes_in/elapsed)]
+        for tmpl in sorted(self.commands.keys()):
+            stats = self.commands[tmpl]
+            lines.append(repr(tmpl))
+            lines.append("   wait:  %s"%stats.wait.describe())
+            lines.append("   write: %s"%stats.write.describe())
+            for i,hist in enumerate(stats.resp):
+                lines.append("   resp%d: %s"%(i,hist.describe()))
+        return lines
+
+    def dump(self):
+        for line in self.report():
+            self.log.info(line)
@@ -0,0 +1,130 @@
+"""
+conditions
+
+Conditions for AnimaticsWinch.wait_for(), which blocks until any of a
+set of conditions is met.  Each condition names the motor variables it
+needs (see telemetry.VARIABLES), so that wait_for() can read everything
+for all of them in one query per tick, and met() is then given the
+winch, a dict of those variables and the seconds since the wait began.
+
+e.g. wait until the motor has slowed to a stop, or 10s have passed:
+  winch.wait_for(conditions.Velocity(above=-0.005),conditions.Elapsed(10.0))
+
+Bounds are inclusive: above=x is met once the value is >= x.
+"""
+import abc
+
+class Condition(object):
+    __metaclass__ = abc.ABCMeta
+    names = ()
+
+    @abc.abstractmethod
+    def met(self,winch,sample,elapsed):
+        """ True once the condition holds, given sample, a dict of the
+        variables in names, and elapsed seconds since the wait began
+        """
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+
+class Elapsed(Condition):
+    def __init__(self,seconds):
+        self.seconds = seconds
+
+    def met(self,winch,sample,elapsed):
+        return elapsed >= self.seconds
+
+    def __repr__(self):
+        return "Elapsed(%g)"%self.seconds
+
+
+class Bounds(Condition):
+    """ met when value() reaches above or below, whichever are given
+    """
+    def __init__(self,above=None,below=None):
+        if above is None and below is None:
+            raise Exception("%s needs a bound"%self.__class__.__name__)
+        self.above = above
+        self.below = below
+
+    @abc.abstractmethod
+    def value(self,winch,sample):
+        """ the value compared against the bounds, from sample
+        """
+
+    def met(self,winch,sample,elapsed):
+        val = self.value(winch,sample)
+        if self.above is not None and val >= self.above:
+            return True
+        if self.below is not None and val <= self.below:
+            return True
+        return False
+
+    def __repr__(self):
+        bounds = []
+        if self.above is not None:
+            bounds.append("above=%g"%self.above)
+        if self.below is not None:
+            bounds.append("below=%g"%self.below)
+        return "%s(%s)"%(self.__class__.__name__,",".join(bounds))
+
+
+class Velocity(Bounds):
+    """ cable speed in m/s, as read_motor_velocity()
+    """
+    names = ('va','rpa')
+    def value(self,winch,sample):
+        return winch.read_motor_velocity(va=sample['va'],pa=sample['rpa'])
+
+class Position(Bounds):
+    """ cable out in m, as read_cable_out()
+    """
+    names = ('rpa',)
+    def value(self,winch,sample):
+        return winch.read_cable_out(rpa=sample['rpa'])
+
+class Current(Bounds):
+    """ motor current, UIA
+    """
+    names = ('uia',)
+    def value(self,winch,sample):
+        return winch.read_motor_current(uia=sample['uia'])
+
+class Torque(Bounds):
+    """ motor torque, TRQ
+    """
+    names = ('trq',)
+    def value(self,winch,sample):
+        return winch.read_motor_torque(rtrq=sample['trq'])
+
+
+class StatusBit(Condition):
+    """ met when bit of status word 0 is set, or clear if set=False
+    """
+    names = ('sw0',)
+    def __init__(self,bit,set=True):
+        self.bit = bit
+        self.set = set
+
+    def met(self,winch,sample,elapsed):
+        return bool(sample['sw0'] & (1<<self.bit)) == self.set
+
+    def __repr__(self):
+        return "StatusBit(%d,set=%s)"%(self.bit,self.set)
+
+def TrajectoryDone():
+    """ the current move has finished
+    """
+    return StatusBit(2,set=False)
+
+
+class Predicate(Condition):
+    """ fn(sample) for anything else, reading the variables in names
+    """
+    def __init__(self,fn,*names):
+        self.fn = fn
+        self.names = names
+
+    def met(self,winch,sample,elapsed):
+        return self.fn(sample)
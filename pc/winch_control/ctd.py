@@ -1,19 +1,20 @@
 #!/usr/bin/env python
 import Tkinter
 tk=Tkinter
+import tkSimpleDialog
 import aniwinch
-import threading
 from datetime import datetime
-import time
 import serial
 import sys
 
 import winch_settings
+import clock
+import snapshot
 
 from humminbird import HumminbirdMonitor
 from gpio_wrapper import SerialGPIO
 
-from async import async,OperationAborted
+from async import async,OperationAborted,Executor
 
 import logging
 
@@ -21,16 +22,16 @@ class CTD(object):
     towyo_factor=1.5
     depth_override=None
 
-    def __init__(self):
+    def __init__(self,clk=None):
         self.log = logging.getLogger('main')
+        self.clock = clk or clock.get_clock()
 
-        self.lock = threading.Lock()
-        self.thread = None
-        self.abort_async = False
+        # runs actions called with block=False - see async.py
+        self.executor = Executor('ctd')
         self.async_action = None
         
-        self.monitor = HumminbirdMonitor()
-        self.winch = aniwinch.AnimaticsWinch()
+        self.monitor = HumminbirdMonitor(self.clock)
+        self.winch = aniwinch.AnimaticsWinch(clk=self.clock)
         
     @async('cast on gpio')
     def cast_on_gpio(self):
@@ -124,53 +125,32 @@ class CTD(object):
         
     def stop_auto(self,cleanup=True):
         self.log.debug("stop_auto top, cleanup=%s"%cleanup)
-
-        # probably a race condition here!
-        # 1. there's a thread running
-        # 2. stop_auto() is called - abort_async=True
-        # 3. The thread exits
-        # END: abort_async is left True
-
-        # so async makes sure that the last thing that happens
-        # in the thread is clearing abort_async
-        with self.lock:
-            if self.async_action is not None:
-                self.log.info("ctd::stop_auto setting exception with cleanup=%s"%cleanup)
-                self.abort_async = OperationAborted(cleanup=cleanup)
+        # cancels only what is running or queued now, so nothing is
+        # left over to abort a later action
+        if self.executor.busy():
+            self.log.info("ctd::stop_auto cancelling with cleanup=%s"%cleanup)
+            self.executor.cancel_all(OperationAborted(cleanup=cleanup))
 
     def handle_abort(self):
         self.log.info("async action was aborted")
 
-    # would be nice to do this with simple lexical scope,
-    # but doesn't appear to work.
-    waiting = 0
     def do_synchronous_cast(self):
-        self.waiting=1
-        def on_complete(arg):
-            self.waiting -= 1
-            
-        self.winch.ctd_cast(self.depth_for_cast(),
-                            block=False,callback=on_complete) 
-        while self.waiting >0:
+        cast=self.winch.ctd_cast(self.depth_for_cast(),block=False)
+        while not cast.done():
             self.poll()
-            time.sleep(0.2)
+            self.clock.wait(0.2)
+        # raises if the winch aborted the cast
+        cast.result()
             
     def poll(self):
-        # print "ctd::poll()"
-        if self.abort_async is not False:
-            if isinstance(self.abort_async,OperationAborted):
-                exc = self.abort_async
-            else:
-                exc = OperationAborted(cleanup=True)
-            self.abort_async = False # it's been received
-            self.log.info("ctd::poll() raising exc with cleanup=%s"%exc.cleanup)
-            raise exc
+        # raises OperationAborted if stop_auto() has cancelled this
+        self.executor.check()
 
     # Connect to the GPIO on demand
     _gpio = None
     def gpio(self):
         if self._gpio is None:
-            self._gpio = SerialGPIO()
+            self._gpio = SerialGPIO(self.clock)
         return self._gpio
     
     def force_enable_gpio(self):
@@ -236,6 +216,12 @@ class CTD(object):
     def reset_here(self):
         self.winch.reset_encoder_position()        
 
+    def record_line_mark(self):
+        m=tkSimpleDialog.askfloat("Line mark","Marked wire out at the block [m]",
+                                  parent=self.top)
+        if m is not None:
+            self.winch.record_calibration('mark',m)
+
     def stop_now(self):
         self.log.info('ctd::stop_now')
         self.stop_auto(cleanup=False) # signal that no cleanup actions should be taken
@@ -245,14 +231,23 @@ class CTD(object):
     def print_status(self):
         self.winch.status_report()
 
+    def dump_comm_stats(self):
+        self.winch.comm_stats.dump()
+        self.winch.loop_stats.dump()
+        self.winch.cache.dump()
+
     update_rate_ms = 200
     
     def periodic_update(self):
-        for text,thunk,str_var in self.state_values:
-            try:
-                str_var.set(thunk())
-            except Exception as exc:
-                print exc
+        # only the published snapshot - nothing here talks to a device
+        snap=self.publisher.newer(self.shown_seq)
+        if snap is not None:
+            self.shown_seq=snap.seq
+            for text,thunk,str_var in self.state_values:
+                try:
+                    str_var.set(thunk(snap))
+                except Exception as exc:
+                    print exc
         
         self.top.after(self.update_rate_ms,self.periodic_update)
         
@@ -264,6 +259,7 @@ class CTD(object):
                           ('Set current position as top',self.reset_here),
                           ('Recover and reset CTD',self.recover_reset),
                           ('Recover CTD',self.recover),
+                          ('Record line mark',self.record_line_mark),
 
                           ('Start GPIO-triggered single-cast mode',self.enable_hw_trig_cast),
                           ('Start GPIO-triggered tow-yo',self.enable_hw_trig_towyo),
@@ -271,7 +267,8 @@ class CTD(object):
                           ('Force enable autopilot via GPIO',self.force_enable_gpio),
                           ('Force disable autopilot via GPIO',self.force_disable_gpio),
                           ('Stop automated casts',self.stop_auto),
-                          ('Print status info to console',self.print_status) ]:
+                          ('Print status info to console',self.print_status),
+                          ('Log serial and loop timing stats',self.dump_comm_stats) ]:
             buttons.append( Tkinter.Button(self.actions,text=text,command=cmd) )
         for btn in buttons:
             btn.pack(side=Tkinter.TOP,fill='x')
@@ -324,17 +321,20 @@ class CTD(object):
         self.winch.start_force_move(force_kg)
         
     def gui_init_state(self):
-        # a list of parameters to update periodically
-        self.state_values = [ ['Depth',lambda: "%.2f m"%self.monitor.maxDepth],
-                              ['GPS velocity',lambda: "%.2f m/s"%self.monitor.velocity],
-                              ['Cable out',lambda: "%.2f m/%.2frev"%self.winch.get_cable_out(1.0,extra=True) ],
-                              ['Cable speed',lambda: "%.2f m/s"%self.winch.get_velocity(1.0) ],
-                              ['Winch current',lambda: "%.0f mA?"%self.winch.get_current(1.0)],
-                              ['Winch torque',lambda: "%.0f"%self.winch.get_torque(1.0)],
-                              ['Winch action',lambda: self.winch.async_action],
-                              ['CTD action',lambda: self.async_action],
-                              ['GPIO from APM',lambda: self.gpio().cast_signal()],
-                              ['GPIO to APM',lambda: self.gpio().last_signal_out ]]
+        # a list of parameters to update periodically, each formatted
+        # from a snapshot.Snapshot
+        self.state_values = [ ['Depth',lambda s: "%.2f m"%s.depth],
+                              ['GPS velocity',lambda s: "%.2f m/s"%s.gps_velocity],
+                              ['Cable out',lambda s: "%.2f m/%.2frev"%(s.cable_out,s.cable_revs) ],
+                              ['Cable speed',lambda s: "%.2f m/s"%s.cable_speed ],
+                              ['Winch current',lambda s: "%.0f mA?"%s.current],
+                              ['Winch torque',lambda s: "%.0f"%s.torque],
+                              ['Winch serial',lambda s: s.comm_summary],
+                              ['Control loop',lambda s: s.loop_summary],
+                              ['Winch action',lambda s: s.winch_action],
+                              ['CTD action',lambda s: s.ctd_action],
+                              ['GPIO from APM',lambda s: s.gpio_in],
+                              ['GPIO to APM',lambda s: s.gpio_out ]]
 
         hdr_font = ('Helvetica','13','bold')
         hdr_key = Tkinter.Label(self.state,text="Variable",font=hdr_font,justify=tk.LEFT)
@@ -353,7 +353,6 @@ class CTD(object):
             else:
                 val = Tkinter.Label(self.state,textvariable=str_var,
                                     justify=Tkinter.LEFT)
-            str_var.set(thunk())
             lab.grid(row=i+1,column=0,sticky=tk.N+tk.W+tk.S)
             val.grid(row=i+1,column=1,sticky=tk.N+tk.W+tk.S)
 
@@ -450,11 +449,18 @@ class CTD(object):
         self.state.pack(side=Tkinter.LEFT,fill='both')
         self.config.pack(side=Tkinter.LEFT,fill='both')
 
+        # reads the devices for the state column - see snapshot.py
+        self.publisher = snapshot.SnapshotPublisher(self,rate=1000.0/self.update_rate_ms,
+                                                    clk=self.clock)
+        self.shown_seq = 0
+        self.publisher.start()
         top.after(self.update_rate_ms,self.periodic_update)
         
         top.mainloop()
         self.log.info("exiting mainloop")
         
+        self.publisher.stop()
+        self.executor.shutdown()
         self.winch.close()
         if self._gpio is not None:
             self._gpio.close()
@@ -0,0 +1,407 @@
+"""
+devices
+
+The winch, Humminbird and GPIO on a reactor (see reactor.py), as an
+alternative to the threads in aniwinch, humminbird and gpio_wrapper.
+Linux only - the ports are opened non-blocking and select()ed on.
+
+Methods which talk to a device return a Future, and the slower actions
+are coroutines, to run with reactor.spawn() or yield from another
+coroutine.  Either way they are only called on the reactor's thread.
+
+  winch.msg(out): the responses, formatted as AnimaticsWinch.msg()
+  winch.complete_position_move(...): as AnimaticsWinch, polling
+    status at control_rate, with the same decisions and commands (see
+    positionmove.py)
+  gpio.wait_for_cast_signal(): until the autopilot signals a cast
+  monitor.next_sentence(): the next NMEA sentence, with maxDepth and
+    velocity kept current as they come in
+
+Cancelling the Task stops a move the same way as an abort: the motor is
+stopped and the brake set.  The telemetry stream and the resident cast
+program aren't supported here - status is always queried.
+
+usage: python devices.py [location]
+  print depth, speed, cast signal and cable out until interrupted
+"""
+import collections
+import logging
+import serial
+
+import winch_settings
+import reactor
+import telemetry
+import spool
+import profiles
+import positionmove
+import calibration
+import humminbird
+from aniwinch import AnimaticsWinch
+from async import Future
+
+def open_port(port,baudrate):
+    """ a serial port which never blocks, for a SerialProtocol
+    """
+    return serial.Serial(port,baudrate,timeout=0)
+
+
+class NmeaMonitor(reactor.SerialProtocol):
+    """ reactor version of humminbird.HumminbirdMonitorReal
+    """
+    terminator = "\n"
+
+    def __init__(self,loop,port):
+        reactor.SerialProtocol.__init__(self,loop,port)
+        self.log = logging.getLogger('humm')
+        self.nmealog = logging.getLogger('nmea')
+        self.maxDepth = 5
+        self.velocity = 0.0
+        self.waiters = []
+
+    def line_received(self,line):
+        line = line.strip()
+        self.nmealog.info(line)
+        parsed = humminbird.parse_nmea(line,self.log)
+        if parsed is not None:
+            setattr(self,parsed[0],parsed[1])
+        waiters,self.waiters = self.waiters,[]
+        for fut in waiters:
+            fut.set_result(line)
+
+    def next_sentence(self):
+        fut = Future()
+        self.waiters.append(fut)
+        return fut
+
+    def moving(self):
+        return self.velocity > 0.5
+
+    def connection_lost(self,exc):
+        self.log.error("Humminbird port closed")
+        reactor.SerialProtocol.connection_lost(self,exc)
+
+
+class GpioDevice(reactor.SerialProtocol):
+    """ reactor version of gpio_wrapper.SerialGPIOReal.  The board only
+    answers queries, so waiting for a signal still polls, on the reactor.
+    """
+    terminator = "\n"
+    gpio_recv = 0 # for AP to signal to PC to cast
+    gpio_xmit = 1 # for PC to signal to AP to stop
+    # a read with no answer in this long reads as 0, like the timeout of
+    # the serial port in SerialGPIOReal
+    read_timeout = 1.0
+    poll_interval = 0.5
+
+    def __init__(self,loop,port):
+        reactor.SerialProtocol.__init__(self,loop,port)
+        self.log = logging.getLogger('gpio')
+        self.last_signal_out = None
+        self.last_signal_in = None
+        # reads waiting on a value, oldest first, with their timeouts
+        self.reads = collections.deque()
+
+    def line_received(self,line):
+        if line.startswith('\r'): line = line[1:]
+        # echoes and prompts
+        if line.startswith('>') or line.startswith('g'):
+            return
+        if not self.reads:
+            return
+        fut,timer = self.reads.popleft()
+        timer.cancel()
+        try:
+            val = int(line)
+        except ValueError:
+            val = 0
+        fut.set_result(val)
+
+    def read(self,chan):
+        fut = Future()
+        def expire():
+            for i,(pending,timer) in enumerate(self.reads):
+                if pending is fut:
+                    del self.reads[i]
+                    fut.set_result(0)
+                    break
+        timer = self.reactor.call_later(self.read_timeout,expire)
+        self.reads.append( (fut,timer) )
+        self.write('gpio read %d\r' % chan)
+        return fut
+
+    def cast_signal(self):
+        """ coroutine: whether Ardupilot has signalled for a cast
+        """
+        val = yield self.read(self.gpio_recv)
+        self.last_signal_in = val == 1
+        raise reactor.Return(self.last_signal_in)
+
+    def wait_for_cast_signal(self):
+        """ coroutine: wait for the cast signal to go low, if it was left
+        high, and then high
+        """
+        while (yield self.cast_signal()): # wait for clean start
+            self.log.info("Cast signal hasn't transitioned yet")
+            yield self.poll_interval
+        while not (yield self.cast_signal()): # wait for the real signal
+            self.log.info("Cast signal is low - waiting")
+            yield self.poll_interval
+
+    def signal_cast_in_progress(self):
+        self.write('gpio set %d\r' % self.gpio_xmit)
+        self.last_signal_out = 1
+    def signal_cast_complete(self):
+        self.write('gpio clear %d\r' % self.gpio_xmit)
+        self.last_signal_out = 0
+
+    def connection_lost(self,exc):
+        self.log.error("GPIO port closed")
+        reactor.SerialProtocol.connection_lost(self,exc)
+        while self.reads:
+            fut,timer = self.reads.popleft()
+            timer.cancel()
+            fut.set_result(0)
+
+
+class WinchDevice(reactor.SerialProtocol):
+    """ reactor version of the parts of AnimaticsWinch needed for a
+    position move.  Settings are AnimaticsWinch's, with the spool
+    calibration applied.  connect() before anything else.
+    """
+    terminator = "\r"
+    settings = spool.SpoolModel.winch_attrs + (
+        'spool_radius_inner','max_wire_out','speed_tolerance','target_velocity',
+        'free_wheel_ratio','max_pause','control_rate',
+        'slack_window','slack_z','slack_current_threshold',
+        'torque_thresh_coeffs','torque_thresh_min')
+    status_names = AnimaticsWinch.status_names
+
+    def __init__(self,loop,port):
+        reactor.SerialProtocol.__init__(self,loop,port)
+        self.log = logging.getLogger('wnch')
+        self.clock = loop.clock
+        for attr in self.settings:
+            setattr(self,attr,getattr(AnimaticsWinch,attr))
+        cal = calibration.Calibration.load(winch_settings.calibration_file)
+        if cal.fit is not None:
+            cal.fit.apply(self)
+        # (future,nresp,responses) for each command awaiting responses,
+        # oldest first
+        self.in_flight = collections.deque()
+        self.cable_out = None
+
+    _spool = None
+    @property
+    def spool(self):
+        key = tuple(getattr(self,attr) for attr in spool.SpoolModel.winch_attrs)
+        if self._spool is None or self._spool.key()!=key:
+            self._spool = spool.SpoolModel(*key)
+        return self._spool
+
+    def position_winch_to_m(self,nondim):
+        return self.spool.counts_to_m(nondim)
+    def position_m_to_winch(self,m):
+        return self.spool.m_to_counts(m)
+
+    def msg(self,out,nresp=-1):
+        """ send out, formatted as for AnimaticsWinch.msg(), and return a
+        Future for the list of responses
+        """
+        out = out.replace("\n","\r")
+        if out[-1] not in [' ',"\r"]:
+            self.log.warning("msg does not end in space or CR - assuming CR")
+            out += "\r"
+        if nresp<0:
+            nresp = out.count("\r")
+        if self.port is None:
+            raise Exception("Winch serial port is not open")
+        self.log.debug("=>%s"%(repr(out)))
+        fut = Future()
+        if nresp == 0:
+            fut.set_result([])
+        else:
+            self.in_flight.append( (fut,nresp,[]) )
+        self.write(out)
+        return fut
+
+    def line_received(self,line):
+        if line.startswith(telemetry.STREAM_PREFIX):
+            return
+        if not self.in_flight:
+            self.log.debug("Unexpected response %r"%line)
+            return
+        fut,nresp,responses = self.in_flight[0]
+        responses.append(line)
+        if len(responses) >= nresp:
+            self.in_flight.popleft()
+            fut.set_result(responses)
+
+    def connection_lost(self,exc):
+        self.log.error("Winch serial port closed")
+        reactor.SerialProtocol.connection_lost(self,exc)
+        while self.in_flight:
+            fut,nresp,responses = self.in_flight.popleft()
+            fut.set_exception(Exception("Winch serial port closed"))
+
+    def connect(self,zero=True):
+        """ coroutine: read the sample rate and version, and set up the
+        motor as AnimaticsWinch does.  zero: reset the encoder position
+        """
+        yield self.msg("ECHO_OFF ")
+        rsp = yield self.msg("RSP\r")
+        if rsp[0]=="":
+            raise Exception("Failed to read sample rate and version - motor disconnected?")
+        srate,self.version = rsp[0].split('/')
+        self.srate = int(srate)
+        if self.version == '5.0.3.61':
+            self.cmd_ver = self.version
+        else:
+            self.cmd_ver = 'old'
+        self.log.info("Sample rate: %s"%self.srate)
+        self.log.info("Firmware version: %s"%self.version)
+        if self.cmd_ver != 'old':
+            yield self.msg('BRKTRJ ')
+        yield self.msg('EL=-1 ')
+        if zero:
+            yield self.msg("O=0 ")
+
+    def query(self,*names):
+        """ coroutine: a namedtuple of the motor variables in names, see
+        AnimaticsWinch.query()
+        """
+        q = telemetry.compile_query(names,self.cmd_ver)
+        responses = yield self.msg(q.cmd,nresp=q.nresp)
+        raise reactor.Return(q.parse(responses))
+
+    def read_cable_out(self):
+        """ coroutine: cable out in m
+        """
+        rec = yield self.query('rpa')
+        self.cable_out = self.position_winch_to_m(rec.rpa)
+        raise reactor.Return(self.cable_out)
+
+    # the commands of AnimaticsWinch.stop_motor(), enable_brake() and
+    # so on - see positionmove.py
+    def send(self,cmds):
+        """ send each of cmds, none of which expect a response
+        """
+        for cmd in cmds:
+            self.msg(cmd)
+
+    def free_wheel(self):
+        T = int(self.spool.kg_to_trq(0.0))
+        self.send(positionmove.release_brake_cmds(self.cmd_ver) + positionmove.stop_cmds()
+                  + positionmove.force_cmds(self.cmd_ver,T))
+
+    def stop(self):
+        self.log.info("Stopping motor")
+        self.send(positionmove.stop_cmds() + positionmove.enable_brake_cmds(self.cmd_ver))
+
+    def complete_position_move(self,absol_m=None,rel_m=None,
+                               velocity=None,direc=0,
+                               accel=None,decel=None,
+                               monitor_slack=True,max_pause=None):
+        """ coroutine: as AnimaticsWinch.complete_position_move
+        """
+        velocity = velocity or self.target_velocity
+        if max_pause is None:
+            max_pause = self.max_pause
+        pos = yield self.read_cable_out()
+        if rel_m is not None:
+            absol_m = pos + rel_m
+        if absol_m > self.max_wire_out:
+            self.log.warn("Requested wire out %f > max %f"%(absol_m,self.max_wire_out))
+            absol_m = self.max_wire_out
+        target_position = int( self.position_m_to_winch(absol_m) )
+        if direc != 0:
+            if (direc < 0) == (pos < absol_m):
+                self.log.info("No move - direc=%d"%direc)
+                return
+        elif pos<absol_m:
+            direc = 1
+        else:
+            direc = -1
+        self.log.info("Commanded to move to cable length %s"%absol_m)
+        if isinstance(velocity,profiles.SpeedProfile):
+            profile = velocity.compile(self,span=(pos,absol_m))
+        elif callable(velocity):
+            profile = profiles.FunctionProfile(velocity,self)
+        else:
+            profile = profiles.SpeedProfile.constant(velocity).compile(self,span=(pos,absol_m))
+        accel = accel or 100
+        decel = decel or 100
+        if direc<0:
+            # only worry about slack when reeling out
+            monitor_slack = False
+
+        period = 1.0/self.control_rate
+        move = positionmove.PositionMove(self,profile,target_position,direc,
+                                         free=monitor_slack,max_pause=max_pause)
+        def servo(vt):
+            move.servo_sent(vt)
+            return self.msg(positionmove.servo_cmd(accel,decel,vt,target_position))
+
+        try:
+            if monitor_slack:
+                self.free_wheel()
+                self.log.info('Start free velocity move')
+            else:
+                rec = yield self.query('rpa')
+                yield servo(profile.vt(rec.rpa))
+
+            t_next = self.clock.time()
+            while 1:
+                # fixed rate, skipping ahead rather than catching up
+                delay = t_next - self.clock.time()
+                yield max(delay,0)
+                late = delay < -0.5*period
+                t_next = max(t_next+period,self.clock.time())
+
+                st = yield self.query(*self.status_names)
+                sw0,va,uia,rtrq,rpa = st
+                self.cable_out = self.position_winch_to_m(rpa)
+
+                action = move.update(sw0,va,uia,rtrq,rpa,late=late)
+                if action == positionmove.SERVO:
+                    yield servo(move.vt)
+                elif action == positionmove.FREE:
+                    yield self.msg(positionmove.FREE_WHEEL_CMD)
+                elif action == positionmove.END:
+                    break
+        finally:
+            # no waiting here - this also runs when the task is cancelled
+            if self.port is not None:
+                self.stop()
+
+
+def open_devices(loop):
+    """ (winch,monitor,gpio) on the ports in winch_settings
+    """
+    winch = WinchDevice(loop,open_port(winch_settings.winch_com_port,
+                                          winch_settings.winch_baud))
+    monitor = NmeaMonitor(loop,open_port(winch_settings.hummingbird_com_port,4800))
+    gpio = GpioDevice(loop,open_port(winch_settings.gpio_com_port,9600))
+    return winch,monitor,gpio
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = reactor.Reactor()
+    winch,monitor,gpio = open_devices(loop)
+
+    def report():
+        yield winch.connect(zero=False)
+        while 1:
+            cable_out = yield winch.read_cable_out()
+            signal = yield gpio.cast_signal()
+            print "depth %.1f m  speed %.2f m/s  cast signal %s  cable out %.2f m"%(
+                monitor.maxDepth,monitor.velocity,signal,cable_out)
+            yield 1.0
+    task = loop.spawn(report())
+    task.add_done_callback(lambda t: loop.stop())
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    if task.done() and task.exc is not None:
+        print "Failed: %s"%task.exc
@@ -1,19 +1,24 @@
 import serial, sys, threading, time
 import winch_settings
+import clock
+import transport
 
 import logging
 
 class SerialGPIOReal(object):
     gpio_recv=0 # for AP to signal to PC to cast
     gpio_xmit=1 # for PC to signal to AP to stop
-    def __init__(self):
+    def __init__(self,clk=None):
+        self.clock = clk or clock.get_clock()
         self.last_signal_out = None
+        self.last_signal_in = None
         self.open_serial()
         self.log = logging.getLogger('gpio')
         
     def open_serial(self):
         try:
-            self.ser = serial.Serial(winch_settings.gpio_com_port, timeout=1)
+            opener = lambda: serial.Serial(winch_settings.gpio_com_port, timeout=1)
+            self.ser = transport.open_port('gpio',opener,clk=self.clock)
         except Exception,exc:
             self.log.error("Failed to open serial")
             self.log.error(str(exc))
@@ -22,7 +27,8 @@ class SerialGPIOReal(object):
     def cast_signal(self):
         """ return boolean whether Ardupilot has signalled for a cast.
         """
-        return self.read(self.gpio_recv) == 1
+        self.last_signal_in = self.read(self.gpio_recv) == 1
+        return self.last_signal_in
     def wait_for_cast_signal(self,poll=None):
         # assume we're called before the cast is signalled
         # for, but in case the output was left high, stall
@@ -31,13 +37,13 @@ class SerialGPIOReal(object):
             self.log.info("Cast signal hasn't transitioned yet")
             if poll:
                 poll()
-            time.sleep(0.5)
+            self.clock.sleep(0.5)
         while not self.cast_signal(): # wait for the real signal
             self.log.info("Cast signal is low - waiting")
             if poll:
                 poll()
             # this is where it should wait for a while
-            time.sleep(0.5)
+            self.clock.sleep(0.5)
 
     def signal_cast_in_progress(self):
         self.write(self.gpio_xmit,1)
@@ -90,7 +96,7 @@ class SerialGPIOTest(SerialGPIOReal):
     def write(self,chan,val):
         print "Sending gpio message:",chan,val
     def read(self,chan):
-        t = time.time()
+        t = self.clock.time()
         if t % 15 < 13:
             return 1
         else:
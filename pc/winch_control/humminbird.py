@@ -1,13 +1,38 @@
 import sys
 import threading, serial, time
 import winch_settings
+import clock
+import transport
 import logging
 import random        
 
+def parse_nmea(l,log):
+    """ ('maxDepth',m) for a depth sentence, ('velocity',m/s) for a
+    track sentence, otherwise None
+    """
+    parts = l.split(',')
+    if parts[0] == '$INDPT':
+        try:
+            maxDepth = float(parts[1])
+            log.debug('new max depth %f' % maxDepth)
+        except:
+            log.warn('trouble parsing indpt ' + parts[1])
+            maxDepth = 0
+        return ('maxDepth',maxDepth)
+    elif parts[0] == '$INVTG':
+        try:  # field 7 is speed in kilometers per hour
+            # sometimes it's blank
+            velocity = float(parts[7]) * 1000.0 / 3600.0
+        except:
+            velocity = 0
+        return ('velocity',velocity)
+    return None
+
 class HumminbirdMonitorReal(object):
     p=None
 
-    def __init__(self):
+    def __init__(self,clk=None):
+        self.clock = clk or clock.get_clock()
         self.maxDepth = 1.0
         self.velocity = 0.0
         self.monitor = True
@@ -22,7 +47,8 @@ class HumminbirdMonitorReal(object):
     def open_serial(self):
         self.log.debug("real serial open")
         try:
-            self.p = serial.Serial(winch_settings.hummingbird_com_port, baudrate=4800, timeout=5)
+            opener = lambda: serial.Serial(winch_settings.hummingbird_com_port, baudrate=4800, timeout=5)
+            self.p = transport.open_port('humminbird',opener,clk=self.clock)
         except OSError as exc:
             self.log.critical("Failed to open Humminbird port %s"%(winch_settings.hummingbird_com_port))
             sys.exit(1)
@@ -45,30 +71,10 @@ class HumminbirdMonitorReal(object):
                 if l == "":
                     pass
                 self.nmealog.info(l)
-                parts = l.split(',')
-                if parts[0] == '$INDPT':
-                    try:
-                        maxDepth = float(parts[1])
-                        self.log.debug('new max depth %f' % self.maxDepth)
-                    except:
-                        self.log.warn('trouble parsing indpt ' + parts[1])
-                        maxDepth = 0
+                parsed = parse_nmea(l,self.log)
+                if parsed is not None:
                     with self.lock:
-                        self.maxDepth = maxDepth
-                elif parts[0] == '$INVTG':
-                    try:  # field 7 is speed in kilometers per hour
-                        # sometimes it's blank
-                        velocity = float(parts[7]) * 1000.0 / 3600.0
-                    except:
-                        if 0:
-                            print 'trouble parsing invtg '
-                            for i,part in enumerate(parts):
-                                print "[%d] %s"%(i,part)
-                        velocity = 0
-                    with self.lock:
-                        self.velocity = velocity
-                else:
-                    pass
+                        setattr(self,parsed[0],parsed[1])
         except Exception as exc:
             if self.monitor:
                 self.log.error("monitor thread died")
@@ -88,7 +94,7 @@ class HumminbirdMonitorTest(HumminbirdMonitorReal):
     def readline_gen(self):
         while 1:
             # print "Reading fake hummingbird"
-            time.sleep(1.0)
+            self.clock.wait(1.0)
             fake_depth=1 + random.random()*1.0
             yield "$INDPT,9.5,-0.2*64"
 
@@ -96,7 +102,7 @@ class HumminbirdMonitorTest(HumminbirdMonitorReal):
 
             # VTG: not sure how many of these are actually 
             # filled in by the humminbird:
-            time.sleep(1.0)
+            self.clock.wait(1.0)
             # This is actually copied from somebody's Humminbird stream,
             # though not sure it's the same model.
             # That's 11.1degT, 24.9deg M 9.9 knots, 18.4 kph
@@ -105,7 +111,7 @@ class HumminbirdMonitorTest(HumminbirdMonitorReal):
             # some other lines:
             for l in ["$INRMC,180048,A,4409.5583,N,07448.3608,W,10.1,12.6,280607,13.8,W*57",
                       "$INGGA,180049,4409.5610,N,07448.3597,W,2,09,0.9,450.1,M,,,,*18"]:
-                time.sleep(0.1)
+                self.clock.wait(0.1)
                 yield l
 
     def close(self):
@@ -0,0 +1,283 @@
+"""
+montecarlo
+
+Run many simulated casts and tow-yos against winch_sim, with the
+package, depth, snags and sensor noise drawn at random, to see how the
+slack line settings of AnimaticsWinch hold up.  Runs are spread over a
+multiprocessing pool, one process per core, each run on its own
+SimClock.
+
+The same random scenarios are run for every parameter set, so
+differences between sets come from the parameters rather than the
+draw.  For each run it records:
+  cast_time: simulated seconds for the whole cast or tow-yo
+  slack_events: times the line went slack while the motor was servoing
+  detected: how many of those ended with the motor switched to
+    free-wheel, and latency_mean, latency_max: how long that took
+  overrun: longest length of slack line paid out, m
+  fault: error, timeout, short (package didn't get down to the target
+    or the bottom) or not_home (didn't get back in)
+along with the randomized inputs.  Results are saved with numpy.savez,
+one array per column, plus param_names and param_values describing the
+parameter sets.
+
+usage: python montecarlo.py sim out.npz [runs [name=v1,v2,... ...]]
+  runs: runs per parameter set, default 100
+  name=v1,v2: an AnimaticsWinch attribute to sweep, e.g.
+    free_wheel_ratio=0.15,0.25,0.35 max_pause=1,2,4
+  parameter sets are every combination of the swept values.
+"""
+import sys
+import time
+import threading
+import itertools
+import logging
+import multiprocessing
+import numpy as np
+
+import winch_settings
+import clock
+import aniwinch
+import winch_sim
+
+# uniform ranges for the randomized inputs
+scenario_ranges = dict(package_mass=(4.0,12.0),  # kg
+                       wet_fraction=(0.6,0.9),   # wet weight / mass
+                       drag_coeff=(8.0,25.0),
+                       bottom_depth=(4.0,25.0),  # wire out, m
+                       sounding_error=(-0.1,0.1),# fraction of the depth
+                       snag_duration=(0.5,8.0),  # s
+                       noise_trq=(0.0,400.0),
+                       noise_uia=(0.0,3.0),
+                       noise_va=(0.0,3000.0))
+snag_probability = 0.2
+towyo_probability = 0.3
+towyo_cycles = 2
+towyo_factor = 1.5 # as CTD.towyo_factor
+# simulated seconds before a run is aborted
+sim_limit = 600.0
+
+# columns of the results, in order
+input_columns = ['param','seed','towyo','package_mass','package_wet_kg','drag_coeff',
+                 'bottom_depth','depth','snag_depth','snag_duration',
+                 'noise_trq','noise_uia','noise_va']
+output_columns = ['cast_time','slack_events','detected','latency_mean','latency_max',
+                  'overrun','max_z','error','timeout','short','not_home','fault']
+
+def draw_scenario(seed):
+    rng = np.random.RandomState(seed)
+    def uniform(name):
+        return rng.uniform(*scenario_ranges[name])
+    scen = dict(seed=seed)
+    scen['towyo'] = rng.rand() < towyo_probability
+    scen['package_mass'] = uniform('package_mass')
+    scen['package_wet_kg'] = scen['package_mass']*uniform('wet_fraction')
+    scen['drag_coeff'] = uniform('drag_coeff')
+    scen['bottom_depth'] = uniform('bottom_depth')
+    # the depth the sounder gives for the cast
+    scen['depth'] = scen['bottom_depth']*(1+uniform('sounding_error'))
+    if rng.rand() < snag_probability:
+        scen['snag_depth'] = rng.uniform(0.5,scen['bottom_depth'])
+    else:
+        scen['snag_depth'] = np.nan
+    scen['snag_duration'] = uniform('snag_duration')
+    for name in ['noise_trq','noise_uia','noise_va']:
+        scen[name] = uniform(name)
+    return scen
+
+def slack_latencies(events):
+    """ for each time the line went slack while servoing, how long
+    until the motor was switched to torque mode (free-wheel), or nan if
+    the line came taut or the motor stopped first.
+    """
+    latencies = []
+    t_slack = None
+    for t,kind,mode in events:
+        if t_slack is None:
+            if kind == 'slack' and mode == 'servo':
+                t_slack = t
+        elif kind == 'mode' and mode == 'torque':
+            latencies.append(t - t_slack)
+            t_slack = None
+        elif kind == 'taut' or (kind == 'mode' and mode == 'off'):
+            latencies.append(np.nan)
+            t_slack = None
+    if t_slack is not None:
+        latencies.append(np.nan)
+    return np.array(latencies)
+
+def run_scenario(winch,scen):
+    if scen['towyo']:
+        for cycle in range(towyo_cycles):
+            winch.ctd_out(scen['depth']*towyo_factor,block=True)
+            winch.complete_position_move(absol_m=winch.arm_length+winch.cage_length+0.05,
+                                         block=True,direc=-1)
+        winch.ctd_in(block=True)
+    else:
+        winch.ctd_cast(scen['depth'],block=True)
+
+def run_one(job):
+    """ run one scenario with one parameter set, returning a dict of
+    the input and output columns
+    """
+    param_index,params,scen = job
+    result = dict(scen,param=param_index)
+
+    clk = clock.SimClock()
+    clock.set_clock(clk)
+    sim = winch_sim.SimulatedAnimatics
+    sim_attrs = dict( (name,scen[name]) for name in ['package_mass','package_wet_kg','drag_coeff',
+                                                    'bottom_depth','snag_duration',
+                                                    'noise_trq','noise_uia','noise_va'] )
+    sim_attrs['snag_depth'] = None if np.isnan(scen['snag_depth']) else scen['snag_depth']
+    sim_attrs['seed'] = scen['seed']
+    saved = dict( (name,getattr(sim,name)) for name in sim_attrs )
+
+    error = timeout = False
+    winch = None
+    try:
+        for name in sim_attrs:
+            setattr(sim,name,sim_attrs[name])
+        winch = aniwinch.AnimaticsWinch(clk=clk)
+        for name in params:
+            setattr(winch,name,params[name])
+
+        done = threading.Event()
+        timed_out = []
+        def watchdog():
+            while not done.wait(0.05):
+                if clk.time() > sim_limit:
+                    timed_out.append(1)
+                    winch.abort()
+                    break
+        thread = threading.Thread(target=watchdog)
+        thread.setDaemon(1)
+        thread.start()
+
+        try:
+            run_scenario(winch,scen)
+        except Exception as exc:
+            if not timed_out:
+                logging.getLogger('montecarlo').error("seed %d: %s"%(scen['seed'],exc))
+                error = True
+        finally:
+            done.set()
+        timeout = bool(timed_out)
+        motor = winch.motor
+        result['cast_time'] = clk.time()
+        home = abs(winch.read_cable_out()) <= 0.1
+    except Exception as exc:
+        logging.getLogger('montecarlo').error("seed %d: %s"%(scen['seed'],exc))
+        error = True
+        motor = None
+        result['cast_time'] = np.nan
+        home = False
+    finally:
+        if winch is not None:
+            winch.close()
+        for name in saved:
+            setattr(sim,name,saved[name])
+
+    if motor is not None:
+        latencies = slack_latencies(motor.events)
+        detected = latencies[np.isfinite(latencies)]
+        result['slack_events'] = len(latencies)
+        result['detected'] = len(detected)
+        result['latency_mean'] = detected.mean() if len(detected) else np.nan
+        result['latency_max'] = detected.max() if len(detected) else np.nan
+        result['overrun'] = motor.max_slack
+        result['max_z'] = motor.max_z
+    else:
+        result.update(slack_events=0,detected=0,latency_mean=np.nan,latency_max=np.nan,
+                      overrun=np.nan,max_z=np.nan)
+
+    depth = scen['depth']
+    if scen['towyo']:
+        depth *= towyo_factor
+    target = depth + aniwinch.AnimaticsWinch.arm_length + aniwinch.AnimaticsWinch.cage_length
+    result['error'] = error
+    result['timeout'] = timeout
+    result['short'] = not (result['max_z'] >= min(target,scen['bottom_depth']) - 0.5)
+    result['not_home'] = not home
+    result['fault'] = error or timeout or result['short'] or result['not_home']
+    return result
+
+def init_worker():
+    # the winch logs every move at INFO, which is just noise here
+    winch_settings.set_location('sim')
+    logging.getLogger().setLevel(logging.WARNING)
+
+def parameter_sets(sweeps):
+    """ sweeps: list of (name,[values]).  Returns a list of dicts, one
+    per combination
+    """
+    names = [name for name,values in sweeps]
+    return [dict(zip(names,combo))
+            for combo in itertools.product(*[values for name,values in sweeps])]
+
+def run(param_sets,runs=100,seed=0,processes=None,progress=True):
+    """ run the same runs scenarios with each of param_sets, returning
+    a dict of columns
+    """
+    scenarios = [draw_scenario(seed+i) for i in range(runs)]
+    jobs = [(i,params,scen)
+            for i,params in enumerate(param_sets)
+            for scen in scenarios]
+    pool = multiprocessing.Pool(processes,initializer=init_worker)
+    results = []
+    t_start = time.time()
+    try:
+        for result in pool.imap_unordered(run_one,jobs):
+            results.append(result)
+            if progress and len(results) % 50 == 0:
+                elapsed = time.time() - t_start
+                print "%d/%d runs, %.0fs, %.0fs to go"%(len(results),len(jobs),elapsed,
+                                                        elapsed*(len(jobs)-len(results))/len(results))
+    finally:
+        pool.close()
+        pool.join()
+    # keep a stable order regardless of which process finished first
+    results.sort(key=lambda r: (r['param'],r['seed']))
+    return dict( (col,np.array([r[col] for r in results]))
+                 for col in input_columns+output_columns )
+
+def save(path,cols,param_sets):
+    names = sorted(set(name for params in param_sets for name in params))
+    values = np.array([[params.get(name,np.nan) for name in names]
+                       for params in param_sets],dtype=np.float64)
+    np.savez(path,param_names=np.array(names),param_values=values,**cols)
+
+def report(cols,param_sets):
+    print "%-40s %5s %6s %8s %8s %8s %7s %8s"%("parameters","runs","fault","time",
+                                               "lat p50","lat p90","missed","overrun")
+    for i,params in enumerate(param_sets):
+        sel = cols['param'] == i
+        ok = sel & ~cols['fault']
+        lat = cols['latency_max'][sel]
+        lat = lat[np.isfinite(lat)]
+        missed = (cols['slack_events'][sel] - cols['detected'][sel]).sum()
+        label = " ".join("%s=%g"%(name,params[name]) for name in sorted(params)) or "defaults"
+        print "%-40s %5d %5.1f%% %7.1fs %7.3fs %7.3fs %7d %7.2fm"%(
+            label,sel.sum(),100.0*cols['fault'][sel].mean(),
+            cols['cast_time'][ok].mean() if ok.any() else np.nan,
+            np.percentile(lat,50) if len(lat) else np.nan,
+            np.percentile(lat,90) if len(lat) else np.nan,
+            missed,
+            np.nanmax(cols['overrun'][sel]) if sel.any() else np.nan)
+
+if __name__ == '__main__':
+    winch_settings.set_location('sim')
+    path = sys.argv[2]
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    sweeps = []
+    for arg in sys.argv[4:]:
+        name,values = arg.split('=')
+        if not hasattr(aniwinch.AnimaticsWinch,name):
+            raise Exception("AnimaticsWinch has no attribute %s"%name)
+        sweeps.append( (name,[float(v) for v in values.split(',')]) )
+    param_sets = parameter_sets(sweeps)
+    t = time.time()
+    cols = run(param_sets,runs)
+    save(path,cols,param_sets)
+    print "%d runs in %.0fs, saved to %s"%(len(cols['param']),time.time()-t,path)
+    report(cols,param_sets)
@@ -0,0 +1,151 @@
+"""
+positionmove
+
+What complete_position_move does with each status sample, shared by
+the threaded loop in AnimaticsWinch and the coroutine in
+devices.WinchDevice, along with the motor commands both send.
+
+A PositionMove is in 'free' (free-wheeling in torque mode, so the
+package pulls the line out) or 'servo' (a position move at the VT for
+the present radius).  update() takes a sample and returns what the
+loop should do next:
+  CONTINUE - nothing to send
+  SERVO - send a position move at move.vt, and call servo_sent()
+  FREE - the line appears slack: go back to free-wheeling
+  END - the move is over, see end_reason
+The loop owns the port, and sends the commands itself, as one write
+each from the lists below.
+"""
+import slack
+
+CONTINUE = 'continue'
+SERVO = 'servo'
+FREE = 'free'
+END = 'end'
+
+# stopping the motor always takes its own write - the motor has been
+# touchy about X, and see AnimaticsWinch.outside_transaction()
+def stop_cmds():
+    """ stop, and set the mode back to something sane
+    """
+    return ["X ","ZS MV ADT=800 VT=0 G "]
+
+def release_brake_cmds(cmd_ver):
+    return ["BRKRLS "] if cmd_ver != 'old' else []
+
+def enable_brake_cmds(cmd_ver):
+    return ["BRKTRJ "] if cmd_ver != 'old' else []
+
+def force_cmds(cmd_ver,T):
+    """ torque mode at T, after stop_cmds() and with the brake released
+    """
+    if cmd_ver == 'old':
+        return ['MT ',"TS=65536 ","T=%i "%T]
+    return ['ZS MT ',"T=%i "%T,"TS=250000 G "]
+
+def servo_cmd(accel,decel,vt,target_position):
+    return "MP AT=%d DT=%d VT=%i PT=%i G "%(accel,decel,vt,target_position)
+
+# from servo back to free-wheeling when the line goes slack
+FREE_WHEEL_CMD = 'MT T=0 G '
+
+# ignore status without the trajectory bit for this long after a
+# servo command, when status can lag the command
+START_LAG = 1.0
+
+
+class PositionMove(object):
+    """ winch: for the settings, spool and log.  profile: from
+    profiles.py.  direc: 1 out, -1 in.  free: start free-wheeling.
+    status_lag: status records may predate the last servo command, as
+    with the telemetry stream or the cast sequencer.
+    update_vt: send a new VT as the radius changes - False when the cast
+    sequencer does that itself.
+    """
+    def __init__(self,winch,profile,target_position,direc,free,max_pause,
+                 status_lag=False,update_vt=True):
+        self.winch = winch
+        self.log = winch.log
+        self.clock = winch.clock
+        self.profile = profile
+        self.target_position = target_position
+        self.direc = direc
+        self.max_pause = max_pause
+        self.status_lag = status_lag
+        self.update_vt = update_vt
+        self.mode = 'free' if free else 'servo'
+        self.detector = slack.SlackDetector.for_winch(winch)
+        # track how long it's been idle
+        self.t_start = self.t_idle = self.clock.time()
+        # VT of the last servo command, when it was sent, and whether its
+        # move has shown up in status
+        self.cmd_vt = None
+        self.t_run = None
+        self.started = False
+        # the commanded speed for the latest sample
+        self.vt = None
+        self.end_reason = None
+
+    def servo_sent(self,vt):
+        """ a servo command for vt has just been sent
+        """
+        self.cmd_vt = vt
+        self.t_run = self.clock.time()
+        self.started = False
+
+    def update(self,sw0,va,uia,rtrq,rpa,late=False):
+        """ a status sample.  late: the loop is behind, so skip logging.
+        Returns CONTINUE, SERVO, FREE or END.
+        """
+        spool = self.winch.spool
+        in_trajectory = sw0&4
+        self.vt = self.profile.vt(rpa)
+
+        if self.mode=='free':
+            # e.g. direc=1, going out, stop if rpa is greater than target_position
+            if self.direc*(rpa-self.target_position)>=0:
+                self.log.info("Free-wheeled to target_position.")
+                self.end_reason = 'target'
+                return END
+            # has it free-wheeled up to speed?
+            if rtrq!=0.0:
+                if not late:
+                    self.log.info('Wait for true free-wheel')
+                return CONTINUE
+            if va>self.profile.switch_va(rpa):
+                self.log.info('Free-wheeled up to %.2f, switch to servo'%spool.vt_to_mps(va,counts=rpa))
+                self.mode = 'servo'
+                self.detector.reset()
+                return SERVO
+            if self.clock.time() - self.t_idle > self.max_pause:
+                self.log.info('Idle too long.')
+                self.end_reason = 'idle'
+                return END
+            if not late:
+                self.log.info("Free-wheeling at %f [%d], compared to %.2f"%(spool.vt_to_mps(va,counts=rpa),va,
+                                                                           self.profile.speed(rpa)))
+            return CONTINUE
+
+        if self.status_lag and not self.started:
+            if in_trajectory:
+                self.started = True
+            elif self.clock.time()-self.t_run < START_LAG:
+                # status from before the move started
+                return CONTINUE
+        if not in_trajectory:
+            self.log.info("position move - end on no trajectory flag after %fs"%(self.clock.time()-self.t_start))
+            self.end_reason = 'trajectory'
+            return END
+        # if it's working to go this fast, then revert to free-wheel
+        # to avoid overhauling the line.
+        if self.detector.update(self.clock.time(),va,uia,rtrq,rpa):
+            self.log.info('Line appears slack: %s'%self.detector.describe())
+            self.mode = 'free'
+            self.t_idle = self.clock.time()
+            return FREE
+        if self.update_vt and self.vt != self.cmd_vt:
+            return SERVO
+        if not late:
+            self.log.debug("VA: %7d  UIA: %7d [%d]  TRQ: %7d [%d]"%(va,uia,self.winch.slack_current_threshold,
+                                                                    rtrq,self.detector.torque_thresh(va)))
+        return CONTINUE
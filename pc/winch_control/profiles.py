@@ -0,0 +1,136 @@
+"""
+profiles
+
+Speed profiles for position moves, as tables of segments over wire
+out, compiled once per move into encoder counts.
+
+A SpeedProfile is a list of (start_m,speed) segments: speed, in m/s,
+applies from start_m of wire out up to the start of the next segment,
+and the first segment also covers anything before its start.
+
+compile() turns the starts into RPA breakpoints and the speeds into VT
+values for a particular winch, so that the control loop picks the VT
+for the latest RPA with a bisect over integers, and only converts
+units for logging.  The drum radius shrinks as wire goes out, so the VT
+for a given wire speed grows with depth.  compile() splits segments
+wherever the radius changes by winch.speed_tolerance, and takes each
+piece's VT at its middle, so the wire speed stays within half the
+tolerance of the profile.  Given max_pieces, e.g. for the cast
+sequencer, it uses no more pieces than that, spread to keep the worst
+piece as flat as possible, and records the worst speed error that
+leaves in speed_error.
+
+Each segment also gets the VA at which a free-wheeling move switches
+to servo, from switch_va().
+"""
+import bisect
+import numpy as np
+
+def switch_va(winch,speed):
+    """ VA above which a move free-wheeling out at speed m/s switches to
+    servo.  This is the switch point free_wheel_ratio was tuned with,
+    which measured VA against the VT for 1 m/s on a full spool, clipped
+    to vt_max, not against the VT for speed at the present radius.
+    """
+    return winch.free_wheel_ratio*speed*winch.spool.mps_to_vt(1.0)
+
+
+class SpeedProfile(object):
+    def __init__(self,segments):
+        self.segments = sorted(segments)
+
+    @classmethod
+    def constant(cls,speed):
+        return cls([(0.0,speed)])
+
+    def speed(self,m):
+        """ speed in m/s at m of wire out
+        """
+        starts = [start for start,speed in self.segments]
+        idx = max(0,bisect.bisect_right(starts,m)-1)
+        return self.segments[idx][1]
+
+    def compile(self,winch,span=None,max_pieces=None):
+        """ span: (from_m,to_m), the wire out the move covers, in
+        either order.  Segments are only split within it.  Defaults to
+        the whole cable.
+        max_pieces: if the tolerance needs more pieces than this, use
+        this many instead, as long as there are no more segments.
+        """
+        sp = winch.spool
+        if span is None:
+            span = (0.0,winch.max_wire_out)
+        lo,hi = min(span),max(span)
+        starts = [start for start,speed in self.segments]
+        ends = starts[1:] + [max(hi,starts[-1])]
+        starts[0] = min(starts[0],lo)
+        # the part of each segment within the span, which may be empty
+        lows = np.clip(starts,lo,hi)
+        highs = np.maximum(lows,np.clip(ends,lo,hi))
+        r_lows = sp.radius(sp.m_to_counts(lows))
+        r_highs = sp.radius(sp.m_to_counts(highs))
+        ratios = np.log(r_lows/r_highs)
+        npieces = np.ceil( ratios / -np.log(1-winch.speed_tolerance) )
+        npieces = np.maximum(npieces,1).astype(np.int32)
+        if max_pieces is not None and len(npieces) <= max_pieces < npieces.sum():
+            npieces = np.ones(len(ratios),np.int32)
+            for extra in range(max_pieces-len(npieces)):
+                npieces[np.argmax(ratios/npieces)] += 1
+        # with the VT from the middle radius, the wire speed at the
+        # ends of a piece is off by half the piece's change in radius
+        speed_error = np.max(np.exp(ratios/(2.0*npieces)) - 1)
+
+        breaks = []
+        vts = []
+        speeds = []
+        switch_vas = []
+        for i,(start,speed) in enumerate(self.segments):
+            n = npieces[i]
+            # radius at each end of each piece, evenly spaced in log
+            radii = r_lows[i]*(r_highs[i]/r_lows[i])**(np.arange(n+1)/float(n))
+            if i > 0:
+                breaks.append(int(sp.m_to_counts(start)))
+            breaks += [int(rpa) for rpa in sp.radius_to_counts(radii[1:-1])]
+            mids = sp.radius_to_counts(np.sqrt(radii[:-1]*radii[1:]))
+            vts += [int(vt) for vt in sp.mps_to_vt(speed,counts=mids)]
+            speeds += [speed]*n
+            switch_vas += [switch_va(winch,speed)]*n
+        return CompiledProfile(breaks,vts,speeds,switch_vas,speed_error)
+
+
+class CompiledProfile(object):
+    """ breaks: RPA where each segment after the first starts
+    vts: VT for each segment
+    speeds: m/s for each segment, for logging
+    switch_vas: VA to switch from free-wheel to servo in each segment
+    speed_error: worst fractional error in wire speed over the span
+    """
+    def __init__(self,breaks,vts,speeds,switch_vas,speed_error=0.0):
+        self.breaks = breaks
+        self.vts = vts
+        self.speeds = speeds
+        self.switch_vas = switch_vas
+        self.speed_error = speed_error
+
+    def vt(self,rpa):
+        return self.vts[bisect.bisect_right(self.breaks,rpa)]
+    def speed(self,rpa):
+        return self.speeds[bisect.bisect_right(self.breaks,rpa)]
+    def switch_va(self,rpa):
+        return self.switch_vas[bisect.bisect_right(self.breaks,rpa)]
+
+
+class FunctionProfile(object):
+    """ the same interface for a function taking wire out in m and
+    returning a speed in m/s.  Converts units on every lookup.
+    """
+    def __init__(self,fn,winch):
+        self.fn = fn
+        self.winch = winch
+
+    def vt(self,rpa):
+        return int(self.winch.spool.mps_to_vt(self.speed(rpa),counts=rpa))
+    def speed(self,rpa):
+        return self.fn(self.winch.position_winch_to_m(rpa))
+    def switch_va(self,rpa):
+        return switch_va(self.winch,self.speed(rpa))
@@ -0,0 +1,362 @@
+"""
+reactor
+
+An optional single-threaded way of running the devices on Linux: one
+select() loop owns the serial ports of the winch, Humminbird and GPIO,
+opened non-blocking, and anything waiting on them is a coroutine on
+that loop rather than a thread.  The devices are in devices.py.
+
+This is Python 2, without asyncio, so coroutines are generators.  A
+coroutine yields what it is waiting for, and is resumed with the result:
+  a Future (async.Future, which includes a Task) - resumed with its
+    result, or its exception is raised at the yield
+  a generator - run as a Task, and waited for
+  a number - sleep that many seconds
+  None - let everything else that is ready run first
+and returns a value with raise Return(value).
+
+Reactor.spawn(gen) runs a coroutine as a Task, which is also a Future.
+Task.cancel() raises Cancelled, an OperationAborted, at the yield the
+coroutine is waiting on, and cancels the Task it is waiting for, if
+any, so the same except and finally clauses as the threaded layer do
+the cleanup.
+
+Python 2 forgets the exception being handled when a generator yields,
+so in
+  except Cancelled:
+      yield cleanup()
+      raise
+the bare raise raises None, a TypeError.  Task turns that back into
+the Cancelled for a cancel, but a handler for anything else which
+yields has to bind the exception and re-raise it:
+  except IOError as exc:
+      yield cleanup()
+      raise exc
+
+spawn(), call_soon() and Task.cancel() can be called from any thread,
+e.g. the GUI, which can then wait on the Task.
+"""
+import os
+import fcntl
+import errno
+import select
+import heapq
+import itertools
+import threading
+import collections
+import types
+import logging
+import abc
+
+import clock
+from async import Future,OperationAborted
+
+class Return(Exception):
+    """ raised by a coroutine to return value
+    """
+    def __init__(self,value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Cancelled(OperationAborted):
+    def __init__(self):
+        OperationAborted.__init__(self,cleanup=False)
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+    fcntl.fcntl(fd,fcntl.F_SETFL,flags|os.O_NONBLOCK)
+
+
+class Timer(object):
+    def __init__(self,when,fn,args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor(object):
+    def __init__(self,clk=None):
+        # select() waits in real time, so timers can't run on a
+        # simulated clock
+        self.clock = clk or clock.RealClock()
+        self.log = logging.getLogger('reactor')
+        self.readers = {}
+        self.writers = {}
+        # heap of (when,sequence,Timer)
+        self.timers = []
+        self.seq = itertools.count()
+        # callbacks to run on the next pass, possibly from other threads
+        self.ready = collections.deque()
+        self.ready_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        # written by other threads to wake up select()
+        self.wake_r,self.wake_w = os.pipe()
+        set_nonblocking(self.wake_r)
+        set_nonblocking(self.wake_w)
+        self.add_reader(self.wake_r,self.drain_wakeup)
+
+    def add_reader(self,fd,fn):
+        self.readers[fd] = fn
+    def remove_reader(self,fd):
+        self.readers.pop(fd,None)
+    def add_writer(self,fd,fn):
+        self.writers[fd] = fn
+    def remove_writer(self,fd):
+        self.writers.pop(fd,None)
+
+    def call_soon(self,fn,*args):
+        with self.ready_lock:
+            self.ready.append( (fn,args) )
+        if threading.current_thread() is not self.thread:
+            try:
+                os.write(self.wake_w,'x')
+            except OSError as exc:
+                # already full of wakeups
+                if exc.errno != errno.EAGAIN:
+                    raise
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wake_r,4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def call_later(self,delay,fn,*args):
+        """ call fn(*args) on the loop after delay seconds.  Only from
+        the loop's thread.  Returns a Timer, which can be cancelled.
+        """
+        timer = Timer(self.clock.time()+delay,fn,args)
+        heapq.heappush(self.timers,(timer.when,next(self.seq),timer))
+        return timer
+
+    def sleep(self,seconds):
+        """ a Future which completes after seconds
+        """
+        fut = Future()
+        self.call_later(seconds,fut.set_result,None)
+        return fut
+
+    def spawn(self,gen,name=None):
+        return Task(self,gen,name)
+
+    def run(self):
+        """ run the loop in this thread until stop()
+        """
+        self.thread = threading.current_thread()
+        self.running = True
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.thread = None
+
+    def start(self):
+        """ run the loop in a thread of its own
+        """
+        thread = threading.Thread(target=self.run,name='reactor')
+        thread.setDaemon(1)
+        thread.start()
+        return thread
+
+    def stop(self):
+        def halt():
+            self.running = False
+        self.call_soon(halt)
+
+    def run_once(self):
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0,self.timers[0][0] - self.clock.time())
+        else:
+            timeout = None
+        try:
+            rd,wr,_ = select.select(list(self.readers),list(self.writers),[],timeout)
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            rd,wr = [],[]
+        for fd in rd:
+            if fd in self.readers:
+                self.run_callback(self.readers[fd],())
+        for fd in wr:
+            if fd in self.writers:
+                self.run_callback(self.writers[fd],())
+        now = self.clock.time()
+        while self.timers and self.timers[0][0] <= now:
+            when,seq,timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.run_callback(timer.fn,timer.args)
+        # only what was ready at the start of this pass, so a callback
+        # which reschedules itself can't starve select()
+        with self.ready_lock:
+            ready,self.ready = self.ready,collections.deque()
+        for fn,args in ready:
+            self.run_callback(fn,args)
+
+    def run_callback(self,fn,args):
+        try:
+            fn(*args)
+        except Exception:
+            self.log.exception("Error in reactor callback %s"%getattr(fn,'__name__',fn))
+
+
+class Task(Future):
+    """ runs a coroutine on the reactor, and completes with its value
+    """
+    ids = itertools.count()
+
+    def __init__(self,reactor,gen,name=None):
+        Future.__init__(self)
+        self.reactor = reactor
+        self.gen = gen
+        self.name = name or getattr(gen,'__name__','task')
+        # what the coroutine is waiting on
+        self.waiting = None
+        # each resume carries the id of the wait it ends, so that a
+        # wait which was cancelled can't resume the coroutine later
+        self.wait_id = next(self.ids)
+        # the Cancelled raised by cancel(), once it has been
+        self.cancel_exc = None
+        reactor.call_soon(self.step,None,None,self.wait_id)
+
+    def __repr__(self):
+        return "Task(%s)"%self.name
+
+    def step(self,value,exc,wait_id):
+        if self.done() or wait_id != self.wait_id:
+            return
+        self.wait_id = next(self.ids)
+        self.waiting = None
+        try:
+            if exc is not None:
+                yielded = self.gen.throw(exc)
+            else:
+                yielded = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as ret:
+            self.set_result(ret.value)
+        except Exception as err:
+            if (self.cancel_exc is not None and isinstance(err,TypeError)
+                and 'NoneType' in str(err)):
+                # a bare raise after a yield in the handler - see above
+                err = self.cancel_exc
+            if not isinstance(err,OperationAborted):
+                self.reactor.log.debug("%r failed: %s"%(self,err))
+            self.set_exception(err)
+        else:
+            self.wait_on(yielded)
+
+    def wait_on(self,yielded):
+        wait_id = self.wait_id
+        if yielded is None:
+            self.reactor.call_soon(self.step,None,None,wait_id)
+            return
+        if isinstance(yielded,types.GeneratorType):
+            yielded = Task(self.reactor,yielded)
+        elif isinstance(yielded,(int,long,float)):
+            yielded = self.reactor.sleep(yielded)
+        if not isinstance(yielded,Future):
+            self.reactor.call_soon(self.step,None,
+                                   TypeError("%r yielded %r"%(self,yielded)),wait_id)
+            return
+        self.waiting = yielded
+        def resume(fut):
+            self.reactor.call_soon(self.step,fut.value,fut.exc,wait_id)
+        yielded.add_done_callback(resume)
+
+    def cancel(self):
+        """ raise Cancelled in the coroutine, where it is waiting
+        """
+        self.reactor.call_soon(self.cancel_now)
+
+    def cancel_now(self):
+        if self.done():
+            return
+        if isinstance(self.waiting,Task):
+            self.waiting.cancel()
+        self.cancel_exc = Cancelled()
+        self.step(None,self.cancel_exc,self.wait_id)
+
+
+class SerialProtocol(object):
+    """ a serial port on the reactor, read and written non-blocking and
+    split into lines on terminator.  port is anything with fileno(),
+    e.g. a serial.Serial opened with timeout=0.  Subclasses handle
+    line_received(line).
+    """
+    __metaclass__ = abc.ABCMeta
+    terminator = "\r"
+
+    def __init__(self,reactor,port):
+        self.reactor = reactor
+        self.port = port
+        self.fd = port.fileno()
+        set_nonblocking(self.fd)
+        self.inbuf = ""
+        self.outbuf = ""
+        self.reactor.add_reader(self.fd,self.readable)
+
+    def readable(self):
+        try:
+            data = os.read(self.fd,4096)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN,errno.EINTR):
+                return
+            self.connection_lost(exc)
+            return
+        if not data:
+            self.connection_lost(None)
+            return
+        self.data_received(data)
+
+    def data_received(self,data):
+        self.inbuf += data
+        lines = self.inbuf.split(self.terminator)
+        self.inbuf = lines.pop()
+        for line in lines:
+            self.line_received(line)
+
+    @abc.abstractmethod
+    def line_received(self,line):
+        """ called on the loop with each line read from the port,
+        without the terminator
+        """
+
+    def write(self,data):
+        self.outbuf += data
+        self.flush()
+
+    def flush(self):
+        while self.outbuf:
+            try:
+                n = os.write(self.fd,self.outbuf)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN,errno.EINTR):
+                    break
+                self.connection_lost(exc)
+                return
+            self.outbuf = self.outbuf[n:]
+        if self.outbuf:
+            self.reactor.add_writer(self.fd,self.flush)
+        else:
+            self.reactor.remove_writer(self.fd)
+
+    def connection_lost(self,exc):
+        self.close()
+
+    def close(self):
+        self.reactor.remove_reader(self.fd)
+        self.reactor.remove_writer(self.fd)
+        if self.port is not None:
+            self.port.close()
+            self.port = None
@@ -0,0 +1,113 @@
+"""
+scheduler
+
+Fixed-rate pacing for control loops, with timing statistics.
+
+A FixedRate schedule sets a deadline for the start of each iteration,
+one period apart.  tick() waits for the next deadline and records how
+late the iteration actually started.  When an iteration starts a whole
+period or more past its deadline, those deadlines are counted as
+missed and the schedule skips ahead, rather than running a burst of
+iterations to catch up.  late() tells the loop when it is behind, so
+it can skip low priority work like logging for that iteration.
+
+Times come from the loop's clock (see clock.py), so a simulated loop
+is paced in simulated time.
+"""
+import logging
+
+import clock
+import commstats
+
+class LoopStats(object):
+    """ timing of a control loop, accumulated over any number of runs
+      jitter: how late each iteration started
+      work: time from the start of an iteration to the next tick()
+    """
+    def __init__(self,name='control loop'):
+        self.name = name
+        self.log = logging.getLogger('loop')
+        self.reset()
+
+    def reset(self):
+        self.jitter = commstats.Histogram()
+        self.work = commstats.Histogram()
+        self.iterations = 0
+        self.missed = 0
+        self.shed = 0
+        self.rate = None
+
+    def summary(self):
+        """ one-line summary for the GUI
+        """
+        if self.rate is None:
+            return "idle"
+        return "%.0f Hz, %d iters, %d missed, %d shed, jitter p90<=%.1fms"%(
+            self.rate,self.iterations,self.missed,self.shed,
+            1000*self.jitter.quantile(0.9))
+
+    def report(self):
+        lines = ["%s: %s"%(self.name,self.summary())]
+        lines.append("   jitter: %s"%self.jitter.describe())
+        lines.append("   work:   %s"%self.work.describe())
+        return lines
+
+    def dump(self):
+        for line in self.report():
+            self.log.info(line)
+
+
+class FixedRate(object):
+    # an iteration which starts this fraction of a period late sheds
+    # low priority work
+    late_fraction = 0.5
+
+    def __init__(self,rate,clk=None,stats=None):
+        self.period = 1.0/rate
+        self.clock = clk or clock.get_clock()
+        self.stats = stats or LoopStats()
+        self.stats.rate = rate
+        self.deadline = None
+        self.t_start = None
+        self.lateness = 0.0
+        # for this run of the loop
+        self.iterations = 0
+        self.missed = 0
+        self.max_late = 0.0
+
+    def tick(self):
+        """ wait for the start of the next iteration
+        """
+        now = self.clock.time()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.stats.work.add(now - self.t_start)
+            if now < self.deadline:
+                self.clock.sleep(self.deadline - now)
+                now = self.clock.time()
+        self.lateness = max(0.0,now - self.deadline)
+        self.stats.jitter.add(self.lateness)
+        self.max_late = max(self.max_late,self.lateness)
+        if self.lateness >= self.period:
+            skipped = int(self.lateness/self.period)
+            self.missed += skipped
+            self.stats.missed += skipped
+            self.deadline += skipped*self.period
+        self.iterations += 1
+        self.stats.iterations += 1
+        self.t_start = now
+        self.deadline += self.period
+
+    def late(self):
+        """ true if this iteration started late enough that low priority
+        work should be skipped.  Each true return is counted as shed work.
+        """
+        if self.lateness > self.late_fraction*self.period:
+            self.stats.shed += 1
+            return True
+        return False
+
+    def describe(self):
+        return "%d iterations at %.0f Hz, %d missed, max late %.1fms"%(
+            self.iterations,1.0/self.period,self.missed,1000*self.max_late)
@@ -0,0 +1,229 @@
+"""
+slack
+
+Slack line detection for the servo loop in complete_position_move.
+
+A slack line shows up as the motor working to pay out cable: torque
+above what the speed alone calls for (see torque_thresh()) while the current isn't negative.  Single samples of torque and current
+are noisy, so SlackDetector keeps the last window samples of (t, va,
+uia, trq, rpa) in a ring, along with each sample's torque residual over
+the threshold, and declares slack when the mean residual is above zero
+by z standard errors and the mean current is above the current
+threshold.  With a window of 1 that is the original single-sample test.
+
+Sums over the window are updated as samples come and go, so update()
+costs the same whatever the window.  stats() gives the mean, variance
+and slope against time of each column, for logging.
+
+The detector doesn't care where samples come from, so it can be run
+over a capture of the winch port (see transport.py) to try out other
+settings against recorded casts:
+
+usage: python slack.py capture.cap [window [z]]
+  prints each point where the detector would have found slack
+"""
+import sys
+import numpy as np
+
+import telemetry
+import transport
+
+# columns of the ring
+COLUMNS = ['t','va','uia','trq','rpa','resid']
+T,VA,UIA,TRQ,RPA,RESID = range(len(COLUMNS))
+
+def torque_thresh(va,coeffs,torque_min):
+    """ torque above which the line is taken to be slack at motor speed
+    va: coeffs[0]*va + coeffs[1], but at least torque_min
+    """
+    return max(torque_min,coeffs[0]*va + coeffs[1])
+
+class SlackDetector(object):
+    # recompute the sums from scratch this often, so rounding errors
+    # don't build up
+    refresh = 1000
+
+    def __init__(self,window,z,current_threshold,torque_coeffs,torque_min):
+        self.window = int(window)
+        self.z = z
+        self.current_threshold = current_threshold
+        self.torque_coeffs = torque_coeffs
+        self.torque_min = torque_min
+        self.ring = np.zeros( (self.window,len(COLUMNS)), np.float64)
+        self.reset()
+
+    @classmethod
+    def for_winch(cls,winch):
+        """ a detector with the settings of an AnimaticsWinch
+        """
+        return cls(window=winch.slack_window,z=winch.slack_z,
+                   current_threshold=winch.slack_current_threshold,
+                   torque_coeffs=winch.torque_thresh_coeffs,
+                   torque_min=winch.torque_thresh_min)
+
+    def reset(self):
+        """ forget all samples, e.g. when the motor changes mode
+        """
+        self.n = 0
+        self.idx = 0
+        self.count = 0
+        self.t0 = None
+        self.sums = np.zeros(len(COLUMNS))
+        self.sumsq = np.zeros(len(COLUMNS))
+        # sum of t*x, for the slope
+        self.sum_tx = np.zeros(len(COLUMNS))
+
+    def torque_thresh(self,va):
+        return torque_thresh(va,self.torque_coeffs,self.torque_min)
+
+    def update(self,t,va,uia,trq,rpa):
+        """ add a sample, and return True if the line appears slack
+        """
+        if self.t0 is None:
+            self.t0 = t
+        row = np.array([t-self.t0,va,uia,trq,rpa,trq-self.torque_thresh(va)])
+        if self.n == self.window:
+            old = self.ring[self.idx]
+            self.sums -= old
+            self.sumsq -= old*old
+            self.sum_tx -= old[T]*old
+        else:
+            self.n += 1
+        self.ring[self.idx] = row
+        self.sums += row
+        self.sumsq += row*row
+        self.sum_tx += row[T]*row
+        self.idx = (self.idx+1) % self.window
+        self.count += 1
+        if self.count % self.refresh == 0:
+            self.resum()
+        return self.slack()
+
+    def resum(self):
+        rows = self.ring[:self.n]
+        self.sums = rows.sum(axis=0)
+        self.sumsq = (rows*rows).sum(axis=0)
+        self.sum_tx = (rows[:,T:T+1]*rows).sum(axis=0)
+
+    def mean(self):
+        return self.sums/self.n
+
+    def variance(self):
+        """ sample variance of each column, 0 with fewer than 2 samples
+        """
+        if self.n < 2:
+            return np.zeros(len(COLUMNS))
+        var = (self.sumsq - self.sums*self.sums/self.n)/(self.n-1)
+        return np.maximum(var,0.0)
+
+    def slope(self):
+        """ least squares slope of each column against t, per second
+        """
+        denom = self.n*self.sumsq[T] - self.sums[T]**2
+        if self.n < 2 or denom <= 0:
+            return np.zeros(len(COLUMNS))
+        return (self.n*self.sum_tx - self.sums[T]*self.sums)/denom
+
+    def slack(self):
+        """ True once the window is full and the current and torque
+        residual say the line is slack
+        """
+        if self.n < self.window:
+            return False
+        mean = self.mean()
+        if mean[UIA] <= self.current_threshold:
+            return False
+        stderr = np.sqrt(self.variance()[RESID]/self.n)
+        return mean[RESID] > self.z*stderr
+
+    def stats(self):
+        """ dict of column: (mean,variance,slope)
+        """
+        if self.n == 0:
+            return {}
+        mean,var,slope = self.mean(),self.variance(),self.slope()
+        return dict( (col,(mean[i],var[i],slope[i])) for i,col in enumerate(COLUMNS) )
+
+    def describe(self):
+        st = self.stats()
+        if not st:
+            return "no samples"
+        return "%d samples, UIA %.0f, TRQ %.0f (%+.0f/s), residual %.0f+-%.0f"%(
+            self.n,st['uia'][0],st['trq'][0],st['trq'][2],
+            st['resid'][0],np.sqrt(st['resid'][1]))
+
+    def replay(self,samples):
+        """ run the detector over samples, a structured array with fields
+        t, va, uia, trq and rpa (e.g. from TelemetryRing.recent() or
+        capture_samples()).  Returns a boolean array, True where it
+        would have declared slack.
+        """
+        return np.array([self.update(s['t'],s['va'],s['uia'],s['trq'],s['rpa'])
+                         for s in samples],dtype=bool)
+
+
+STATUS_FIELDS = ('sw0','va','uia','trq','rpa')
+sample_dtype = [('t','f8')] + [(f,'i8') for f in STATUS_FIELDS]
+
+def capture_samples(path,cmd_ver='new'):
+    """ the status samples the servo loop saw in a capture of the winch
+    port - telemetry stream records, and the responses to the status
+    query from AnimaticsWinch.read_status().  Returns a structured
+    array with sample_dtype.
+    """
+    q = telemetry.compile_query(STATUS_FIELDS,cmd_ver)
+    # for each write still waiting on responses: [responses left,
+    # index of the first status response or None]
+    expected = []
+    samples = []
+    status = []
+    partial = ""
+    for kind,t,data in transport.read_capture(path):
+        if kind == 'W':
+            # each PRINT(...) answers with a line per #13, the rest
+            # with a line per command
+            nresp = data.count("\r") - data.count("PRINT(") + data.count("#13")
+            if nresp:
+                first = nresp-q.nresp if data.endswith(q.cmd) else None
+                expected.append([nresp,first])
+        elif kind == 'R':
+            lines = (partial+data).split("\r")
+            partial = lines.pop()
+            for line in lines:
+                if line.startswith(telemetry.STREAM_PREFIX):
+                    rec = dict(zip(telemetry.STREAM_FIELDS,telemetry.parse_stream_record(line)))
+                    samples.append( (t,) + tuple(rec[f] for f in STATUS_FIELDS) )
+                    continue
+                if not expected:
+                    continue
+                nresp,first = expected[0]
+                if first is not None and first <= 0:
+                    status.append(line)
+                expected[0][0] -= 1
+                if first is not None:
+                    expected[0][1] -= 1
+                if expected[0][0] == 0:
+                    expected.pop(0)
+                    if status:
+                        try:
+                            samples.append( (t,) + tuple(q.parse(status)) )
+                        except ValueError:
+                            pass
+                    status = []
+    return np.array(samples,dtype=sample_dtype)
+
+if __name__ == '__main__':
+    import aniwinch
+    W = aniwinch.AnimaticsWinch
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else W.slack_window
+    z = float(sys.argv[3]) if len(sys.argv) > 3 else W.slack_z
+    samples = capture_samples(sys.argv[1])
+    det = SlackDetector(window,z,W.slack_current_threshold,
+                        W.torque_thresh_coeffs,W.torque_thresh_min)
+    slack = det.replay(samples)
+    # only report the start of each run of slack samples
+    starts = np.nonzero(slack & ~np.r_[False,slack[:-1]])[0]
+    print "%d samples, slack in %d, %d detections"%(len(samples),slack.sum(),len(starts))
+    for i in starts:
+        s = samples[i]
+        print "  t=%8.2f  VA=%8d UIA=%5d TRQ=%6d RPA=%9d"%(s['t'],s['va'],s['uia'],s['trq'],s['rpa'])
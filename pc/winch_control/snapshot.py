@@ -0,0 +1,130 @@
+"""
+snapshot
+
+Everything the GUI shows about the winch, Humminbird and GPIO, as one
+record, so that readers never wait on a serial port or the winch lock.
+
+A single producer, SnapshotPublisher, reads the devices at a fixed
+rate in its own thread, builds a new Snapshot, and publishes it by
+replacing publisher.latest.  Assigning a reference is atomic, so a
+reader takes publisher.latest and reads its fields with no lock, and
+never sees a half-updated record.  Snapshots can't be changed once
+built.  seq counts published snapshots, so a consumer can tell
+whether anything is new since the last one it looked at.
+"""
+import threading
+import logging
+
+import clock
+import scheduler
+
+class Snapshot(object):
+    __slots__ = ('seq','t',
+                 # winch
+                 'cable_out','cable_revs','cable_speed','current','torque',
+                 'winch_action','comm_summary','loop_summary',
+                 # humminbird
+                 'depth','gps_velocity',
+                 # gpio, and the CTD
+                 'gpio_in','gpio_out','ctd_action')
+
+    def __init__(self,**fields):
+        for name in self.__slots__:
+            object.__setattr__(self,name,fields.get(name))
+
+    def __setattr__(self,name,value):
+        raise AttributeError("Snapshot is read-only")
+
+    def fields(self):
+        return dict( (name,getattr(self,name)) for name in self.__slots__ )
+
+    def replace(self,**fields):
+        """ a new snapshot with fields changed
+        """
+        new = self.fields()
+        new.update(fields)
+        return Snapshot(**new)
+
+
+class SnapshotPublisher(object):
+    """ publishes a Snapshot of ctd (a ctd.CTD) rate times a second
+    """
+    def __init__(self,ctd,rate=5.0,clk=None):
+        self.ctd = ctd
+        self.rate = rate
+        self.clock = clk or clock.get_clock()
+        self.log = logging.getLogger('snap')
+        self.latest = Snapshot(seq=0)
+        # sources whose last read failed, so each failure is logged once
+        self.failing = set()
+        self.running = False
+        self.thread = None
+
+    def newer(self,seq):
+        """ the latest snapshot if it is newer than seq, otherwise None
+        """
+        snap = self.latest
+        if snap.seq > seq:
+            return snap
+        return None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2.0/self.rate)
+            self.thread = None
+
+    def run(self):
+        sched = scheduler.FixedRate(self.rate,clk=self.clock)
+        while self.running:
+            sched.tick()
+            self.publish()
+
+    # each reads one device into a dict of fields.  A device that fails
+    # keeps its fields from the previous snapshot.
+    def winch_fields(self):
+        winch = self.ctd.winch
+        cable_out,cable_revs = winch.get_cable_out(1.0,extra=True,accuracy=0.05)
+        return dict(cable_out=cable_out,cable_revs=cable_revs,
+                    cable_speed=winch.get_velocity(1.0,accuracy=0.02),
+                    current=winch.get_current(1.0),
+                    torque=winch.get_torque(1.0),
+                    winch_action=winch.async_action,
+                    comm_summary=winch.comm_stats.summary(),
+                    loop_summary=winch.loop_stats.summary())
+
+    def monitor_fields(self):
+        monitor = self.ctd.monitor
+        return dict(depth=monitor.maxDepth,gps_velocity=monitor.velocity)
+
+    def gpio_fields(self):
+        gpio = self.ctd.gpio()
+        # a GPIO-triggered mode is already reading the port
+        if self.ctd.async_action is None:
+            gpio_in = gpio.cast_signal()
+        else:
+            gpio_in = gpio.last_signal_in
+        return dict(gpio_in=gpio_in,gpio_out=gpio.last_signal_out,
+                    ctd_action=self.ctd.async_action)
+
+    def publish(self):
+        prev = self.latest
+        fields = {}
+        for source in (self.winch_fields,self.monitor_fields,self.gpio_fields):
+            name = source.__name__
+            try:
+                fields.update(source())
+            except Exception as exc:
+                if name not in self.failing:
+                    self.log.warning("%s failed: %s"%(name,exc))
+                self.failing.add(name)
+            else:
+                self.failing.discard(name)
+        self.latest = prev.replace(seq=prev.seq+1,t=self.clock.time(),**fields)
+        return self.latest
@@ -0,0 +1,123 @@
+"""
+spool
+
+Geometry of the drum and wire, and the motor units, as one object with
+the coefficients worked out up front.  Every conversion takes a scalar
+or a numpy array and returns the same, so that log analysis and
+fitting can convert whole columns at once.
+
+Positions are motor encoder counts from a full spool (RPA, PT),
+velocities are VT/VA units (counts per sample * 65536), and forces are
+torque (T, TRQ) units.  Wire out accounts for the radius shrinking as
+wire comes off the drum:
+  m = 2 pi revs R - pi revs**2 wire_area/spool_width
+and wire speed conversions take the counts to evaluate the radius at.
+
+SpoolModel.for_winch() takes the dimensions from an AnimaticsWinch, or
+the class itself, so no serial port is needed:
+  sp = spool.SpoolModel.for_winch(aniwinch.AnimaticsWinch)
+  m = sp.counts_to_m(rpa_column)
+"""
+import numpy as np
+
+class SpoolModel(object):
+    # attributes of AnimaticsWinch which make up the model, in the
+    # order of the constructor arguments
+    winch_attrs = ('enc_count','gear_box_ratio','spool_radius_outer',
+                   'spool_width','wire_area','spool_revolutions_full',
+                   'vt_max','srate','cmd_ver')
+
+    def __init__(self,enc_count,gear_box_ratio,spool_radius_outer,
+                 spool_width,wire_area,spool_revolutions_full=None,
+                 vt_max=None,srate=8000,cmd_ver='523'):
+        self.enc_count = enc_count
+        self.gear_box_ratio = gear_box_ratio
+        self.spool_radius_outer = spool_radius_outer
+        self.spool_width = spool_width
+        self.wire_area = wire_area
+        self.spool_revolutions_full = spool_revolutions_full
+        self.vt_max = vt_max
+        self.srate = srate
+        self.cmd_ver = cmd_ver
+
+        self.counts_per_rev = float(enc_count)*gear_box_ratio
+        # radius lost per revolution of wire paid out
+        self.dr_drev = wire_area/spool_width
+        # m = -(quad_a revs**2 + quad_b revs)
+        self.quad_a = np.pi*self.dr_drev
+        self.quad_b = -2*np.pi*spool_radius_outer
+        # VT for 1 m/s on a full spool.  The 2 is totally empirical.
+        self.vt_per_mps = (2*float(enc_count)/srate*65536.0*gear_box_ratio
+                           / (2*np.pi*spool_radius_outer))
+        # torque of 35 balances a 5lb weight on the old motor, and the
+        # new one has a different range.  kg, not a force, but who
+        # knows the weight of their rig in Newtons??
+        if cmd_ver == 'old':
+            self.trq_per_kg = 2.2*35./5.
+        else:
+            self.trq_per_kg = 2.2*2000./5.
+        if spool_revolutions_full is not None:
+            self.wire_end = self.revs_to_m(spool_revolutions_full)
+        else:
+            self.wire_end = None
+
+    @classmethod
+    def for_winch(cls,winch):
+        return cls(*[getattr(winch,attr) for attr in cls.winch_attrs])
+
+    def key(self):
+        return tuple(getattr(self,attr) for attr in self.winch_attrs)
+
+    ## position
+    def counts_to_revs(self,counts):
+        return np.asarray(counts,np.float64)/self.counts_per_rev
+    def revs_to_counts(self,revs):
+        return np.asarray(revs,np.float64)*self.counts_per_rev
+
+    def revs_to_m(self,revs):
+        revs = np.asarray(revs,np.float64)
+        return -(self.quad_a*revs + self.quad_b)*revs
+    def counts_to_m(self,counts):
+        return self.revs_to_m(self.counts_to_revs(counts))
+
+    def m_to_revs(self,m):
+        """ the smaller root of the quadratic - the larger one is so much
+        wire out that the radius has gone negative.  nan past that point.
+        """
+        disc = self.quad_b**2 - 4*self.quad_a*np.asarray(m,np.float64)
+        return (-self.quad_b - np.sqrt(disc)) / (2*self.quad_a)
+    def m_to_counts(self,m):
+        return self.revs_to_counts(self.m_to_revs(m))
+
+    def radius(self,counts):
+        """ radius of the wire leaving the drum at counts
+        """
+        return self.spool_radius_outer - self.counts_to_revs(counts)*self.dr_drev
+    def radius_to_counts(self,r):
+        return self.revs_to_counts((self.spool_radius_outer - np.asarray(r,np.float64))
+                                   / self.dr_drev)
+
+    ## velocity
+    def mps_to_vt(self,mps,clip=True,counts=0.0):
+        """ wire speed to VT with the drum at counts, i.e. at the
+        radius there.  The default is a full spool.
+        """
+        vt = (np.asarray(mps,np.float64)*self.vt_per_mps
+              * self.spool_radius_outer/self.radius(counts))
+        if clip and self.vt_max is not None:
+            vt = np.clip(vt,-self.vt_max,self.vt_max)
+        return vt
+    def vt_to_mps(self,vt,counts=0.0):
+        """ VT or VA to wire speed with the drum at counts.  For VA this
+        is AnimaticsWinch.read_motor_velocity() - half the speed that
+        VA in counts/s works out to, but it matches the commanded
+        velocity.
+        """
+        return (np.asarray(vt,np.float64)/self.vt_per_mps
+                * self.radius(counts)/self.spool_radius_outer)
+
+    ## force
+    def kg_to_trq(self,kg):
+        return np.asarray(kg,np.float64)*self.trq_per_kg
+    def trq_to_kg(self,trq):
+        return np.asarray(trq,np.float64)/self.trq_per_kg
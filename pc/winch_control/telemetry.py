@@ -0,0 +1,324 @@
+"""
+telemetry
+
+Compile a request for a set of motor variables into a single command
+string for the winch, and parse the responses into a record.
+
+Variables which can be PRINTed are gathered into one PRINT(...)
+statement, and the rest use their report commands, so that any
+combination costs a single round trip through AnimaticsWinch.msg().
+
+Also the motor-pushed telemetry stream: a resident SmartMotor program
+prints status records at a fixed rate, and TelemetryRing holds the
+parsed records for the control loop and GUI.  The same program can run
+a cast profile on the motor.
+
+TelemetryCache keeps the latest value of the fields the GUI shows, so
+that a stale read of any of them refreshes all of them at once.
+"""
+import collections
+import threading
+import time
+import logging
+
+import numpy as np
+
+# name: (PRINT variable, report command, type)
+# exactly one of the PRINT variable or report command is given, and
+# the order here is the order in which they appear in the compiled
+# command.
+VARIABLES = collections.OrderedDict([
+    ('sw0',  (None,  'RW(0)', int)), # status word 0
+    ('va',   ('VA',  None,    int)), # velocity actual
+    ('pa',   ('PA',  None,    int)), # position actual
+    ('uia',  ('UIA', None,    int)), # current
+    ('trq',  ('TRQ', None,    int)), # torque
+    ('rpa',  (None,  'RPA',   int)), # position actual
+    ('rtrq', (None,  'RTRQ',  int)), # torque
+    ('clk',  (None,  'RCLK',  int)), # clock, ms
+    ])
+
+# report commands which differ on older firmware
+OLD_REPORTS = {'rpa':'RP'}
+
+
+class TelemetryQuery(object):
+    """ a compiled query - cmd is sent with nresp expected responses,
+    and parse() turns the responses into a namedtuple with fields in
+    the order the variables were named.
+    """
+    def __init__(self,names,cmd_ver):
+        self.names = tuple(names)
+        for name in self.names:
+            if name not in VARIABLES:
+                raise Exception("Unknown telemetry variable %s"%name)
+        self.record = collections.namedtuple('Telemetry',self.names)
+
+        # the PRINT variables are contiguous in VARIABLES, so walking
+        # it in order gives the order in which responses come back
+        parts = []
+        printed = []
+        order = []
+        for name,(print_var,report,typ) in VARIABLES.items():
+            if name not in self.names:
+                continue
+            if print_var is not None:
+                if not printed:
+                    parts.append(None) # placeholder for the PRINT
+                printed.append(print_var+",#13")
+            else:
+                if cmd_ver=='old':
+                    report = OLD_REPORTS.get(name,report)
+                parts.append(report+"\r")
+            order.append(name)
+        if printed:
+            parts[parts.index(None)] = "PRINT(%s)\r"%(",".join(printed))
+        self.cmd = "".join(parts)
+        self.nresp = len(order)
+        self.slots = [(self.names.index(name),name,VARIABLES[name][2])
+                      for name in order]
+
+    def parse(self,responses):
+        if len(responses) != self.nresp:
+            raise ValueError("Expected %d responses, got %d"%(self.nresp,len(responses)))
+        vals = [None]*len(self.names)
+        for (slot,name,typ),resp in zip(self.slots,responses):
+            try:
+                vals[slot] = typ(resp)
+            except ValueError:
+                raise ValueError("Failed to parse %s from '%s'"%(name,resp))
+        return self.record(*vals)
+
+# compiled queries, keyed by (names,cmd_ver)
+queries = {}
+
+def compile_query(names,cmd_ver):
+    key = (tuple(names),cmd_ver)
+    try:
+        return queries[key]
+    except KeyError:
+        q = queries[key] = TelemetryQuery(names,cmd_ver)
+        return q
+
+
+## Motor-pushed telemetry stream
+
+# SmartMotor user program, which has to be downloaded to the motor once
+# with SMI.  RUN with m=0 runs the telemetry stream, printing a status
+# record every a milliseconds - AnimaticsWinch.start_stream() sets a and
+# starts it.  RUN with m=1 runs the cast sequencer: a position move to t
+# through a speed profile compiled by profiles.py, s segments with VT f,
+# g, h and i, switching to the next segment as PA passes j, k and l.  It
+# prints records every a ms if a>0, and when the move is done carries on
+# with the stream, or ends if a=0.
+RESIDENT_PROGRAM = """
+' resident program for aniwinch.py
+' $T,status word,VA,PA,UIA,TRQ,CLK
+IF m==1
+  GOTO(20)
+ENDIF
+C10
+  PRINT("$T,",W(0),",",VA,",",PA,",",UIA,",",TRQ,",",CLK,#13)
+  WAIT=a
+GOTO(10)
+C20
+  u=-1
+  z=CLK
+  MP
+C21
+  n=0
+  IF s>1
+    IF PA>=j
+      n=1
+    ENDIF
+  ENDIF
+  IF s>2
+    IF PA>=k
+      n=2
+    ENDIF
+  ENDIF
+  IF s>3
+    IF PA>=l
+      n=3
+    ENDIF
+  ENDIF
+  IF n!=u
+    u=n
+    IF n==0
+      VT=f
+    ENDIF
+    IF n==1
+      VT=g
+    ENDIF
+    IF n==2
+      VT=h
+    ENDIF
+    IF n==3
+      VT=i
+    ENDIF
+    PT=t
+    G
+  ENDIF
+  IF a>0
+    IF CLK-z>=a
+      PRINT("$T,",W(0),",",VA,",",PA,",",UIA,",",TRQ,",",CLK,#13)
+      z=CLK
+    ENDIF
+  ENDIF
+  IF B(0,2)==0
+    IF a>0
+      GOTO(10)
+    ENDIF
+    END
+  ENDIF
+GOTO(21)
+END
+"""
+
+# most segments the cast sequencer handles
+CAST_SEGMENTS = 4
+
+def cast_variables(profile,target_position):
+    """ assignments which set up the cast sequencer in RESIDENT_PROGRAM
+    to run the profiles.CompiledProfile profile to target_position
+    """
+    if len(profile.vts) > CAST_SEGMENTS:
+        raise Exception("Cast sequencer handles at most %d segments"%CAST_SEGMENTS)
+    parts = ["s=%d"%len(profile.vts),"t=%d"%target_position]
+    parts += ["%s=%d"%(var,vt) for var,vt in zip('fghi',profile.vts)]
+    parts += ["%s=%d"%(var,rpa) for var,rpa in zip('jkl',profile.breaks)]
+    return " ".join(parts) + " "
+
+STREAM_PREFIX = "$T,"
+STREAM_FIELDS = ['sw0','va','rpa','uia','trq','clk']
+
+def parse_stream_record(line):
+    """ parse one line of the telemetry stream into a list of ints,
+    ordered as STREAM_FIELDS.
+    """
+    vals = [int(s) for s in line[len(STREAM_PREFIX):].split(',')]
+    if len(vals) != len(STREAM_FIELDS):
+        raise ValueError("Bad telemetry record '%s'"%line)
+    return vals
+
+
+class TelemetryRing(object):
+    """ preallocated ring buffer of telemetry records, filled by a
+    single producer (the winch I/O thread) and read by anyone.
+    Each record has the PC time 't' it was received, and the fields
+    in STREAM_FIELDS.
+    """
+    def __init__(self,size=4096):
+        self.size = size
+        self.data = np.zeros(size,dtype=[('t','f8')] + [(f,'i8') for f in STREAM_FIELDS])
+        # number of records ever appended
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def append(self,t,vals):
+        with self.cond:
+            self.data[self.seq % self.size] = tuple([t] + vals)
+            self.seq += 1
+            self.cond.notify_all()
+
+    def latest(self):
+        """ the most recent record, or None if nothing has come in
+        """
+        with self.cond:
+            if self.seq == 0:
+                return None
+            return self.data[(self.seq-1) % self.size].copy()
+
+    def wait_newer(self,seq,timeout=None):
+        """ wait for a record newer than sequence number seq, and return
+        (sequence number, record).  On timeout returns (seq,None).
+        """
+        deadline = time.time() + (timeout or 0.0)
+        with self.cond:
+            while self.seq <= seq:
+                remaining = deadline - time.time()
+                if timeout is not None and remaining <= 0:
+                    return seq,None
+                self.cond.wait(remaining if timeout is not None else None)
+            return self.seq,self.data[(self.seq-1) % self.size].copy()
+
+    def recent(self,n=None):
+        """ up to n of the most recent records, oldest first
+        """
+        with self.cond:
+            count = min(self.seq,self.size)
+            if n is not None:
+                count = min(n,count)
+            idxs = np.arange(self.seq-count,self.seq) % self.size
+            return self.data[idxs]
+
+
+class TelemetryCache(object):
+    """ latest value of each field and when it was set.  A get() older
+    than the age asked for calls refresh(age), which should set() every
+    field, typically from one query.  Only one refresh runs at a time -
+    a thread wanting a refresh while another is running waits for that
+    one to finish and takes its values, or its exception if it failed.
+    """
+    def __init__(self,fields,refresh,clk):
+        self.refresh = refresh
+        self.clock = clk
+        self.log = logging.getLogger('cache')
+        self.cond = threading.Condition()
+        self.values = dict( (field,(0,0)) for field in fields )
+        self.refreshing = False
+        # exception raised by the last refresh, for the threads which
+        # joined it
+        self.refresh_exc = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        # misses which waited on a refresh already running
+        self.joined = 0
+        self.failures = 0
+
+    def set(self,field,val):
+        with self.cond:
+            self.values[field] = (val,self.clock.time())
+
+    def get(self,field,age=0.0):
+        with self.cond:
+            val,t = self.values[field]
+            if self.clock.time() - t <= age:
+                self.hits += 1
+                return val
+            self.misses += 1
+            if self.refreshing:
+                self.joined += 1
+                while self.refreshing:
+                    self.cond.wait()
+                if self.refresh_exc is not None:
+                    raise self.refresh_exc
+                return self.values[field][0]
+            self.refreshing = True
+            self.refresh_exc = None
+        try:
+            self.refresh(age)
+        except Exception as exc:
+            with self.cond:
+                self.failures += 1
+                self.refresh_exc = exc
+            raise
+        finally:
+            with self.cond:
+                self.refreshing = False
+                self.refreshes += 1
+                self.cond.notify_all()
+        with self.cond:
+            return self.values[field][0]
+
+    def summary(self):
+        total = self.hits + self.misses
+        return "%d reads, %.0f%% hits, %d refreshes, %d joined, %d failed"%(
+            total,100.0*self.hits/max(1,total),self.refreshes,self.joined,self.failures)
+
+    def dump(self):
+        self.log.info("telemetry cache: %s"%self.summary())
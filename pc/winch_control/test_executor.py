@@ -0,0 +1,48 @@
+"""
+async.Executor: a cancel_all() must reach every action it doesn't drop
+from the queue, however it lands against the worker taking the action
+off the queue.
+
+usage: python test_executor.py
+"""
+import threading
+import time
+from async import Executor,OperationAborted
+
+# widen the window between the worker taking an action off the queue
+# and the action starting, where a cancel_all() used to go missing
+plain_action=Executor.action
+def slow_action(self,token=None):
+    time.sleep(0.001)
+    return plain_action(self,token)
+Executor.action=slow_action
+
+executor=Executor('test')
+ran=[]
+# set once cancel_all() has returned
+cancelled=threading.Event()
+
+def action():
+    ran.append(1)
+    cancelled.wait()
+    executor.check()
+    return 'finished'
+
+escaped=0
+runs=500
+for i in range(runs):
+    cancelled.clear()
+    future=executor.submit('action',action)
+    # let the worker get part way to running it
+    for j in range(i%50):
+        pass
+    executor.cancel_all(OperationAborted(cleanup=False))
+    cancelled.set()
+    future.wait()
+    if future.exception() is None:
+        escaped+=1
+executor.shutdown()
+
+print "%d actions, %d started, %d finished after cancel_all"%(runs,len(ran),escaped)
+assert escaped==0, "%d actions escaped cancel_all"%escaped
+print "OK"
@@ -57,7 +57,7 @@ try:
             for n in range(10):
                 time.sleep(0.2)
                 # Query current, torque, speed
-                uia,va,rtrq,rpa=winch.msg("PRINT(UIA,#13,VA,#13)\rRTRQ\rRPA\r",nresp=4)
+                uia,va,rtrq,rpa=winch.query('uia','va','rtrq','rpa')
                 rec= dict(uia=uia,rtrq=rtrq,rpa=rpa,
                           spd_ms=spd_ms,spd_winch=spd_winch,va=va) 
                 recs.append(rec)
@@ -167,7 +167,7 @@ def velocity_torque_move(velocity,max_pause=2.0):
                     winch.log.info('Idle too long.')
                     break
             elif mode=='servo':
-                va,uia,rtrq=[float(s) for s in winch.msg('PRINT(VA,#13,UIA,#13,TRQ,#13) ',nresp=3)]
+                va,uia,rtrq=[float(s) for s in winch.query('va','uia','trq')]
                 thresh=torque_thresh(va)
                 # if it's working to go this fast, then revert to free-wheel
                 # to avoid overhauling the line.
@@ -0,0 +1,32 @@
+"""
+A cast on the simulated winch (winch_sim) with a simulated clock, which
+should run well ahead of wall time, pay out to the target depth and
+bring the cable back in.
+
+usage: python test_sim_clock.py
+"""
+import time
+import winch_settings
+winch_settings.set_location('sim')
+import clock
+clk=clock.SimClock()
+clock.set_clock(clk)
+import aniwinch
+
+depth=20.0
+t_start=time.time()
+winch=aniwinch.AnimaticsWinch()
+# ctd_cast(), in two halves to see how far out it got
+winch.ctd_out(depth,block=True)
+cable_max=winch.read_cable_out()
+winch.ctd_in(block=True)
+elapsed=time.time()-t_start
+cable_out=winch.read_cable_out()
+winch.close()
+
+print "cast to %.1fm took %.2fs wall, %.2fs simulated, max cable out %.2fm, cable out %.2fm"%(depth,elapsed,clk.time(),
+                                                                                        cable_max,cable_out)
+assert abs(cable_max-depth) < 1.0, "cast only paid out %.2fm"%cable_max
+assert clk.time() > 5*elapsed, "simulated clock didn't run ahead of real time"
+assert abs(cable_out) < 0.05, "cable not back in: %.2fm"%cable_out
+print "OK"
@@ -0,0 +1,239 @@
+"""
+trajectory
+
+Trapezoidal motion profiles as the motor's trajectory generator plans
+them for MP and MV, in encoder counts and seconds, and an estimator
+which dead-reckons the motor from its last sample along the commanded
+trajectory.
+
+winch_sim drives the simulated drum with the profiles.
+TrajectoryEstimator follows the commands sent to the motor and the
+position and velocity samples read back, and extrapolates to any time
+with a bound on the error.  The bound grows with the time since the
+last sample: slowly while the motor is following a known MP or MV,
+quickly when it is free-wheeling, in torque mode or running the
+resident program, since then nothing says what the drum will do.
+"""
+import math
+import threading
+import numpy as np
+
+class Profile(object):
+    """ motion as a series of constant-acceleration phases, in counts
+    and seconds from t0.  After the last phase the velocity is held.
+    """
+    def __init__(self,t0,p0,v0):
+        self.t0 = t0
+        self.starts = [0.0]
+        self.pos = [p0]
+        self.vel = [v0]
+        self.acc = []
+
+    def end(self):
+        return self.pos[-1],self.vel[-1]
+
+    def add(self,dur,acc):
+        if dur <= 0:
+            return
+        p,v = self.end()
+        self.starts.append(self.starts[-1] + dur)
+        self.pos.append(p + v*dur + 0.5*acc*dur**2)
+        self.vel.append(v + acc*dur)
+        self.acc.append(acc)
+
+    def finish(self,p_end=None,v_end=None):
+        """ call after the last phase.  p_end, v_end: snap the final
+        state to exact values, hiding rounding in the phases
+        """
+        if p_end is not None:
+            self.pos[-1] = p_end
+        if v_end is not None:
+            self.vel[-1] = v_end
+        self.acc.append(0.0)
+        self.t_end = self.t0 + self.starts[-1]
+        self.starts = np.array(self.starts)
+        self.pos = np.array(self.pos)
+        self.vel = np.array(self.vel)
+        self.acc = np.array(self.acc)
+        return self
+
+    def evaluate(self,t):
+        """ position, velocity, acceleration at the array of times t
+        """
+        t = t - self.t0
+        idx = np.maximum(np.searchsorted(self.starts,t,side='right') - 1,0)
+        dt = t - self.starts[idx]
+        acc = self.acc[idx]
+        vel = self.vel[idx] + acc*dt
+        pos = self.pos[idx] + self.vel[idx]*dt + 0.5*acc*dt**2
+        return pos,vel,acc
+
+def plan_velocity(t0,p0,v0,vt,acc,dec):
+    """ MV - ramp from v0 to vt, stopping first if that means a change
+    of direction.
+    """
+    prof = Profile(t0,p0,v0)
+    if v0 != 0 and (vt == 0 or (vt > 0) != (v0 > 0)):
+        prof.add(abs(v0)/dec,-math.copysign(dec,v0))
+        v0 = 0.0
+    if vt != v0:
+        rate = acc if abs(vt) > abs(v0) else dec
+        prof.add(abs(vt-v0)/rate,math.copysign(rate,vt-v0))
+    return prof.finish(v_end=vt)
+
+def plan_position(t0,p0,v0,pt,vt,acc,dec):
+    """ MP - trapezoid (or triangle) from p0 to a stop at pt.  If the
+    motor is moving away from pt, or too fast to stop in time, it stops
+    first and then comes back.
+    """
+    prof = Profile(t0,p0,v0)
+    vt = abs(vt)
+    for it in range(4):
+        p,v = prof.end()
+        dist = pt - p
+        if v != 0 and ((v > 0) != (dist > 0) or v*v/(2*dec) > abs(dist)):
+            prof.add(abs(v)/dec,-math.copysign(dec,v))
+            continue
+        if dist == 0:
+            break
+        s = math.copysign(1,dist)
+        dist = abs(dist)
+        u = s*v
+        if u > vt:
+            prof.add((u-vt)/dec,-s*dec)
+            continue
+        v_peak = math.sqrt((dist + u*u/(2*acc)) / (1/(2*acc) + 1/(2*dec)))
+        v_c = min(vt,v_peak)
+        prof.add((v_c-u)/acc,s*acc)
+        cruise = dist - (v_c*v_c - u*u)/(2*acc) - v_c*v_c/(2*dec)
+        if v_c > 0:
+            prof.add(cruise/v_c,0.0)
+        prof.add(v_c/dec,-s*dec)
+        break
+    return prof.finish(p_end=pt,v_end=0.0)
+
+
+class TrajectoryEstimator(object):
+    """ position in counts and velocity in counts/s, from samples and
+    the command strings sent to the motor.
+    srate: motor sample rate, for the units of VT, AT and DT
+    tracking_acc: counts/s**2 the motor may stray from a known
+      trajectory
+    free_acc: counts/s**2 it may change speed by when the trajectory
+      isn't known
+    """
+    # sample times are when the PC got the response, up to this long
+    # after the motor took the reading
+    stamp_error = 0.02
+    # AT or DT of 0 is taken as an instant change
+    instant_acc = 1e12
+
+    def __init__(self,srate,tracking_acc,free_acc):
+        self.srate = srate
+        self.tracking_acc = tracking_acc
+        self.free_acc = free_acc
+        self.lock = threading.Lock()
+        # as last assigned, in motor units
+        self.vars = dict(AT=0,DT=0,VT=0,PT=0)
+        # MP, MV or MT, as selected for the next G
+        self.next_mode = None
+        # the move in progress, ('MP',pt,vt,acc,dec) or ('MV',None,vt,acc,dec)
+        # in counts and seconds.  None when unknown
+        self.move = None
+        self.t0 = None
+        self.anchor(0.0,0.0,0.0,0.0,0.0)
+
+    def anchor(self,t,pos,vel,pos_err,vel_err):
+        """ restart the estimate from a known state at t
+        """
+        self.t0 = t
+        self.pos_err = pos_err
+        self.vel_err = vel_err
+        if self.move is None:
+            self.profile = Profile(t,pos,vel).finish()
+        elif self.move[0] == 'MP':
+            kind,pt,vt,acc,dec = self.move
+            self.profile = plan_position(t,pos,vel,pt,vt,acc,dec)
+        else:
+            kind,pt,vt,acc,dec = self.move
+            self.profile = plan_velocity(t,pos,vel,vt,acc,dec)
+
+    def estimate(self,t):
+        """ (position,velocity,position error,velocity error) at t
+        """
+        with self.lock:
+            return self._estimate(t)
+
+    def _estimate(self,t):
+        age = max(0.0,t - self.t0)
+        pos,vel,acc = self.profile.evaluate(max(t,self.t0))
+        acc_err = self.free_acc if self.move is None else self.tracking_acc
+        return (float(pos),float(vel),
+                self.pos_err + self.vel_err*age + 0.5*acc_err*age**2,
+                self.vel_err + acc_err*age)
+
+    def observe(self,t,pos,vel=None):
+        """ a sample of position, and optionally velocity, in counts and
+        counts/s, taken at t
+        """
+        with self.lock:
+            if vel is None:
+                est_pos,vel,pos_err,vel_err = self._estimate(t)
+            else:
+                vel_err = 0.0
+            self.anchor(t,pos,vel,abs(vel)*self.stamp_error,vel_err)
+
+    def from_va(self,va):
+        return va*self.srate/65536.0
+    def from_at(self,at):
+        return at*self.srate**2/65536.0 or self.instant_acc
+
+    def command(self,txt,t):
+        """ follow the commands in txt, as sent to the motor at t
+        """
+        with self.lock:
+            for cmd in txt.split():
+                if '=' in cmd:
+                    key,val = cmd.split('=',1)
+                    try:
+                        val = float(val)
+                    except ValueError:
+                        continue
+                    if key == 'ADT':
+                        self.vars['AT'] = self.vars['DT'] = val
+                    elif key in self.vars:
+                        self.vars[key] = val
+                    elif key == 'O':
+                        # new origin - same motion, shifted
+                        pos,vel,pos_err,vel_err = self._estimate(t)
+                        self.shift(t,val-pos)
+                elif cmd in ('MP','MV','MT'):
+                    self.next_mode = cmd
+                elif cmd == 'G':
+                    self.start(t,self.next_mode)
+                elif cmd == 'X':
+                    # decelerate to a stop
+                    self.start(t,'MV',vt=0.0)
+                elif cmd in ('OFF','RUN'):
+                    # off, or the resident program may move it
+                    self.start(t,None)
+
+    def start(self,t,mode,vt=None):
+        pos,vel,pos_err,vel_err = self._estimate(t)
+        v = self.vars
+        if vt is None:
+            vt = self.from_va(v['VT'])
+        if mode == 'MP':
+            self.move = ('MP',v['PT'],vt,self.from_at(v['AT']),self.from_at(v['DT']))
+        elif mode == 'MV':
+            self.move = ('MV',None,vt,self.from_at(v['AT']),self.from_at(v['DT']))
+        else:
+            self.move = None
+        self.anchor(t,pos,vel,pos_err,vel_err)
+
+    def shift(self,t,offset):
+        pos,vel,pos_err,vel_err = self._estimate(t)
+        if self.move is not None and self.move[0] == 'MP':
+            kind,pt,vt,acc,dec = self.move
+            self.move = (kind,pt+offset,vt,acc,dec)
+        self.anchor(t,pos+offset,vel,pos_err,vel_err)
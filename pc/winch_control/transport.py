@@ -0,0 +1,300 @@
+"""
+transport
+
+Record and replay the serial traffic of the winch, Humminbird and GPIO
+ports.
+
+RecordingTransport wraps an open port, passing everything through and
+logging each write and read with a timestamp to a capture file.
+ReplayTransport stands in for the port and feeds the recorded reads
+back to the same code, either in real time or as fast as possible.
+
+Replayed reads are tied to the write which preceded them in the
+recording, so a response is never delivered before the code has sent
+the command it answers, and arrives the same delay after it as in the
+recording.  Writes which differ from the recording are counted and
+logged, and the time from handing data to the code until its next
+write is collected in a histogram, e.g. to compare how quickly
+complete_position_move responds to status readings against a trace
+from the field.
+
+Capture file format: a header, then one record per event:
+  kind (1 byte: W write, R read, B baud rate change)
+  t (float64, seconds since the capture started, never decreasing)
+  length (uint32)
+  data
+
+Ports are opened through open_port(), which checks winch_settings for
+capture_dir and replay_files.
+
+usage: python transport.py capture.cap
+  prints a summary of a capture file
+"""
+import os
+import sys
+import struct
+import threading
+import collections
+import time
+import logging
+from datetime import datetime
+
+import winch_settings
+import clock
+import commstats
+
+MAGIC = 'JYSC'
+VERSION = 1
+header = struct.Struct('<4sB')
+record = struct.Struct('<cdI')
+
+def capture_path(name):
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(winch_settings.capture_dir,"%s-%s.cap"%(name,stamp))
+
+def open_port(name,opener,clk=None):
+    """ open the port for device name ('winch','humminbird' or 'gpio')
+    by calling opener(), unless winch_settings.replay_files has a capture
+    for it.  If winch_settings.capture_dir is set, the port is recorded.
+    """
+    if name in winch_settings.replay_files:
+        return ReplayTransport(winch_settings.replay_files[name],
+                               speed=winch_settings.replay_speed,clk=clk)
+    port = opener()
+    if winch_settings.capture_dir:
+        port = RecordingTransport(port,capture_path(name),clk=clk)
+    return port
+
+def read_capture(path):
+    """ list of (kind,t,data) from a capture file
+    """
+    with open(path,'rb') as fp:
+        buff = fp.read()
+    magic,version = header.unpack_from(buff,0)
+    if magic != MAGIC or version != VERSION:
+        raise Exception("%s is not a version %d capture file"%(path,VERSION))
+    events = []
+    offset = header.size
+    while offset + record.size <= len(buff):
+        kind,t,length = record.unpack_from(buff,offset)
+        offset += record.size
+        events.append( (kind,t,buff[offset:offset+length]) )
+        offset += length
+    return events
+
+
+class RecordingTransport(object):
+    def __init__(self,port,path,clk=None):
+        self.port = port
+        self.path = path
+        self.clock = clk or clock.get_clock()
+        self.log = logging.getLogger('capture')
+        self.lock = threading.Lock()
+        self.fp = open(path,'wb')
+        self.fp.write(header.pack(MAGIC,VERSION))
+        self.t0 = self.clock.time()
+        self.t_last = 0.0
+        self.log.info("Recording serial traffic to %s"%path)
+        baud = getattr(port,'baudrate',None)
+        if baud is not None:
+            self.record('B',str(baud))
+
+    def record(self,kind,data):
+        with self.lock:
+            if self.fp is None:
+                return
+            # wall clock can step backwards - keep the capture monotonic
+            self.t_last = max(self.t_last,self.clock.time() - self.t0)
+            self.fp.write(record.pack(kind,self.t_last,len(data)))
+            self.fp.write(data)
+            if kind != 'R':
+                self.fp.flush()
+
+    def write(self,data):
+        self.record('W',data)
+        return self.port.write(data)
+    def read(self,size=1):
+        data = self.port.read(size)
+        self.record('R',data)
+        return data
+    def readline(self):
+        data = self.port.readline()
+        self.record('R',data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    def get_baudrate(self):
+        return self.port.baudrate
+    def set_baudrate(self,baud):
+        self.record('B',str(baud))
+        self.port.baudrate = baud
+    baudrate = property(get_baudrate,set_baudrate)
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+        self.port.close()
+
+    def __getattr__(self,attr):
+        # flush, flushInput, timeout, ...
+        return getattr(self.port,attr)
+
+
+class ReplayTransport(object):
+    """ speed: 1.0 for real time, 0 for as fast as possible.
+    """
+    def __init__(self,path,speed=1.0,clk=None,timeout=1):
+        self.path = path
+        self.speed = speed
+        self.clock = clk or clock.get_clock()
+        self.timeout = timeout
+        self.baudrate = None
+        self.log = logging.getLogger('replay')
+
+        # expected writes, in order, and the reads as
+        # (index of the write they follow, or -1, delay after it, data)
+        self.expected = []
+        self.chunks = collections.deque()
+        t_anchor = 0.0
+        for kind,t,data in read_capture(path):
+            if kind == 'W':
+                self.expected.append(data)
+                t_anchor = t
+            elif kind == 'R' and data:
+                self.chunks.append( (len(self.expected)-1,t-t_anchor,data) )
+            elif kind == 'B' and not self.expected:
+                self.baudrate = int(data)
+        self.t_start = self.clock.time()
+        # clock time of each write made during the replay
+        self.write_times = []
+        self.rx = ""
+        self.lock = threading.Lock()
+        self.mismatches = 0
+        # from handing data to the code until its next write, real time
+        self.latency = commstats.Histogram()
+        self.t_delivered = None
+        self.log.info("Replaying %s: %d writes, %d reads"%(path,len(self.expected),len(self.chunks)))
+
+    def due(self,chunk):
+        """ clock time chunk becomes readable, or None if it waits on a
+        write which hasn't happened yet.
+        """
+        idx,delay,data = chunk
+        if idx < 0:
+            base = self.t_start
+        elif idx < len(self.write_times):
+            base = self.write_times[idx]
+        else:
+            return None
+        if self.speed == 0:
+            return base
+        return base + delay/self.speed
+
+    def poll(self,now):
+        """ move chunks which are due into rx, and return when the next
+        one will be due (None if unknown)
+        """
+        while self.chunks:
+            t_due = self.due(self.chunks[0])
+            if t_due is None or t_due > now:
+                return t_due
+            self.rx += self.chunks.popleft()[2]
+        return None
+
+    def wait_for(self,ready):
+        """ wait until ready() is true of the received data or the
+        timeout passes.
+        """
+        now = self.clock.time()
+        deadline = now + self.timeout
+        while 1:
+            with self.lock:
+                t_next = self.poll(now)
+                if ready():
+                    return
+                exhausted = not self.chunks
+            if exhausted:
+                # nothing more will come
+                self.clock.wait(max(0,deadline-now))
+                return
+            if t_next is None and self.speed == 0:
+                return
+            if t_next is None or t_next > deadline:
+                t_next = deadline
+            if now >= deadline:
+                return
+            self.clock.wait(t_next-now)
+            now = self.clock.time()
+
+    def take(self,count):
+        with self.lock:
+            data = self.rx[:count]
+            self.rx = self.rx[count:]
+        if data:
+            self.t_delivered = time.time()
+        return data
+
+    def read(self,size=1):
+        self.wait_for(lambda: len(self.rx) >= size)
+        return self.take(size)
+    def readline(self):
+        self.wait_for(lambda: "\n" in self.rx)
+        eol = self.rx.find("\n")
+        return self.take(len(self.rx) if eol < 0 else eol+1)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self.poll(self.clock.time())
+            return len(self.rx)
+
+    def write(self,data):
+        if self.t_delivered is not None:
+            self.latency.add(time.time() - self.t_delivered)
+            self.t_delivered = None
+        with self.lock:
+            idx = len(self.write_times)
+            self.write_times.append(self.clock.time())
+        if idx >= len(self.expected):
+            self.mismatches += 1
+            self.log.warning("Write %d past the end of the capture: %r"%(idx,data))
+        elif data != self.expected[idx]:
+            self.mismatches += 1
+            self.log.warning("Write %d differs from capture: %r vs %r"%(idx,data,self.expected[idx]))
+        return len(data)
+
+    def done(self):
+        """ true once every recorded read has been delivered
+        """
+        return not self.chunks and not self.rx
+
+    def flush(self):
+        pass
+    def reset_input_buffer(self):
+        with self.lock:
+            self.rx = ""
+    flushInput = reset_input_buffer
+    def close(self):
+        pass
+
+
+def summarize(path):
+    events = read_capture(path)
+    counts = collections.defaultdict(int)
+    nbytes = collections.defaultdict(int)
+    for kind,t,data in events:
+        counts[kind] += 1
+        nbytes[kind] += len(data)
+    duration = events[-1][1] if events else 0.0
+    print "%s: %d events over %.1fs"%(path,len(events),duration)
+    for kind,label in [('W','writes'),('R','reads'),('B','baud changes')]:
+        print "  %-12s %6d  %8d bytes"%(label,counts[kind],nbytes[kind])
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        summarize(path)
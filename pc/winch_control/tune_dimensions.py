@@ -1,4 +1,6 @@
 import numpy as np
+import aniwinch
+import spool
 exper_01 = np.array( [
     [    0.0,          0.0],
     [   10.0,         10.11], 
@@ -21,7 +23,8 @@ rev_total_01=410.6
 #coeffs=np.polyfit(exper_01[:,0],exper_01[:,1],1)
 
 # back out the number of revolutions from current settings:
-revs=np.array( [a.position_winch_to_revs(a.position_m_to_winch(m)) for m in exper_01[:,1]] )
+current=spool.SpoolModel.for_winch(aniwinch.AnimaticsWinch)
+revs=current.m_to_revs(exper_01[:,1])
 
 # and then the forward calc, but we'll tune these:
 # don't tune wire_area, since it is a calculated quantity.
@@ -30,7 +33,9 @@ spool_width = 0.031 # spool width cancels out
 spool_radius_outer = 0.154/2-0.01 - 0.002
 spool_radius_inner = 0.054/2.     - 0.0023 
 wire_area=spool_width*(spool_radius_outer-spool_radius_inner) / spool_revolutions_full
-m_refine=2*np.pi*revs*spool_radius_outer - 2*np.pi*revs**2/2*wire_area/spool_width
+tuned=spool.SpoolModel(current.enc_count,current.gear_box_ratio,
+                       spool_radius_outer,spool_width,wire_area)
+m_refine=tuned.revs_to_m(revs)
 
 
 import matplotlib.pyplot as plt
@@ -21,6 +21,34 @@ winch_is_real = True
 gpio_is_real = True
 hummingbird_is_real = True
 winch_baud=9600
+# if set, switch the winch to this rate after connecting at winch_baud
+winch_baud_fast=None
+# if set, commands which are sent together without waiting on a
+# response go out as one write - see AnimaticsWinch.transaction().
+# Off until it has been tried on the motor.
+winch_coalesce_writes=False
+# if set, have the motor push a telemetry record every this many ms
+# rather than polling.  Requires the program in telemetry.RESIDENT_PROGRAM
+# to be loaded on the motor.
+winch_stream_period_ms=None
+# if set, the resident program switches speeds through ctd_out/ctd_in
+# itself, rather than the PC resending MP as the cable goes out.
+# Requires the same program.
+winch_resident_cast=False
+# when the winch isn't real, use the physical model in winch_sim rather
+# than the simple FakeAnimatics
+winch_sim=False
+# if set, record the serial traffic of each device to a capture file in
+# this directory.  See transport.py
+capture_dir=None
+# capture files to replay in place of the real ports, keyed by 'winch',
+# 'humminbird' or 'gpio', and the replay speed - 1.0 is real time, 0 is
+# as fast as possible
+replay_files={}
+replay_speed=1.0
+# observations of the true wire out, and the spool geometry fitted to
+# them, which is loaded at startup.  See calibration.py
+calibration_file=os.path.join(os.path.dirname(__file__),'spool_calibration.txt')
 winch_com_port="COM1"
 
 def set_location(location):
@@ -30,6 +58,10 @@ def set_location(location):
     global gpio_com_port
     global humminbird_com_port
     global winch_is_real
+    global winch_baud_fast
+    global winch_coalesce_writes
+    global winch_sim
+    global calibration_file
 
     # and choose settings based on that    
     if location=='lab':
@@ -42,6 +74,18 @@ def set_location(location):
         winch_is_real = False
         gpio_is_real= False
         hummingbird_is_real=False
+        winch_baud_fast=115200
+        winch_coalesce_writes=True
+        calibration_file=None
+    elif location=='sim':
+        # like thistle, but with a simulated winch, cable and package
+        winch_is_real = False
+        gpio_is_real= False
+        hummingbird_is_real=False
+        winch_sim=True
+        winch_baud_fast=115200
+        winch_coalesce_writes=True
+        calibration_file=None
     elif location=='workmac':
         winch_com_port="/dev/cu.usbserial-FTGUK02I"
         gpio_is_real=False
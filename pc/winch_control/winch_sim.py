@@ -0,0 +1,434 @@
+"""
+winch_sim
+
+Physics-based stand-in for the winch.  SimulatedAnimatics answers the
+same commands as FakeAnimatics, but RPA, VA, TRQ, UIA and the status
+word come from a model of the motor, drum, cable and package:
+
+ - drum radius shrinks as wire is paid out, with the same spool model
+   as AnimaticsWinch.position_winch_to_m (spool.py)
+ - the package has mass, wet weight and quadratic drag, and hangs on
+   the line while there is tension.  When the drum pays out faster
+   than the package can fall, the line goes slack until the package
+   catches up.
+ - MP and MV follow trapezoidal profiles from AT, DT, VT and PT (see
+   trajectory.py), as long as the torque required is within the limit
+   set by AMPS.  Past that the drum moves under the limiting torque,
+   and the profile is restarted from wherever the drum got to.
+ - MT applies a fixed torque, so MT with T=0 and the brake released
+   free-wheels under the line tension.
+ - the package stops on the bottom at bottom_depth, and the drum
+   stalls when the package jams in the block at block_out.
+ - the package can snag at snag_depth on the way down, and lets go
+   snag_duration seconds later.
+ - TRQ, UIA and VA as reported can have gaussian noise added.
+
+Line going slack or taut, landing, snags and changes of drive mode are
+appended to events, and the longest length of slack line and the
+deepest the package got are kept in max_slack and max_z, for
+montecarlo.py to score the control code against.
+
+The state advances at the motor sample rate, a chunk of samples at a
+time with numpy.  Drag and friction are held at their values from the
+start of each chunk, so chunks are kept short compared to the
+dynamics, and events (line going slack or taut, bottom strike,
+hitting the block) end a chunk early.
+
+Select with winch_settings.winch_sim, or the 'sim' location.
+"""
+import math
+import numpy as np
+
+import aniwinch
+import trajectory
+import spool
+
+G = 9.81
+
+class SimulatedAnimatics(aniwinch.FakeAnimatics):
+    # package
+    package_mass = 6.0   # kg, in air
+    package_wet_kg = 5.0 # apparent weight in water, kg
+    drag_coeff = 15.0    # N/(m/s)**2
+    # drum, gearbox and rotor inertia as an equivalent mass at the wire
+    drum_mass = 2.0      # kg
+    # gearbox and drum friction in TRQ units
+    fric_coulomb = 1200.0
+    fric_viscous = 0.002 # per unit of VA
+    # extra torque the drive reports when it is driving the drum at
+    # speed.  With the friction this puts a slack line above
+    # AnimaticsWinch.torque_thresh(), and a line with a couple of kg
+    # on it below.
+    drive_loss = 0.0275  # per unit of VA
+    # TRQ per kg of tension at the outer radius, as in
+    # AnimaticsWinch.force_kg_to_winch
+    trq_per_kg = 2.2*2000/5.
+    trq_max = 32767      # at AMPS=1023
+    uia_per_trq = 0.01
+    bottom_depth = 30.0  # wire out when the package lands, m
+    block_out = -0.83    # wire out when the package jams in the block, m
+    snag_depth = None    # wire out where the package snags, m
+    snag_duration = 5.0  # s
+    # standard deviation of noise on reported values
+    noise_trq = 0.0
+    noise_uia = 0.0
+    noise_va = 0.0
+    seed = None
+
+    # samples per numpy step
+    chunk = 80
+
+    def __init__(self,clk=None):
+        aniwinch.FakeAnimatics.__init__(self,clk)
+        self.spool = spool.SpoolModel.for_winch(aniwinch.AnimaticsWinch)
+        self.counts_per_rev = self.spool.counts_per_rev
+        self.r_outer = self.spool.spool_radius_outer
+        # wire out with the spool empty
+        self.wire_end = self.spool.wire_end
+        self.state.update(AT=100,DT=100,AMPS=1023,UIA=0)
+        self.brake_mode = 'BRKTRJ'
+
+        # drum, in counts from a full spool, and counts/s
+        self.pos = 0.0
+        self.vel = 0.0
+        # drum position reported as RPA=0
+        self.origin = 0.0
+        # package, in m of wire out and m/s
+        self.z = 0.0
+        self.w = 0.0
+        self.taut = True
+        # 'off', 'servo' following self.profile, or 'torque'
+        self.mode = 'off'
+        self.profile = None
+        # the last G, to replan after the torque limit is hit
+        self.move = None
+        self.trq = 0.0
+        self.saturated = False
+        self.t_sim = self.clock.time()
+        # when the snag lets go, once the package has hit it
+        self.snag_until = None
+        # (t,kind,mode), kind one of 'slack','taut','bottom','snag','mode'
+        self.events = []
+        self.max_slack = 0.0
+        self.max_z = 0.0
+        self.rng = np.random.RandomState(self.seed)
+        self.publish()
+
+    ## spool model, see spool.py
+    def wire_out(self,pos):
+        return self.spool.counts_to_m(pos)
+    def drum_position(self,m):
+        return self.spool.m_to_counts(np.minimum(m,self.wire_end))
+    def radius(self,pos):
+        return self.spool.radius(pos)
+
+    def to_va(self,vel):
+        return vel*65536.0/self.srate
+    def from_va(self,va):
+        return va*self.srate/65536.0
+    def from_at(self,at):
+        return at*self.srate**2/65536.0
+
+    def drag(self,w):
+        return self.drag_coeff*w*np.abs(w)
+    def trq_limit(self):
+        return self.trq_max * self.state['AMPS']/1023.
+    def locked(self):
+        # BRKTRJ holds the brake unless there's a trajectory, and
+        # torque mode doesn't count
+        return self.mode == 'off' or (self.mode == 'torque' and self.brake_mode == 'BRKTRJ')
+
+    ## stepping
+    def update_position(self):
+        t = self.clock.time()
+        n = int((t - self.t_sim)*self.srate)
+        while n > 0:
+            if self.at_rest():
+                # nothing will change - skip ahead
+                self.step(1)
+                self.t_sim += (n-1)/float(self.srate)
+                break
+            n -= self.step(min(n,self.chunk))
+        self.publish()
+
+    def at_rest(self):
+        if self.vel != 0 or self.w != 0:
+            return False
+        if not (self.taut or self.z >= self.floor()):
+            return False
+        if self.snag_until is not None and self.t_sim < self.snag_until:
+            return False
+        if self.locked():
+            return True
+        return (self.mode == 'servo' and self.t_sim >= self.profile.t_end
+                and self.profile.vel[-1] == 0)
+
+    def step(self,n):
+        """ advance up to n samples, returning the number taken
+        """
+        t = np.arange(1,n+1) / float(self.srate)
+        r = self.radius(self.pos)
+        m_per_count = 2*math.pi*r/self.counts_per_rev
+        trq_per_n = self.trq_per_kg/G * r/self.r_outer
+        L0 = self.wire_out(self.pos)
+        self.saturated = False
+
+        if self.locked():
+            L = np.ones(n)*L0
+            u = np.zeros(n)
+            trq = np.zeros(n)
+        elif self.mode == 'servo':
+            pos,vel,acc = self.profile.evaluate(self.t_sim + t)
+            L = self.wire_out(pos)
+            u = vel*m_per_count
+            tension = self.tension(L,u,acc*m_per_count,n)
+            trq = ((self.drum_mass*acc*m_per_count - tension)*trq_per_n
+                   + self.friction(vel) + self.drive_loss*self.to_va(vel))
+            over = np.nonzero(np.abs(trq) > self.trq_limit())[0]
+            if len(over):
+                if over[0] > 0:
+                    return self.finish_step(over[0],L,u,trq)
+                # drive at the limit and pick the profile up afterwards
+                self.saturated = True
+                taken = self.torque_step(t,np.clip(trq[0],-self.trq_limit(),self.trq_limit()),
+                                         L0,m_per_count,trq_per_n,loss=self.drive_loss)
+                self.replan()
+                return taken
+            slack = np.nonzero(tension < 0)[0] if self.taut else []
+            if len(slack):
+                self.taut = False
+                self.note('slack',slack[0])
+                return self.finish_step(max(slack[0],1),L,u,trq)
+        else:
+            return self.torque_step(t,self.state['T'],L0,m_per_count,trq_per_n)
+        return self.finish_step(n,L,u,trq)
+
+    def tension(self,L,u,acc,n):
+        """ line tension in N while the drum follows L,u,acc.  Zero if
+        the line is slack.
+        """
+        if not self.taut:
+            return np.zeros(n)
+        return self.package_wet_kg*G - self.drag(u) - self.package_mass*acc
+
+    def friction(self,vel):
+        """ friction in TRQ units at drum velocity vel, counts/s
+        """
+        return np.sign(vel)*self.fric_coulomb + self.fric_viscous*self.to_va(vel)
+
+    def torque_step(self,t,trq_cmd,L0,m_per_count,trq_per_n,loss=0.0):
+        """ advance under a fixed motor torque trq_cmd.  loss: drive
+        loss per unit of VA, when this is the servo at its torque limit
+        """
+        n = len(t)
+        u0 = self.vel*m_per_count
+        weight = self.package_wet_kg*G
+        load = weight - self.drag(u0) if self.taut else 0.0
+        drive = trq_cmd + load*trq_per_n # TRQ units pushing wire out
+        if self.vel == 0 and abs(drive) <= self.fric_coulomb:
+            drive = 0.0 # stiction
+        elif self.vel == 0:
+            drive -= math.copysign(self.fric_coulomb,drive)
+        else:
+            drive -= math.copysign(self.fric_coulomb,self.vel)
+        if L0 <= self.block_out and drive <= 0 and u0 <= 0:
+            drive,u0 = 0.0,0.0 # jammed in the block
+        elif L0 >= self.wire_end and drive >= 0 and u0 >= 0:
+            drive,u0 = 0.0,0.0 # out of wire
+        mass = self.drum_mass
+        if self.taut:
+            mass += self.package_mass
+        # viscous friction is too stiff to hold constant over a chunk,
+        # so solve mass*du/dt = drive - visc*u exactly
+        visc = (self.fric_viscous+loss)*self.to_va(1.0/m_per_count) # TRQ per m/s
+        tau = mass*trq_per_n/visc
+        u_inf = drive/visc
+        decay = np.exp(-t/tau)
+        u = u_inf + (u0-u_inf)*decay
+        L = L0 + u_inf*t + (u0-u_inf)*tau*(1-decay)
+        if self.taut and weight - self.drag(u0) - self.package_mass*(u_inf-u0)/tau < 0:
+            # the drum is running away from the package
+            self.taut = False
+            self.note('slack')
+            return 0
+        trq = np.ones(n)*trq_cmd
+        # friction can stop the drum, but not reverse it
+        if u0 != 0:
+            stopped = np.nonzero(u*u0 <= 0)[0]
+            if len(stopped):
+                k = max(stopped[0],1)
+                u[k-1] = 0.0
+                return self.finish_step(k,L,u,trq)
+        blocked = np.nonzero((L < self.block_out) | (L > self.wire_end))[0]
+        if len(blocked):
+            k = max(blocked[0],1)
+            L[k-1] = np.clip(L[k-1],self.block_out,self.wire_end)
+            u[k-1] = 0.0
+            return self.finish_step(k,L,u,trq)
+        return self.finish_step(n,L,u,trq)
+
+    def finish_step(self,k,L,u,trq):
+        """ accept the first k samples of wire out L and speed u, and
+        move the package along with them
+        """
+        dt = 1.0/self.srate
+        floor = self.floor()
+        if self.taut:
+            z = L[:k]
+            w = u[:k]
+            landed = np.nonzero(z > floor)[0]
+            if len(landed):
+                k = max(landed[0],1)
+                self.taut = False
+                self.note('slack',k)
+                self.land(floor,k)
+                z_end,w_end = floor,0.0
+            else:
+                z_end,w_end = z[-1],w[-1]
+        elif self.z >= floor and self.w == 0:
+            z_end,w_end = self.z,0.0
+            taut = np.nonzero(L[:k] <= z_end)[0]
+            if len(taut):
+                # lifted off the bottom
+                k = max(taut[0],1)
+                self.taut = True
+                self.note('taut',k)
+        else:
+            # falling freely
+            tk = dt*np.arange(1,k+1)
+            acc = (self.package_wet_kg*G - self.drag(self.w))/self.package_mass
+            w = self.w + acc*tk
+            z = self.z + self.w*tk + 0.5*acc*tk**2
+            caught = np.nonzero((z >= L[:k]) | (z >= floor))[0]
+            if len(caught):
+                k = max(caught[0],1)
+                if z[k-1] >= floor:
+                    self.land(floor,k)
+                    z_end,w_end = floor,0.0
+                else:
+                    self.taut = True
+                    self.note('taut',k)
+                    z_end,w_end = L[k-1],u[k-1]
+            else:
+                z_end,w_end = z[-1],w[-1]
+        if not self.taut:
+            self.max_slack = max(self.max_slack,L[k-1] - z_end)
+        self.max_z = max(self.max_z,z_end)
+        m_per_count = 2*math.pi*self.radius(self.pos)/self.counts_per_rev
+        self.pos = float(self.drum_position(L[k-1]))
+        self.vel = u[k-1]/m_per_count
+        self.z,self.w = z_end,w_end
+        self.trq = trq[k-1]
+        self.t_sim += k*dt
+        return k
+
+    def floor(self):
+        """ wire out at which the package stops - the snag until it
+        lets go, then the bottom
+        """
+        if self.snag_depth is None or self.snag_depth >= self.bottom_depth:
+            return self.bottom_depth
+        if self.snag_until is None or self.t_sim < self.snag_until:
+            return self.snag_depth
+        return self.bottom_depth
+
+    def land(self,floor,k=0):
+        if floor == self.bottom_depth:
+            self.note('bottom',k)
+        elif self.snag_until is None:
+            self.snag_until = self.t_sim + k/float(self.srate) + self.snag_duration
+            self.note('snag',k)
+
+    def note(self,kind,k=0):
+        """ record an event k samples into the current step
+        """
+        self.events.append( (self.t_sim + k/float(self.srate),kind,self.mode) )
+
+    def set_mode(self,mode):
+        if mode != self.mode:
+            self.mode = mode
+            self.note('mode')
+
+    def replan(self):
+        if self.move is None:
+            return
+        kind,target,vt,at,dt = self.move
+        if kind == 'MP':
+            self.profile = trajectory.plan_position(self.t_sim,self.pos,self.vel,target,vt,at,dt)
+        else:
+            self.profile = trajectory.plan_velocity(self.t_sim,self.pos,self.vel,vt,at,dt)
+
+    def publish(self):
+        va = self.to_va(self.vel)
+        trq = self.trq
+        uia = self.trq*self.uia_per_trq
+        if self.noise_trq or self.noise_uia or self.noise_va:
+            dva,dtrq,duia = self.rng.randn(3)
+            va += self.noise_va*dva
+            trq += self.noise_trq*dtrq
+            uia += self.noise_uia*duia + self.noise_trq*dtrq*self.uia_per_trq
+        self.state['RPA'] = int(round(self.pos - self.origin))
+        self.state['RVA'] = int(va)
+        self.state['RTRQ'] = int(trq)
+        self.state['UIA'] = int(uia)
+
+    def status_word(self):
+        self.update_position()
+        # ready, hardware limits enabled
+        sw = 1 | 1024 | 2048
+        if self.mode == 'off':
+            sw |= 2
+        if self.mode == 'servo' and (self.move[0] == 'MV' or self.t_sim < self.profile.t_end):
+            sw |= 4
+        if self.saturated:
+            sw |= 16
+        return sw
+
+    ## commands
+    def assign(self,key,val):
+        if key == 'O':
+            self.update_position()
+            self.origin = self.pos - val
+        elif key == 'ADT':
+            self.state['AT'] = self.state['DT'] = val
+        aniwinch.FakeAnimatics.assign(self,key,val)
+
+    def G(self):
+        self.update_position()
+        at = self.from_at(self.state['AT'])
+        dt = self.from_at(self.state['DT'])
+        vt = self.from_va(self.state['VT'])
+        if self.traj == 'MP':
+            self.move = ('MP',self.state['PT'] + self.origin,vt,at,dt)
+        elif self.traj == 'MV':
+            self.move = ('MV',None,vt,at,dt)
+        elif self.traj == 'MT':
+            self.set_mode('torque')
+            self.move = None
+            if self.locked():
+                self.vel = 0.0
+            return
+        else:
+            return
+        self.set_mode('servo')
+        self.replan()
+    def X(self):
+        # decelerate to a stop
+        self.update_position()
+        if self.mode == 'off':
+            return
+        self.move = ('MV',None,0.0,self.from_at(self.state['AT']),self.from_at(self.state['DT']))
+        self.set_mode('servo')
+        self.replan()
+    def OFF(self):
+        self.update_position()
+        self.set_mode('off')
+        self.vel = 0.0
+    def BRKTRJ(self):
+        self.update_position()
+        self.brake_mode = 'BRKTRJ'
+        if self.locked():
+            self.vel = 0.0
+    def BRKRLS(self):
+        self.update_position()
+        self.brake_mode = 'BRKRLS'